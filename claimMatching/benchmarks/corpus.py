@@ -0,0 +1,115 @@
+"""
+Benchmarks loading a claim source from its JSON files, from the merged
+claim store and from its memory-mapped compiled corpus. Each load runs
+in a fresh interpreter, which reports the load time, the growth of its
+resident memory, and how long reading random documents (as the writer
+does) and every document (as the encoder does) takes.
+Run from the repository root with python claimMatching/benchmarks/corpus.py
+"""
+import argparse, json, os, random, resource, shutil, subprocess, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from func.corpus import convert_source
+from func.match_claims import prune_documents, read_documents
+from pipeline import write_corpus
+
+MODES = {'json': {'use_corpus': False, 'use_claim_store': False},
+         'store': {'use_corpus': False, 'use_claim_store': True},
+         'corpus': {'use_corpus': True, 'use_claim_store': False}}
+
+
+def get_rss_mb():
+    """
+    :return: the process's resident memory in megabytes, or its high-water mark where /proc is unavailable
+    """
+    if os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def measure_load(source, cfg, prune_duplicates, num_reads):
+    """
+    Loads a claim source, then reads documents from it.
+
+    :param source: name of the claim source
+    :param cfg: configuration dictionary
+    :param prune_duplicates: boolean denoting whether or not duplicates are removed from the documents
+    :param num_reads: number of random documents to read
+    :return: dictionary of the measurements
+    """
+    rss_before = get_rss_mb()
+    start = time.perf_counter()
+    documents = read_documents(source, False, cfg, prune_duplicates)
+    if prune_duplicates:
+        documents = prune_documents(documents, source)
+    load_seconds = time.perf_counter() - start
+    rss_loaded = get_rss_mb()
+
+    rng = random.Random(0)
+    reads = [rng.randrange(len(documents)) for _ in range(num_reads)]
+    start = time.perf_counter()
+    for index in reads:
+        documents[index]
+    read_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    num_bytes = sum(len(document) for document in documents)
+    scan_seconds = time.perf_counter() - start
+    return {'documents': len(documents), 'characters': num_bytes, 'load_seconds': load_seconds,
+            'load_rss_mb': rss_loaded - rss_before, 'random_read_us': read_seconds / max(num_reads, 1) * 1e6,
+            'scan_seconds': scan_seconds}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num_claims', dest='num_claims', type=int, default=200000,
+                        help='number of claims per claim source')
+    parser.add_argument('-s', '--source', dest='source', default='ng', choices=['google', 'ng', 'misc_json'],
+                        help='claim source to load')
+    parser.add_argument('-r', '--reads', dest='reads', type=int, default=1000,
+                        help='number of random documents read after loading')
+    parser.add_argument('-d', '--keep_duplicates', dest='keep_duplicates', action='store_true',
+                        help='loads every document rather than the unique ones, the claim store is then not used')
+    parser.add_argument('--files', dest='files', type=int, default=4, help='number of files per source')
+    parser.add_argument('--child', dest='child', default=None, choices=list(MODES), help=argparse.SUPPRESS)
+    parser.add_argument('--root', dest='root', default=None, help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    if arguments.child:
+        with open(os.path.join(arguments.root, 'cfg.json')) as f:
+            cfg = json.load(f)
+        cfg.update(MODES[arguments.child])
+        print(json.dumps(measure_load(arguments.source, cfg, not arguments.keep_duplicates, arguments.reads)))
+        sys.exit(0)
+
+    root = tempfile.mkdtemp(prefix='claim-corpus-')
+    try:
+        cfg = write_corpus(root, arguments.num_claims, 0, arguments.files, 0.3, 0)
+        cfg.update({'languages': ['en'], 'corpus_dir': os.path.join(root, 'corpus')})
+        with open(os.path.join(root, 'cfg.json'), 'w') as f:
+            json.dump(cfg, f)
+        json_mb = sum(os.path.getsize(path) for path in
+                      [os.path.join(directory, file) for directory, _, files in os.walk(root) for file in files]
+                      if path.endswith('.json') and not path.endswith('cfg.json')) / 3 / (1024 * 1024)
+        print("source:", arguments.source, "claims:", arguments.num_claims, "json: {:.1f} MB".format(json_mb))
+
+        start = time.perf_counter()
+        convert_source(arguments.source, cfg)
+        print("conversion: {:.2f}s".format(time.perf_counter() - start))
+        for mode in MODES:
+            if mode == 'store':
+                # the store is built on its first load, which would otherwise be measured
+                read_documents(arguments.source, False, dict(cfg, **MODES[mode]), True)
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', mode, '--root', root,
+                                     '--source', arguments.source, '--reads', str(arguments.reads)] +
+                                    (['--keep_duplicates'] if arguments.keep_duplicates else []),
+                                    capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print("{:<7} {:>8} docs  load {:6.3f}s  +{:7.1f} MB rss  random read {:6.2f}us  scan {:6.3f}s".format(
+                mode, result['documents'], result['load_seconds'], result['load_rss_mb'], result['random_read_us'],
+                result['scan_seconds']))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
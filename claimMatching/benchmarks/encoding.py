@@ -0,0 +1,80 @@
+"""
+Benchmarks the length-bucketed encoder pool in encoder_pool.EncoderPool
+against a single SentenceTransformer.encode call with default settings,
+which is how encode_sets used to encode, reporting throughput and how
+far the pool's embeddings are from the reference embeddings.
+Run from the repository root with python claimMatching/benchmarks/encoding.py
+"""
+import argparse, os, random, sys, time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from func.encoder_pool import EncoderPool
+from func.similarity import normalize_embeddings
+
+
+def make_documents(num_docs, seed):
+    """
+    Creates synthetic tweet-like documents whose lengths vary as much as real tweets do.
+
+    :param num_docs: number of documents
+    :param seed: random seed
+    :return: list of string documents
+    """
+    rng = random.Random(seed)
+    vocab = ['covid', 'vaccine', 'masks', 'lockdown', 'cure', 'hospital', 'cases', 'china', 'virus', 'test',
+             'doctors', 'says', 'new', 'study', 'people', 'the', 'a', 'is', 'not', 'and', 'of', 'to', 'in']
+    return [' '.join(rng.choice(vocab) for _ in range(rng.choice([3, 5, 8, 12, 20, 35, 50])))
+            for _ in range(num_docs)]
+
+
+def measure(encode_fn, documents):
+    """
+    :param encode_fn: function mapping a list of documents to their embeddings
+    :param documents: documents to encode
+    :return: the embeddings and documents encoded per second
+    """
+    start = time.perf_counter()
+    embeddings = np.asarray(encode_fn(documents))
+    return embeddings, len(documents) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num_docs', dest='num_docs', type=int, default=5000,
+                        help='number of synthetic documents')
+    parser.add_argument('-m', '--model', dest='model', default='distiluse-base-multilingual-cased',
+                        help='pre-trained weights to encode with')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=0,
+                        help='number of encoding processes, 0 to use every core')
+    parser.add_argument('-t', '--threads', dest='threads', type=int, default=0,
+                        help='torch threads per process, 0 to split the cores between the processes')
+    parser.add_argument('-b', '--batch_size', dest='batch_size', type=int, default=32,
+                        help='number of documents per model batch')
+    parser.add_argument('-q', '--quantize', dest='quantize', action='store_true',
+                        help='quantize the model\'s linear layers to int8')
+    arguments = parser.parse_args()
+
+    from sentence_transformers import SentenceTransformer
+
+    documents = make_documents(arguments.num_docs, 0)
+    reference_model = SentenceTransformer(arguments.model)
+    # the first call pays for lazy initialization, so neither measurement includes it
+    reference_model.encode(documents[:8])
+    reference, reference_rate = measure(reference_model.encode, documents)
+
+    cfg = {'encode_workers': arguments.workers, 'encode_threads': arguments.threads,
+           'encode_batch_size': arguments.batch_size, 'quantize_model': arguments.quantize}
+    pool = EncoderPool(arguments.model, cfg)
+    pool.encode(documents[:pool.batch_size * pool.workers * 8])
+    pooled, pooled_rate = measure(pool.encode, documents)
+    pool.close()
+
+    similarities = np.sum(normalize_embeddings(reference) * normalize_embeddings(pooled), axis=1)
+    print("documents:", arguments.num_docs, "workers:", pool.workers, "batch size:", arguments.batch_size,
+          "quantized:", arguments.quantize)
+    print("reference: {:.1f} docs/s".format(reference_rate))
+    print("pool:      {:.1f} docs/s ({:.2f}x)".format(pooled_rate, pooled_rate / reference_rate))
+    print("cosine similarity to reference embeddings: min {:.5f}, mean {:.5f}".format(similarities.min(),
+                                                                                    similarities.mean()))
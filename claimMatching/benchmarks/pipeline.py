@@ -0,0 +1,269 @@
+"""
+Benchmarks the matching pipeline offline on a synthetic corpus. Claims
+are written in the Google FactCheck, NewsGuard and misc json layouts
+and tweets in the local tweet layout, then each pipeline stage (load,
+dedup, filter, encode, search, write) is run and timed separately. A
+hashing stub replaces the SBERT encoder, so no model is downloaded.
+The results are written as JSON so they can be compared across commits.
+Run from the repository root with python claimMatching/benchmarks/pipeline.py
+"""
+from contextlib import contextmanager
+from datetime import datetime
+import argparse, json, os, platform, random, resource, shutil, subprocess, sys, tempfile, time, tracemalloc, zlib
+
+import numpy as np
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from func.ann_index import get_candidate_index, index_top_matches
+from func.keyword_filter import filter_documents
+from func.match_claims import load_documents
+from func.match_writer import MatchWriter
+from func.util import get_filtering_words, make_list_unique
+
+SUBJECTS = ['the coronavirus', 'covid-19', 'the new vaccine', 'wearing a mask', 'the lockdown', 'hydroxychloroquine',
+            'drinking hot water', 'the government', 'a new study', 'doctors in italy', 'the world health organization',
+            'garlic', 'bill gates', '5g towers', 'the flu shot', 'social distancing', 'vitamin c', 'the hospital']
+VERBS = ['cures', 'causes', 'spreads', 'prevents', 'was created by', 'kills', 'is linked to', 'does not stop',
+         'protects you from', 'was hidden by', 'is more deadly than', 'has nothing to do with']
+OBJECTS = ['the virus', 'cancer', 'thousands of deaths', 'the pandemic', 'people in china', 'children',
+           'the elderly', 'infections in new york', 'a lab in wuhan', 'big pharma', 'the immune system', 'the flu']
+TAILS = ['', ' according to experts', ' says a viral post', ' claims a facebook video', ' within days',
+         ' in just one week', ' and the media is hiding it', ' according to a leaked report']
+TWEET_FILE = 'coronavirus-tweet-id-2020-05-01-{:02d}.json'
+TWEET_FILE_REGEX = r'coronavirus-tweet-id-2020-05-01-..\.json'
+
+
+def make_claim(rng):
+    """
+    :param rng: random number generator
+    :return: a synthetic English claim sentence
+    """
+    return ' '.join([rng.choice(SUBJECTS), rng.choice(VERBS), rng.choice(OBJECTS)]).capitalize() + rng.choice(TAILS)
+
+
+def make_tweet(rng, claims, tweet_id, duplicate_rate):
+    """
+    Creates a synthetic hydrated tweet. Some tweets repeat a claim, as a retweet or with a link or mention added.
+
+    :param rng: random number generator
+    :param claims: list of claim texts tweets may repeat
+    :param tweet_id: id of the tweet
+    :param duplicate_rate: fraction of tweets that repeat a claim
+    :return: a tweet dictionary
+    """
+    if rng.random() < duplicate_rate:
+        text = rng.choice(claims)
+        variant = rng.randrange(3)
+        if variant == 1:
+            text = 'RT @user' + str(rng.randrange(1000)) + ': ' + text
+        elif variant == 2:
+            text = text + ' https://t.co/' + format(rng.getrandbits(32), 'x')
+    else:
+        text = make_claim(rng) + '. ' + make_claim(rng).lower()
+    return {'id': tweet_id, 'id_str': str(tweet_id), 'lang': 'en', 'full_text': text,
+            'created_at': 'Fri May 01 00:00:00 +0000 2020', 'entities': {}}
+
+
+def write_corpus(root, num_claims, num_tweets, num_files, duplicate_rate, seed):
+    """
+    Writes a synthetic corpus in the layouts every offline loader expects.
+
+    :param root: directory to write the corpus to
+    :param num_claims: number of claims per claim source
+    :param num_tweets: number of tweets
+    :param num_files: number of files each source is split into
+    :param duplicate_rate: fraction of claims and tweets that repeat an earlier claim
+    :param seed: random seed
+    :return: a dictionary of config paths pointing at the corpus
+    """
+    rng = random.Random(seed)
+    paths = {'data_dir': root, 'google_dir': os.path.join(root, 'fact_check_api'),
+             'ng_dir': os.path.join(root, 'newsguard'), 'json_dir': os.path.join(root, 'misc_json'),
+             'tweet_dir': os.path.join(root, 'tweets'), 'output_dir': os.path.join(root, 'output'),
+             'index_dir': os.path.join(root, 'indices'), 'claim_store_path': os.path.join(root, 'claim_store.sqlite'),
+             'embedding_cache_dir': os.path.join(root, 'embedding_cache')}
+    for key in ['ng_dir', 'json_dir', 'tweet_dir']:
+        os.makedirs(paths[key], exist_ok=True)
+    os.makedirs(os.path.join(paths['google_dir'], 'en'), exist_ok=True)
+
+    claims = []
+    for _ in range(num_claims):
+        claims.append(rng.choice(claims) if claims and rng.random() < duplicate_rate else make_claim(rng))
+    google = [{'text': text, 'claimant': 'Facebook user', 'claimDate': '2020-05-01T00:00:00Z',
+               'claimReview': [{'publisher': {'name': 'Fact Checker', 'site': 'factchecker.org'},
+                                'url': 'https://factchecker.org/claims/' + str(index), 'title': text,
+                                'textualRating': rng.choice(['False', 'Misleading', 'Mostly false']),
+                                'languageCode': 'en'}]} for index, text in enumerate(claims)]
+    newsguard = [{'id': 'ng-' + str(index), 'description': rng.choice(claims) if rng.random() < 0.5 else
+                  make_claim(rng)} for index in range(num_claims)]
+    misc = [{'id': 'misc-' + str(index), 'content': rng.choice(claims) if rng.random() < 0.5 else make_claim(rng)}
+            for index in range(num_claims)]
+    per_file = -(-num_claims // num_files)
+    for name, directory, records in [('google', os.path.join(paths['google_dir'], 'en'), google),
+                                     ('newsguard', paths['ng_dir'], newsguard), ('misc', paths['json_dir'], misc)]:
+        for file_index, start in enumerate(range(0, len(records), per_file)):
+            with open(os.path.join(directory, name + '-' + str(file_index) + '.json'), 'w') as f:
+                json.dump(records[start:start + per_file], f)
+
+    per_file = -(-num_tweets // num_files)
+    for file_index in range(num_files):
+        with open(os.path.join(paths['tweet_dir'], TWEET_FILE.format(file_index)), 'w') as f:
+            for tweet_id in range(file_index * per_file, min(num_tweets, (file_index + 1) * per_file)):
+                f.write(json.dumps(make_tweet(rng, claims, tweet_id, duplicate_rate)) + '\n')
+    return paths
+
+
+def stub_encode(documents, dim=256):
+    """
+    Offline stand-in for the SBERT encoder that embeds documents as signed hashed bags of words.
+
+    :param documents: list of string documents
+    :param dim: embedding dimension
+    :return: a float32 array of embeddings
+    """
+    embeddings = np.zeros((len(documents), dim), dtype=np.float32)
+    for row, document in enumerate(documents):
+        for word in str(document).lower().split():
+            code = zlib.crc32(word.encode('utf-8'))
+            embeddings[row, code % dim] += 1 if code & 1 << 31 else -1
+    return embeddings
+
+
+class StageRecorder:
+    """
+    Records the run time, document counts and memory high-water mark of each pipeline stage.
+    """
+
+    def __init__(self, trace_memory):
+        self.trace_memory = trace_memory
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the stage run in the with block. The block may add counts to the yielded dictionary.
+
+        :param name: name of the stage
+        :return: yields a dictionary for the stage's counts
+        """
+        counts = {}
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        yield counts
+        result = {'seconds': time.perf_counter() - start}
+        if self.trace_memory:
+            result['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            tracemalloc.stop()
+        # the resident set high-water mark is for the whole process so far, in KB on Linux and bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result['rss_high_water_mb'] = max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+        result.update(counts)
+        self.stages[name] = result
+        print("{:<8} {:8.3f}s".format(name, result['seconds']), counts)
+
+
+def run_pipeline(search_set, candidate_set, filter, recorder, cfg):
+    """
+    Runs each stage of the matching pipeline on the corpus with the stub encoder.
+
+    :param search_set: string denoting what data to use for the search set
+    :param candidate_set: string denoting what data to use for the candidate set
+    :param filter: boolean denoting whether or not the search set should be filtered with candidate set words
+    :param recorder: StageRecorder for the stages
+    :param cfg: configuration dictionary
+    :return: none
+    """
+    with recorder.stage('load') as counts:
+        candidate_docs = load_documents(candidate_set, False, cfg)
+        search_docs = candidate_docs if search_set == candidate_set else load_documents(search_set, False, cfg)
+        counts.update({'search_docs': len(search_docs), 'candidate_docs': len(candidate_docs)})
+    with recorder.stage('dedup') as counts:
+        candidate_docs = make_list_unique(candidate_docs)
+        search_docs = candidate_docs if search_set == candidate_set else make_list_unique(search_docs)
+        counts.update({'search_docs': len(search_docs), 'candidate_docs': len(candidate_docs)})
+    matches = []
+    if filter:
+        with recorder.stage('filter') as counts:
+            filter_words = get_filtering_words(candidate_docs, cfg)
+            search_docs, matches = filter_documents(search_docs, filter_words, cfg.get('filter_workers', 1))
+            counts.update({'search_docs': len(search_docs), 'filter_words': len(filter_words)})
+    with recorder.stage('encode') as counts:
+        candidate_embeddings = stub_encode(candidate_docs)
+        search_embeddings = candidate_embeddings if search_set == candidate_set else stub_encode(search_docs)
+        counts['encoded_docs'] = len(candidate_docs) + (0 if search_set == candidate_set else len(search_docs))
+    with recorder.stage('search') as counts:
+        index = get_candidate_index(candidate_docs, candidate_embeddings, candidate_set, cfg)
+        all_distances, all_indices = index_top_matches(index, search_embeddings, search_set, candidate_set, cfg)
+        counts['index_type'] = index.index_type
+    with recorder.stage('write') as counts:
+        with MatchWriter(search_set, candidate_set, candidate_docs, cfg) as writer:
+            writer.write(search_docs, matches or [None] * len(search_docs), all_distances, all_indices)
+        counts['written_docs'] = writer.num_searched
+
+
+def get_commit():
+    """
+    :return: the checked out git commit, or None outside of a git checkout
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    sets = ['local_tweets', 'google', 'ng', 'misc_json']
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-cfg', '--config', dest='config', type=str, default='claimMatching/config/config.yml',
+                        help='configuration file whose matching settings are benchmarked')
+    parser.add_argument('-s', '--search_set', dest='search_set', default='local_tweets', choices=sets,
+                        help='which synthetic items to find matching claims for')
+    parser.add_argument('-c', '--candidate_set', dest='candidate_set', default='google', choices=sets,
+                        help='which synthetic items to use as potential matches')
+    parser.add_argument('-n', '--num_claims', dest='num_claims', type=int, default=5000,
+                        help='number of claims per claim source')
+    parser.add_argument('-t', '--num_tweets', dest='num_tweets', type=int, default=20000, help='number of tweets')
+    parser.add_argument('--files', dest='files', type=int, default=4, help='number of files per source')
+    parser.add_argument('--duplicate_rate', dest='duplicate_rate', type=float, default=0.3,
+                        help='fraction of claims and tweets that repeat an earlier claim')
+    parser.add_argument('--seed', dest='seed', type=int, default=0, help='random seed of the corpus')
+    parser.add_argument('-f', '--filter', dest='filter', action='store_true',
+                        help='adds the TF-IDF filter stage')
+    parser.add_argument('-M', '--trace_memory', dest='trace_memory', action='store_true',
+                        help='records each stage\'s peak Python allocations, which slows the stages down')
+    parser.add_argument('-o', '--output', dest='output', type=str, default=None,
+                        help='file to write the JSON results to, printed if not given')
+    parser.add_argument('--corpus_dir', dest='corpus_dir', type=str, default=None,
+                        help='directory to write the corpus to and keep, a temporary directory is used if not given')
+    arguments = parser.parse_args()
+
+    with open(arguments.config) as f:
+        cfg = yaml.load(f, Loader=yaml.FullLoader)
+    root = arguments.corpus_dir or tempfile.mkdtemp(prefix='claim-benchmark-')
+    start = time.perf_counter()
+    cfg.update(write_corpus(root, arguments.num_claims, arguments.num_tweets, arguments.files,
+                            arguments.duplicate_rate, arguments.seed))
+    corpus_seconds = time.perf_counter() - start
+    cfg.update({'languages': ['en'], 'tweet_files': [TWEET_FILE_REGEX],
+                'num_entries': 0, 'output_formats': ['txt', 'jsonl']})
+
+    recorder = StageRecorder(arguments.trace_memory)
+    try:
+        run_pipeline(arguments.search_set, arguments.candidate_set, arguments.filter, recorder, cfg)
+    finally:
+        if arguments.corpus_dir is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    results = {'commit': get_commit(), 'created': datetime.now().isoformat(), 'python': platform.python_version(),
+               'machine': platform.machine(), 'cpus': os.cpu_count(),
+               'parameters': {key: value for key, value in vars(arguments).items() if key not in ['output', 'config']},
+               'corpus_seconds': corpus_seconds, 'stages': recorder.stages,
+               'total_seconds': sum(stage['seconds'] for stage in recorder.stages.values())}
+    if arguments.output:
+        with open(arguments.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Results written to", arguments.output)
+    else:
+        print(json.dumps(results, indent=2))
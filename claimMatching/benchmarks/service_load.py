@@ -0,0 +1,65 @@
+"""
+Load generator for the matching service started with main.py --serve.
+Sends match requests from several concurrent clients and reports
+throughput and latency percentiles.
+Run from the repository root with python claimMatching/benchmarks/service_load.py
+"""
+from concurrent.futures import ThreadPoolExecutor
+import argparse, http.client, json, time
+
+import numpy as np
+
+SAMPLE_TEXTS = [
+    "Drinking hot water with lemon kills the coronavirus",
+    "5G towers are spreading COVID-19",
+    "Wearing a mask causes carbon dioxide poisoning",
+    "The virus was created in a lab in Wuhan",
+    "Hydroxychloroquine cures COVID-19",
+    "Garlic protects you from the new coronavirus",
+]
+
+
+def run_client(host, port, num_requests, texts_per_request):
+    """
+    Sends match requests one after another over a single connection.
+
+    :param host: service host
+    :param port: service port
+    :param num_requests: number of requests to send
+    :param texts_per_request: number of texts in each request
+    :return: list of request latencies in seconds
+    """
+    conn = http.client.HTTPConnection(host, port)
+    latencies = []
+    for request in range(num_requests):
+        texts = [SAMPLE_TEXTS[(request + offset) % len(SAMPLE_TEXTS)] for offset in range(texts_per_request)]
+        body = json.dumps({'texts': texts})
+        start = time.perf_counter()
+        conn.request('POST', '/match', body, {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start)
+        if response.status != 200:
+            print("Request failed with status", response.status)
+    conn.close()
+    return latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', dest='host', type=str, default='127.0.0.1', help='service host')
+    parser.add_argument('--port', dest='port', type=int, default=8765, help='service port')
+    parser.add_argument('-c', '--clients', dest='clients', type=int, default=8, help='number of concurrent clients')
+    parser.add_argument('-n', '--requests', dest='requests', type=int, default=100, help='requests per client')
+    parser.add_argument('-t', '--texts', dest='texts', type=int, default=1, help='texts per request')
+    arguments = parser.parse_args()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=arguments.clients) as pool:
+        results = pool.map(lambda _: run_client(arguments.host, arguments.port, arguments.requests, arguments.texts),
+                           range(arguments.clients))
+        latencies = np.array([latency for client in results for latency in client]) * 1000
+    elapsed = time.perf_counter() - start
+    print("requests:", len(latencies), "in {:.2f}s, {:.1f} requests/s".format(elapsed, len(latencies) / elapsed))
+    print("latency ms: p50 {:.2f}, p90 {:.2f}, p99 {:.2f}, max {:.2f}".format(
+        *np.percentile(latencies, [50, 90, 99]), latencies.max()))
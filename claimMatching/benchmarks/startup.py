@@ -0,0 +1,99 @@
+"""
+Benchmarks the import cost of each mode of main.py. Every mode imports
+what main.py imports for it in a fresh interpreter, so the timings are
+cold-start timings, and reports which heavy third-party packages were
+loaded. The eager mode imports every heavy package, which is what each
+invocation of main.py used to pay for before imports were deferred.
+Run from the repository root with python claimMatching/benchmarks/startup.py
+"""
+import argparse, json, os, statistics, subprocess, sys, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ['faiss', 'langdetect', 'nltk', 'PIL', 'psycopg2', 'pyarrow', 'pytesseract', 'requests', 'scipy',
+         'sentence_transformers', 'torch']
+MODES = {
+    'startup': 'import main',
+    'fetch': 'import main; import func.get_google_fact_check',
+    'cache': 'import main; import func.embedding_cache',
+    'match google ng': "import main; import func.match_claims as M; M.import_loader('google'); M.import_loader('ng')",
+    'match tweets': "import main; import func.match_claims as M; M.import_loader('tweets')",
+    'filter': 'import main; import func.match_claims; from nltk.corpus import stopwords; import scipy.sparse',
+    'serve': 'import main; import func.match_service',
+    'encode': 'import main; import func.match_claims; import torch, sentence_transformers',
+    'eager': 'import main; import func.match_claims; import func.get_google_fact_check; import func.match_service\n'
+             'for name in ["psycopg2", "langdetect", "PIL.Image", "pytesseract", "nltk.corpus", "scipy.sparse", '
+             '"torch", "sentence_transformers"]:\n'
+             '    try:\n'
+             '        __import__(name)\n'
+             '    except ImportError:\n'
+             '        pass',
+}
+REPORT = '\nimport json, sys\nprint(json.dumps(sorted(name for name in {} if name in sys.modules)))'.format(HEAVY)
+
+
+def run_mode(code, import_time=False):
+    """
+    Runs a mode's imports in a fresh interpreter started from the claimMatching directory.
+
+    :param code: python code importing the mode's modules
+    :param import_time: whether or not to have python report the time of every import
+    :return: seconds taken by the interpreter, the heavy packages it loaded and its import time report
+    """
+    command = [sys.executable] + (['-X', 'importtime'] if import_time else []) + ['-c', code + REPORT]
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=ROOT, capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    if result.returncode != 0:
+        return seconds, None, result.stderr
+    return seconds, json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def slowest_imports(report, num_imports):
+    """
+    :param report: stderr of an interpreter run with -X importtime
+    :param num_imports: number of imports to return
+    :return: the slowest top-level imports as (cumulative seconds, package) pairs
+    """
+    imports = []
+    for line in report.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, package = line[len('import time:'):].split('|')
+        # nested imports are indented under the import that triggered them
+        if cumulative.strip().isdigit() and not package.startswith('  '):
+            imports.append((int(cumulative) / 1e6, package.strip()))
+    return sorted(imports, reverse=True)[:num_imports]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--repeats', dest='repeats', type=int, default=5,
+                        help='number of fresh interpreters started per mode')
+    parser.add_argument('-m', '--modes', dest='modes', nargs='+', default=list(MODES), choices=list(MODES),
+                        help='modes to benchmark')
+    parser.add_argument('-i', '--imports', dest='imports', type=int, default=0,
+                        help='number of slowest top-level imports to list for each mode')
+    parser.add_argument('-o', '--output', dest='output', default=None,
+                        help='file to write the results to as JSON')
+    arguments = parser.parse_args()
+
+    # the interpreter alone is the floor every mode pays
+    baseline = min(run_mode('pass')[0] for _ in range(arguments.repeats))
+    print("interpreter: {:.3f}s".format(baseline))
+    results = {'interpreter_seconds': baseline, 'modes': {}}
+    for mode in arguments.modes:
+        runs = [run_mode(MODES[mode]) for _ in range(arguments.repeats)]
+        if runs[0][1] is None:
+            print("{:<16} failed: {}".format(mode, runs[0][2].strip().splitlines()[-1]))
+            continue
+        seconds = [run[0] for run in runs]
+        results['modes'][mode] = {'min_seconds': min(seconds), 'median_seconds': statistics.median(seconds),
+                                  'import_seconds': min(seconds) - baseline, 'heavy_packages': runs[0][1]}
+        print("{:<16} {:.3f}s (median {:.3f}s), loads: {}".format(mode, min(seconds), statistics.median(seconds),
+                                                                 ', '.join(runs[0][1]) or 'none'))
+        if arguments.imports:
+            for cumulative, package in slowest_imports(run_mode(MODES[mode], import_time=True)[2], arguments.imports):
+                print("    {:.3f}s {}".format(cumulative, package))
+    if arguments.output:
+        with open(arguments.output, 'w') as f:
+            json.dump(results, f, indent=2)
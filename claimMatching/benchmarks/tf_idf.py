@@ -0,0 +1,86 @@
+"""
+Benchmarks the sparse TF-IDF in util.do_tf_idf against the dense
+implementation it replaced, reporting run time, peak memory and
+whether both produce the same filtering word ranking.
+Run from the repository root with python claimMatching/benchmarks/tf_idf.py
+"""
+import argparse, os, random, sys, time, tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from func.util import do_tf_idf
+
+
+def dense_tf_idf(documents):
+    """
+    The dense TF-IDF previously used by util.do_tf_idf, kept as a reference.
+
+    :param documents: list of all documents to perform tf-idf over
+    :return: the dense tf-idf matrix and the word decoder
+    """
+    unique_words = list(dict.fromkeys(word.lower() for document in documents for word in document.split(' ')))
+    word_encoder = {word: index for index, word in enumerate(unique_words)}
+    word_counts = np.zeros((len(documents), len(unique_words)), dtype=np.int32)
+    for index, document in enumerate(documents):
+        for word in document.split(' '):
+            word_counts[index, word_encoder[word.lower()]] += 1
+    tf_matrix = word_counts / np.sum(word_counts, axis=1).reshape(-1, 1)
+    presence = word_counts.copy()
+    presence[presence > 0] = 1
+    idf_matrix = np.log(len(documents) / np.sum(presence, axis=0))
+    return tf_matrix * idf_matrix, unique_words
+
+
+def make_documents(num_docs, vocab_size, seed):
+    """
+    Creates synthetic documents whose word frequencies follow a Zipf distribution like natural text.
+
+    :param num_docs: number of documents
+    :param vocab_size: number of distinct words
+    :param seed: random seed
+    :return: list of string documents
+    """
+    rng = random.Random(seed)
+    vocab = ['word' + str(index) for index in range(vocab_size)]
+    weights = [1 / (rank + 1) for rank in range(vocab_size)]
+    return [' '.join(rng.choices(vocab, weights, k=rng.randint(8, 40))) for _ in range(num_docs)]
+
+
+def measure(fn, documents):
+    """
+    :param fn: tf-idf function to time
+    :param documents: documents to run it on
+    :return: the function's result, seconds taken and peak traced memory in MB
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(documents)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num_docs', dest='num_docs', type=int, default=20000,
+                        help='number of synthetic documents')
+    parser.add_argument('-v', '--vocab_size', dest='vocab_size', type=int, default=30000,
+                        help='number of distinct words in the synthetic documents')
+    parser.add_argument('-k', '--num_filters', dest='num_filters', type=int, default=80,
+                        help='number of filtering words to compare')
+    arguments = parser.parse_args()
+
+    documents = make_documents(arguments.num_docs, arguments.vocab_size, 0)
+    (dense_matrix, dense_decoder), dense_time, dense_peak = measure(dense_tf_idf, documents)
+    (sparse_matrix, _, sparse_decoder), sparse_time, sparse_peak = measure(do_tf_idf, documents)
+
+    dense_top = [dense_decoder[term] for term in np.argsort(np.sum(dense_matrix, axis=0))[-arguments.num_filters:]]
+    sparse_sums = np.asarray(sparse_matrix.sum(axis=0)).ravel()
+    sparse_top = [sparse_decoder[term] for term in np.argsort(sparse_sums)[-arguments.num_filters:]]
+
+    print("documents:", arguments.num_docs, "unique words:", len(sparse_decoder), "non-zeros:", sparse_matrix.nnz)
+    print("dense:  {:.2f}s, peak {:.1f} MB".format(dense_time, dense_peak))
+    print("sparse: {:.2f}s, peak {:.1f} MB".format(sparse_time, sparse_peak))
+    print("same filtering words:", set(dense_top) == set(sparse_top), "same ranking:", dense_top == sparse_top)
@@ -0,0 +1,358 @@
+"""
+This file contains the nearest-neighbour index layer that sits behind
+the claim matcher. An index is built once from the candidate set's
+embeddings, saved to disk and reloaded on later runs. The exact index
+reproduces the brute-force cosine search, while the IVF/PQ and HNSW
+indices trade a little recall for much faster searches over large
+candidate sets.
+"""
+import glob, hashlib, json, os, re, sys
+
+import numpy as np
+
+from func.embedding_cache import hash_text
+from func.encoder_pool import get_model_name
+from func.quantized_index import QuantizedIndex
+from func.sharded_index import ShardedIndex
+from func.similarity import exclude_ids, normalize_embeddings, normalized_top_matches
+
+INDEX_TYPES = ['exact', 'ivfpq', 'hnsw']
+DEFAULT_INDEX_DIR = 'data/indices/'
+
+
+def import_faiss():
+    """
+    Helper function that imports faiss, which is only needed by the approximate indices.
+
+    :return: the faiss module
+    """
+    try:
+        import faiss
+    except ImportError:
+        print("The ivfpq and hnsw indices require faiss, please run pip install faiss-cpu or set index_type to exact.")
+        sys.exit(1)
+    return faiss
+
+
+class ExactIndex:
+    """
+    Brute-force cosine index over every candidate embedding.
+    """
+    index_type = 'exact'
+
+    def __init__(self, embeddings, cfg):
+        self.embeddings = normalize_embeddings(embeddings)
+        self.cfg = cfg
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def search(self, query_embeddings, k):
+        # the candidates were normalized once when the index was built
+        return normalized_top_matches(normalize_embeddings(query_embeddings), self.embeddings, k, self.cfg)
+
+    def save(self, path):
+        np.save(path, self.embeddings)
+
+    @classmethod
+    def load(cls, path, cfg):
+        index = cls.__new__(cls)
+        index.embeddings = np.load(path, mmap_mode='r')
+        index.cfg = cfg
+        return index
+
+
+class FaissIndex:
+    """
+    Approximate cosine index backed by a faiss IVF/PQ or HNSW inner-product index over normalized embeddings.
+    """
+
+    def __init__(self, index, index_type, cfg):
+        self.index = index
+        self.index_type = index_type
+        self.cfg = cfg
+        self.configure_search()
+
+    def __len__(self):
+        return self.index.ntotal
+
+    def configure_search(self):
+        """
+        Applies the configured search-time parameters to the underlying faiss index.
+
+        :return: none
+        """
+        faiss = import_faiss()
+        if self.index_type == 'ivfpq':
+            faiss.extract_index_ivf(self.index).nprobe = self.cfg.get('ivf_nprobe', 16)
+        elif self.index_type == 'hnsw':
+            self.index.hnsw.efSearch = self.cfg.get('hnsw_ef_search', 128)
+
+    @classmethod
+    def build(cls, embeddings, index_type, cfg):
+        faiss = import_faiss()
+        vectors = np.ascontiguousarray(normalize_embeddings(embeddings), dtype=np.float32)
+        dim = vectors.shape[1]
+        if index_type == 'ivfpq':
+            nlist = max(1, min(cfg.get('ivf_nlist', 1024), len(vectors) // 39))
+            quantizer = faiss.IndexFlatIP(dim)
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, cfg.get('pq_m', 16), cfg.get('pq_nbits', 8),
+                                     faiss.METRIC_INNER_PRODUCT)
+            index.train(vectors)
+        else:
+            index = faiss.IndexHNSWFlat(dim, cfg.get('hnsw_m', 32), faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = cfg.get('hnsw_ef_construction', 200)
+        index.add(vectors)
+        return cls(index, index_type, cfg)
+
+    def search(self, query_embeddings, k):
+        queries = np.ascontiguousarray(normalize_embeddings(query_embeddings), dtype=np.float32)
+        k = min(k, len(self))
+        similarities, indices = self.index.search(queries, k)
+        return 1.0 - similarities.astype(np.float64), indices.astype(np.int64)
+
+    def save(self, path):
+        import_faiss().write_index(self.index, path)
+
+    @classmethod
+    def load(cls, path, index_type, cfg):
+        return cls(import_faiss().read_index(path), index_type, cfg)
+
+
+def fingerprint_candidates(candidate_docs, cfg):
+    """
+    Computes an identifier for a candidate set so that a saved index is only reused for the same documents,
+    model and index settings.
+
+    :param candidate_docs: list of all documents in the candidate set
+    :param cfg: configuration dictionary
+    :return: hex string fingerprint
+    """
+    digest = hashlib.sha1()
+    digest.update(get_model_name(cfg['model'], cfg).encode('utf-8'))
+    for key in ['index_type', 'ivf_nlist', 'pq_m', 'pq_nbits', 'hnsw_m', 'hnsw_ef_construction']:
+        digest.update(str(cfg.get(key)).encode('utf-8'))
+    for doc in candidate_docs:
+        digest.update(hash_text(doc))
+    return digest.hexdigest()
+
+
+def get_vector_path(candidate_docs, candidate_set, cfg):
+    """
+    Returns where a quantized index keeps its float32 embeddings for re-ranking and where shard workers load their
+    slices of the embeddings from. The path names the model and the candidate set's fingerprint, so embeddings of
+    another model or candidate set are never used, and older files of the same candidate set and model are removed.
+
+    :param candidate_docs: list of all documents in the candidate set
+    :param candidate_set: name of the candidate set
+    :param cfg: configuration dictionary
+    :return: path of the .npy file with the candidate set's float32 embeddings
+    """
+    model_name = re.sub(r'[^A-Za-z0-9_.-]', '_', get_model_name(cfg['model'], cfg))
+    prefix = os.path.join(cfg.get('index_dir', DEFAULT_INDEX_DIR), candidate_set + '-' + model_name + '-')
+    vector_path = prefix + fingerprint_candidates(candidate_docs, cfg)[:16] + '.npy'
+    # processes still mapping a removed file keep reading it until they unmap it
+    for path in glob.glob(glob.escape(prefix) + '[0-9a-f]' * 16 + '.npy'):
+        if path != vector_path:
+            os.remove(path)
+    return vector_path
+
+
+def get_index_paths(candidate_set, index_type, cfg):
+    """
+    :param candidate_set: name of the candidate set
+    :param index_type: type of the index stored on disk
+    :param cfg: configuration dictionary
+    :return: the path of the saved index and the path of its metadata file
+    """
+    base = os.path.join(cfg.get('index_dir', DEFAULT_INDEX_DIR), candidate_set + '-' + cfg.get('index_type', 'exact'))
+    suffix = '.npy' if index_type == 'exact' else '.faiss'
+    return base + suffix, base + '.json'
+
+
+def build_index(candidate_embeddings, cfg):
+    """
+    Builds the configured index type over the candidate set's embeddings.
+
+    :param candidate_embeddings: SBERT-generated embeddings for all documents in the candidate set
+    :param cfg: configuration dictionary
+    :return: an index with a search(query_embeddings, k) method
+    """
+    index_type = cfg.get('index_type', 'exact')
+    if index_type not in INDEX_TYPES:
+        print("Unknown index_type", index_type, "in config, please use one of", INDEX_TYPES)
+        sys.exit(1)
+    if index_type == 'exact':
+        return ExactIndex(candidate_embeddings, cfg)
+    if index_type == 'ivfpq' and len(candidate_embeddings) < 2 ** cfg.get('pq_nbits', 8):
+        print("Too few candidates to train an ivfpq index, falling back to the exact index.")
+        return ExactIndex(candidate_embeddings, cfg)
+    print("Building", index_type, "index over", len(candidate_embeddings), "candidates...")
+    return FaissIndex.build(candidate_embeddings, index_type, cfg)
+
+
+def load_index(candidate_set, fingerprint, cfg):
+    """
+    Loads a saved index for the candidate set if one was built from the same documents and settings.
+
+    :param candidate_set: name of the candidate set
+    :param fingerprint: fingerprint of the current candidate set
+    :param cfg: configuration dictionary
+    :return: the saved index, or None if there is no up-to-date index on disk
+    """
+    _, meta_path = get_index_paths(candidate_set, None, cfg)
+    if not os.path.isfile(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    index_path, _ = get_index_paths(candidate_set, meta.get('index_type'), cfg)
+    if meta.get('fingerprint') != fingerprint or not os.path.isfile(index_path):
+        return None
+    print("Loading", meta.get('index_type'), "index from", index_path)
+    if meta.get('index_type') == 'exact':
+        return ExactIndex.load(index_path, cfg)
+    return FaissIndex.load(index_path, meta.get('index_type'), cfg)
+
+
+def save_index(index, candidate_set, fingerprint, cfg):
+    """
+    Saves an index and its metadata to the index directory.
+
+    :param index: index to save
+    :param candidate_set: name of the candidate set
+    :param fingerprint: fingerprint of the candidate set the index was built from
+    :param cfg: configuration dictionary
+    :return: none
+    """
+    os.makedirs(cfg.get('index_dir', DEFAULT_INDEX_DIR), exist_ok=True)
+    index_path, meta_path = get_index_paths(candidate_set, index.index_type, cfg)
+    index.save(index_path)
+    with open(meta_path, 'w') as f:
+        json.dump({'index_type': index.index_type, 'fingerprint': fingerprint, 'size': len(index),
+                   'model': cfg['model']}, f)
+
+
+def get_candidate_index(candidate_docs, candidate_embeddings, candidate_set, cfg):
+    """
+    Returns an index over the candidate set, loading it from disk when an up-to-date copy exists and
+    otherwise building and saving a new one.
+
+    :param candidate_docs: list of all documents in the candidate set
+    :param candidate_embeddings: SBERT-generated embeddings for all documents in the candidate set
+    :param candidate_set: name of the candidate set
+    :param cfg: configuration dictionary
+    :return: an index with a search(query_embeddings, k) method
+    """
+    if cfg.get('index_type', 'exact') == 'exact':
+        if cfg.get('num_shards', 0) > 1:
+            return ShardedIndex(candidate_embeddings, get_vector_path(candidate_docs, candidate_set, cfg), cfg)
+        quantization = cfg.get('embedding_quantization', 'none')
+        if quantization != 'none':
+            return QuantizedIndex(candidate_embeddings, quantization,
+                                  get_vector_path(candidate_docs, candidate_set, cfg), cfg)
+        # the exact index is cheaper to rebuild from the embeddings than to read back from disk
+        return build_index(candidate_embeddings, cfg)
+    fingerprint = fingerprint_candidates(candidate_docs, cfg)
+    index = load_index(candidate_set, fingerprint, cfg)
+    if index is None:
+        index = build_index(candidate_embeddings, cfg)
+        save_index(index, candidate_set, fingerprint, cfg)
+    return index
+
+
+def index_top_matches(index, search_embeddings, search_set, candidate_set, cfg, search_ids=None):
+    """
+    Finds the top matching candidate documents for every search document with an index. When the search set is
+    the candidate set, each document's own candidate is left out of its results by id, since neither approximate
+    indices nor ties with duplicate documents guarantee that it comes back first.
+
+    :param index: index over the candidate set
+    :param search_embeddings: SBERT-generated embeddings for all documents in the search set
+    :param search_set: name of the search set
+    :param candidate_set: name of the candidate set
+    :param cfg: configuration dictionary
+    :param search_ids: candidate index of each search document when the search set is the candidate set, by
+    default its position
+    :return: a 2D array of cosine distances and a 2D array of indices of the closest candidates for each search item
+    """
+    if search_ids is None:
+        search_ids = np.arange(len(search_embeddings))
+    if search_set == candidate_set and getattr(index, 'excludes_self', False):
+        return index.search(search_embeddings, cfg['num_matches'], exclude=search_ids)
+    if search_set == candidate_set:
+        distances, indices = index.search(search_embeddings, cfg['num_matches'] + 1)
+        k = min(cfg['num_matches'], indices.shape[1])
+        return exclude_ids(distances, indices, search_ids, k)
+    return index.search(search_embeddings, cfg['num_matches'])
+
+
+def close_index(index):
+    """
+    Stops the worker processes of indices that have them.
+
+    :param index: index over the candidate set
+    :return: none
+    """
+    if hasattr(index, 'close'):
+        index.close()
+
+
+def recall_report(index, search_embeddings, candidate_embeddings, search_set, candidate_set, cfg, search_ids=None):
+    """
+    Compares an index's matches to the exact cosine matches and prints the recall. For quantized indices the
+    recall before re-ranking and the memory saved are reported as well.
+
+    :param index: index over the candidate set
+    :param search_embeddings: SBERT-generated embeddings for all documents in the search set
+    :param candidate_embeddings: SBERT-generated embeddings for all documents in the candidate set
+    :param search_set: name of the search set
+    :param candidate_set: name of the candidate set
+    :param cfg: configuration dictionary
+    :param search_ids: candidate index of each search document when the search set is the candidate set, by
+    default its position
+    :return: a dictionary with the recall at num_matches and the rate at which the top match agrees
+    """
+    if search_ids is None:
+        search_ids = np.arange(len(search_embeddings))
+    exact_index = ExactIndex(candidate_embeddings, cfg)
+    exact_distances, exact = index_top_matches(exact_index, search_embeddings, search_set, candidate_set, cfg,
+                                               search_ids)
+    approx_distances, approx = index_top_matches(index, search_embeddings, search_set, candidate_set, cfg, search_ids)
+    report = {'index_type': index.index_type, 'queries': len(exact), 'k': cfg['num_matches']}
+    report.update(compare_matches(exact, approx))
+    print("Recall of", report['index_type'], "index at k =", report['k'], "over", report['queries'], "queries:",
+          round(report['recall_at_k'], 4), "(top match agreement", round(report['top1_agreement'], 4), ")")
+    if isinstance(index, QuantizedIndex):
+        if search_set == candidate_set:
+            shortlist_dists, shortlist = index.search(search_embeddings, cfg['num_matches'] + 1, rerank=False)
+            _, shortlist = exclude_ids(shortlist_dists, shortlist, search_ids, min(cfg['num_matches'],
+                                                                                   shortlist.shape[1]))
+        else:
+            _, shortlist = index.search(search_embeddings, cfg['num_matches'], rerank=False)
+        report['recall_without_rerank'] = compare_matches(exact, shortlist)['recall_at_k']
+        # the shared columns only differ if re-ranking found a different candidate at that rank
+        same = exact == approx
+        report['max_distance_error'] = float(np.abs(exact_distances - approx_distances)[same].max()) if same.any() \
+            else 0.0
+        report['memory_mb'] = index.memory_bytes() / (1024 * 1024)
+        report['float32_memory_mb'] = len(index) * index.dim * 4 / (1024 * 1024)
+        print("Without re-ranking the recall is", round(report['recall_without_rerank'], 4), "- the index holds",
+              round(report['memory_mb'], 2), "MB instead of", round(report['float32_memory_mb'], 2),
+              "MB of float32 embeddings (" + str(round(report['float32_memory_mb'] / max(report['memory_mb'], 1e-9),
+                                                       1)) + "x smaller)")
+    return report
+
+
+def compare_matches(exact, approx):
+    """
+    :param exact: 2D array of the exact matches' candidate indices
+    :param approx: 2D array of another search's candidate indices
+    :return: a dictionary with the recall at k and the rate at which the top match agrees
+    """
+    found = 0
+    top_agree = 0
+    for exact_row, approx_row in zip(exact, approx):
+        found += len(set(exact_row.tolist()) & set(approx_row.tolist()))
+        if len(exact_row) and len(approx_row) and exact_row[0] == approx_row[0]:
+            top_agree += 1
+    return {'recall_at_k': found / max(exact.size, 1), 'top1_agreement': top_agree / max(len(exact), 1)}
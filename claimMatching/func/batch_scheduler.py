@@ -0,0 +1,200 @@
+"""
+This file contains an asyncio micro-batching scheduler for online
+claim matching. Concurrent match requests are queued and merged into
+dynamic batches bounded by a maximum number of texts and a maximum
+wait, so the encoder works on full batches instead of single tweets.
+Each batch's results are scattered back to the requests it contains.
+"""
+import asyncio, threading, time
+
+
+class MicroBatcher:
+    """
+    Merges concurrent requests into batches for a batch processing function. The scheduler runs its own event
+    loop in a background thread, so it can be used from both threaded and asyncio callers. Close the scheduler,
+    or use it as a context manager, to stop the loop and its thread.
+    """
+
+    def __init__(self, process_fn, max_batch_size=64, max_wait_ms=5):
+        """
+        :param process_fn: function mapping a list of texts and k to a list with each text's results
+        :param max_batch_size: maximum number of texts in a batch
+        :param max_wait_ms: maximum time the first request of a batch waits for others to join it
+        """
+        self.process_fn = process_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.loop = None
+        self.thread = None
+        self.task = None
+        self.queue = None
+        # a request that did not fit in the previous batch, which starts the next one
+        self.carried = None
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_texts = 0
+        self.max_queue_depth = 0
+        self.total_wait = 0.0
+        self.batch_sizes = {}
+
+    def start(self):
+        """
+        Starts the scheduler's event loop in a daemon thread.
+
+        :return: the started scheduler
+        """
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.setup(), self.loop).result()
+        return self
+
+    async def setup(self):
+        self.queue = asyncio.Queue()
+        self.task = self.loop.create_task(self.run())
+
+    def close(self):
+        """
+        Cancels the batch loop and any pending requests, then stops the event loop and joins its thread.
+
+        :return: none
+        """
+        if self.loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.cancel_tasks(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
+
+    async def cancel_tasks(self):
+        """
+        Cancels every other task on the scheduler's loop and waits for them to finish, so none is left pending
+        when the loop stops.
+
+        :return: none
+        """
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def __enter__(self):
+        return self if self.loop is not None else self.start()
+
+    def __exit__(self, *args):
+        self.close()
+
+    async def submit(self, texts, k):
+        """
+        Queues a request and waits for its batch to be processed. Must be awaited on the scheduler's loop. Requests
+        with more than max_batch_size texts are split into parts that are queued separately.
+
+        :param texts: list of string documents
+        :param k: number of results per text
+        :return: a list with each text's results
+        """
+        futures = []
+        for start in range(0, len(texts), self.max_batch_size):
+            future = self.loop.create_future()
+            await self.queue.put((texts[start:start + self.max_batch_size], k, future, time.perf_counter()))
+            futures.append(future)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        parts = await asyncio.gather(*futures)
+        return [result for part in parts for result in part]
+
+    def match(self, texts, k):
+        """
+        Queues a request from another thread and blocks until its results are ready.
+
+        :param texts: list of string documents
+        :param k: number of results per text
+        :return: a list with each text's results
+        """
+        return asyncio.run_coroutine_threadsafe(self.submit(texts, k), self.loop).result()
+
+    async def next_batch(self):
+        """
+        Waits for a request, then gathers further requests until the batch is full or the first request has
+        waited max_wait. A request that would overflow the batch is carried over to the next one.
+
+        :return: list of queued requests
+        """
+        if self.carried:
+            batch, self.carried = [self.carried], None
+        else:
+            batch = [await self.queue.get()]
+        num_texts = len(batch[0][0])
+        deadline = self.loop.time() + self.max_wait
+        while num_texts < self.max_batch_size:
+            if self.queue.empty():
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                request = self.queue.get_nowait()
+            if num_texts + len(request[0]) > self.max_batch_size:
+                self.carried = request
+                break
+            batch.append(request)
+            num_texts += len(request[0])
+        return batch
+
+    async def run(self):
+        """
+        Processes batches one at a time. Requests arriving while a batch is processed form the next batch.
+
+        :return: none
+        """
+        while True:
+            batch = await self.next_batch()
+            texts = [text for request in batch for text in request[0]]
+            k = max(request[1] for request in batch)
+            started = time.perf_counter()
+            self.record_batch(batch, len(texts), started)
+            try:
+                results = await self.loop.run_in_executor(None, self.process_fn, texts, k)
+                if len(results) != len(texts):
+                    raise RuntimeError("Batch returned " + str(len(results)) + " results for " + str(len(texts))
+                                       + " texts")
+            except Exception as e:
+                # every request of the batch fails with the error, so each handler can answer its client
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            start = 0
+            for request_texts, request_k, future, _ in batch:
+                request_results = [result[:request_k] for result in results[start:start + len(request_texts)]]
+                start += len(request_texts)
+                if not future.done():
+                    future.set_result(request_results)
+
+    def record_batch(self, batch, num_texts, started):
+        """
+        Updates the scheduler's metrics for a batch that is about to be processed.
+
+        :param batch: list of queued requests
+        :param num_texts: number of texts in the batch
+        :param started: time the batch started processing
+        :return: none
+        """
+        self.num_batches += 1
+        self.num_requests += len(batch)
+        self.num_texts += num_texts
+        self.total_wait += sum(started - queued_at for _, _, _, queued_at in batch)
+        self.batch_sizes[num_texts] = self.batch_sizes.get(num_texts, 0) + 1
+
+    def metrics(self):
+        """
+        :return: a dictionary with the current queue depth and batch statistics
+        """
+        return {'queue_depth': self.queue.qsize() if self.queue else 0, 'max_queue_depth': self.max_queue_depth,
+                'num_requests': self.num_requests, 'num_batches': self.num_batches,
+                'mean_batch_size': self.num_texts / max(self.num_batches, 1),
+                'mean_queue_wait_ms': 1000 * self.total_wait / max(self.num_requests, 1),
+                'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())}}
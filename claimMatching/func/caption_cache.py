@@ -0,0 +1,117 @@
+"""
+This file contains a persistent SQLite cache of media captions so that
+images shared across tweets and runs are only downloaded and OCR'd once.
+Captions are addressed both by media url and by a hash of the image
+bytes, and are tied to the version of the OCR engine that produced them.
+"""
+import hashlib, os, sqlite3
+
+import pytesseract
+
+DEFAULT_CACHE_PATH = 'data/caption_cache.sqlite'
+_engine_version = []
+
+
+def get_engine_version():
+    """
+    Helper function that returns the version of the OCR engine, which is looked up once per process.
+
+    :return: version string of the captioning engine
+    """
+    if not _engine_version:
+        try:
+            _engine_version.append('tesseract-' + str(pytesseract.get_tesseract_version()))
+        except (OSError, pytesseract.TesseractNotFoundError):
+            _engine_version.append('tesseract-unknown')
+    return _engine_version[0]
+
+
+def hash_image(image_bytes):
+    """
+    :param image_bytes: raw bytes of an image
+    :return: hex sha1 digest of the image
+    """
+    return hashlib.sha1(image_bytes).hexdigest()
+
+
+class CaptionCache:
+    """
+    SQLite store mapping media urls to image hashes and image hashes to captions.
+    """
+
+    def __init__(self, cfg):
+        self.path = cfg.get('caption_cache_path', DEFAULT_CACHE_PATH)
+        self.engine = get_engine_version()
+        self.url_hits = 0
+        self.hash_hits = 0
+        self.misses = 0
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("create table if not exists urls (url text primary key, image_hash text not null)")
+        self.conn.execute("create table if not exists captions (image_hash text not null, engine text not null, "
+                          "caption text not null, primary key (image_hash, engine))")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_by_urls(self, urls):
+        """
+        Looks up the captions of images that were already captioned under the same url.
+
+        :param urls: list of unique media urls
+        :return: a dictionary mapping each cached url to its caption
+        """
+        found = {}
+        for start in range(0, len(urls), 500):
+            batch = urls[start:start + 500]
+            rows = self.conn.execute("select urls.url, captions.caption from urls join captions on "
+                                     "urls.image_hash = captions.image_hash where captions.engine = ? and urls.url in ("
+                                     + ",".join("?" * len(batch)) + ")", [self.engine] + batch)
+            found.update(rows.fetchall())
+        self.url_hits += len(found)
+        return found
+
+    def get_by_hashes(self, image_hashes):
+        """
+        Looks up the captions of images whose bytes were already captioned, possibly under another url.
+
+        :param image_hashes: list of unique image hashes
+        :return: a dictionary mapping each cached image hash to its caption
+        """
+        found = {}
+        for start in range(0, len(image_hashes), 500):
+            batch = image_hashes[start:start + 500]
+            rows = self.conn.execute("select image_hash, caption from captions where engine = ? and image_hash in ("
+                                     + ",".join("?" * len(batch)) + ")", [self.engine] + batch)
+            found.update(rows.fetchall())
+        self.hash_hits += len(found)
+        self.misses += len(set(image_hashes)) - len(found)
+        return found
+
+    def put(self, url_hashes, hash_captions):
+        """
+        Stores new url to image hash mappings and new captions.
+
+        :param url_hashes: dictionary mapping media urls to image hashes
+        :param hash_captions: dictionary mapping image hashes to captions
+        :return: none
+        """
+        self.conn.executemany("insert or replace into urls (url, image_hash) values (?, ?)", url_hashes.items())
+        self.conn.executemany("insert or replace into captions (image_hash, engine, caption) values (?, ?, ?)",
+                              [(image_hash, self.engine, caption) for image_hash, caption in hash_captions.items()])
+        self.conn.commit()
+
+    def stats(self):
+        """
+        :return: a dictionary with this session's url hits, image hash hits and misses
+        """
+        return {'url_hits': self.url_hits, 'hash_hits': self.hash_hits, 'misses': self.misses}
@@ -0,0 +1,214 @@
+"""
+This file contains the merged claim store. Google FactCheck, NewsGuard
+and miscellaneous JSON claims are ingested once into a single SQLite
+file, where records from overlapping files and sources are merged by
+their id within a source and by normalized text. The matcher then
+reads one deduplicated corpus instead of parsing every source JSON
+file.
+"""
+import json, os, sqlite3, sys
+
+from func.embedding_cache import normalize_text
+
+DEFAULT_STORE_PATH = 'data/claim_store.sqlite'
+STORE_SOURCES = ['google', 'ng', 'misc_json']
+TEXT_FIELDS = {'google': 'text', 'ng': 'description', 'misc_json': 'content'}
+FORMAT_VERSION = 3
+
+
+def get_source_files(source, cfg):
+    """
+    Lists the JSON files of a claim source, along with the language of each file.
+
+    :param source: name of the claim source
+    :param cfg: configuration dictionary
+    :return: a list of (path, language) tuples, language is None for sources without languages
+    """
+    files = []
+    if source == 'google':
+        for language in cfg['languages']:
+            language_dir = os.path.join(cfg['google_dir'], language)
+            if os.path.isdir(language_dir):
+                files.extend((os.path.join(language_dir, file), language) for file in sorted(os.listdir(language_dir))
+                             if file.endswith('.json'))
+    else:
+        source_dir = cfg['ng_dir'] if source == 'ng' else cfg['json_dir']
+        if os.path.isdir(source_dir):
+            files.extend((os.path.join(source_dir, file), None) for file in sorted(os.listdir(source_dir))
+                         if file.endswith('.json'))
+    return files
+
+
+def fingerprint_sources(source, cfg):
+    """
+    :param source: name of the claim source
+    :param cfg: configuration dictionary
+    :return: a list of the path, language, size and modification time of each of the source's JSON files
+    """
+    fingerprint = []
+    for path, language in get_source_files(source, cfg):
+        stat = os.stat(path)
+        fingerprint.append([path, language, stat.st_size, stat.st_mtime])
+    return fingerprint
+
+
+def get_claim_url(record):
+    """
+    Finds the url of the article reviewing a claim, if it has one.
+
+    :param record: claim dictionary from any source
+    :return: the review's url or None
+    """
+    reviews = record.get('claimReview')
+    if reviews and reviews[0].get('url'):
+        return reviews[0].get('url')
+    for field in ['url', 'link']:
+        value = record.get(field)
+        if isinstance(value, str) and value.startswith(('http://', 'https://')):
+            return value
+    return None
+
+
+def get_claim_key(record, source):
+    """
+    Finds the key under which records of the same claim are merged before comparing their texts. Ids are only
+    meaningful within their own source, and review urls are not keys since one article often reviews several
+    distinct claims.
+
+    :param record: claim dictionary from any source
+    :param source: name of the claim source
+    :return: the claim's id prefixed with its source, or None
+    """
+    if record.get('id') is not None and record.get('id') != '':
+        return source + ':' + str(record.get('id'))
+    return None
+
+
+def get_text_key(text):
+    """
+    :param text: claim text
+    :return: the key under which texts that differ only by case and whitespace are merged
+    """
+    return normalize_text(text).lower()
+
+
+def get_store_path(cfg):
+    """
+    :param cfg: configuration dictionary
+    :return: path of the claim store
+    """
+    return cfg.get('claim_store_path', DEFAULT_STORE_PATH)
+
+
+def fingerprint_store_sources(cfg):
+    """
+    :param cfg: configuration dictionary
+    :return: the format version and the fingerprint of every source file the claim store is built from
+    """
+    return {'version': FORMAT_VERSION, 'sources': {source: fingerprint_sources(source, cfg)
+                                                   for source in STORE_SOURCES}}
+
+
+def is_stale(cfg):
+    """
+    Checks whether any source file was added, changed or deleted since the claim store was built.
+
+    :param cfg: configuration dictionary
+    :return: whether or not the store is missing or was built from different source files
+    """
+    store_path = get_store_path(cfg)
+    if not os.path.isfile(store_path):
+        return True
+    conn = sqlite3.connect(store_path)
+    try:
+        row = conn.execute("select value from meta where key = 'fingerprint'").fetchone()
+    except sqlite3.DatabaseError:
+        row = None
+    finally:
+        conn.close()
+    return row is None or json.loads(row[0]) != fingerprint_store_sources(cfg)
+
+
+def build_claim_store(cfg):
+    """
+    Ingests every claim source into a new claim store, merging records that share an id within their source or a
+    normalized text.
+
+    :param cfg: configuration dictionary
+    :return: none
+    """
+    store_path = get_store_path(cfg)
+    store_dir = os.path.dirname(store_path)
+    if store_dir:
+        os.makedirs(store_dir, exist_ok=True)
+    tmp_path = store_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    # the files are fingerprinted before they are read, so a file changed during the build leaves the store stale
+    fingerprint = fingerprint_store_sources(cfg)
+    conn = sqlite3.connect(tmp_path)
+    conn.execute("create table meta (key text primary key, value text not null)")
+    conn.execute("create table claims (id integer primary key, text_key text unique not null, url text, "
+                 "text text not null)")
+    conn.execute("create index claims_url on claims (url)")
+    conn.execute("create table memberships (claim_id integer not null, source text not null, language text, "
+                 "unique (claim_id, source, language))")
+    conn.execute("create index memberships_source on memberships (source, language)")
+
+    claim_key_ids = {}
+    text_key_ids = {}
+    num_records = 0
+    for source in STORE_SOURCES:
+        for path, language in get_source_files(source, cfg):
+            with open(path) as f:
+                records = json.load(f) or []
+            for record in records:
+                text = record.get(TEXT_FIELDS[source])
+                if not text:
+                    continue
+                num_records += 1
+                claim_key = get_claim_key(record, source)
+                text_key = get_text_key(text)
+                claim_id = claim_key_ids.get(claim_key) if claim_key else None
+                if claim_id is None:
+                    claim_id = text_key_ids.get(text_key)
+                if claim_id is None:
+                    claim_id = conn.execute("insert into claims (text_key, url, text) values (?, ?, ?)",
+                                            (text_key, get_claim_url(record), text)).lastrowid
+                    text_key_ids[text_key] = claim_id
+                if claim_key and claim_key not in claim_key_ids:
+                    claim_key_ids[claim_key] = claim_id
+                conn.execute("insert or ignore into memberships (claim_id, source, language) values (?, ?, ?)",
+                             (claim_id, source, language))
+    conn.execute("insert into meta (key, value) values ('fingerprint', ?)", (json.dumps(fingerprint),))
+    conn.commit()
+    num_claims = conn.execute("select count(*) from claims").fetchone()[0]
+    conn.close()
+    os.replace(tmp_path, store_path)
+    print("Built claim store at", store_path, "with", num_claims, "claims merged from", num_records, "records.")
+
+
+def load_claims(source, cfg):
+    """
+    Loads the deduplicated claim texts of a source from the claim store, rebuilding the store first if its
+    sources changed.
+
+    :param source: name of the claim source
+    :param cfg: configuration dictionary
+    :return: list of claim texts in ingestion order, exits if the source has no claims
+    """
+    if is_stale(cfg):
+        build_claim_store(cfg)
+    conn = sqlite3.connect(get_store_path(cfg))
+    query = ("select distinct claims.id, claims.text from claims join memberships on claims.id = "
+             "memberships.claim_id where memberships.source = ?")
+    params = [source]
+    if source == 'google':
+        query += " and memberships.language in (" + ",".join("?" * len(cfg['languages'])) + ")"
+        params.extend(cfg['languages'])
+    texts = [text for _, text in conn.execute(query + " order by claims.id", params)]
+    conn.close()
+    if len(texts) == 0:
+        print("No", source, "claims found, please fetch or set up the data before continuing per the README.")
+        sys.exit(1)
+    return texts
@@ -0,0 +1,214 @@
+"""
+This file contains the compiled corpus format for claim sources. The
+texts of a source's JSON files are converted once into a UTF-8 blob,
+an array of byte offsets into it and a small metadata table, which
+are memory-mapped on load. Texts are only decoded when a document is
+accessed, so a run holds neither the parsed JSON records nor a list
+of every text.
+"""
+import copy, hashlib, json, os, shutil, sys, tempfile
+
+import numpy as np
+
+from func.claim_store import STORE_SOURCES, TEXT_FIELDS, fingerprint_sources
+
+DEFAULT_CORPUS_DIR = 'data/corpus/'
+CORPUS_SOURCES = STORE_SOURCES
+FORMAT_VERSION = 1
+# number of documents decoded from one contiguous read when iterating over a corpus
+ITER_BLOCK = 4096
+ROW_DTYPE = np.dtype([('file', np.int32), ('language', np.int16)])
+
+
+def get_corpus_dir(source, cfg):
+    """
+    :param source: name of the claim source
+    :param cfg: configuration dictionary
+    :return: directory of the source's compiled corpus
+    """
+    return os.path.join(cfg.get('corpus_dir', DEFAULT_CORPUS_DIR), source)
+
+
+def read_meta(corpus_dir):
+    """
+    :param corpus_dir: directory of a compiled corpus
+    :return: the corpus' metadata, or None if it was never completely written
+    """
+    meta_path = os.path.join(corpus_dir, 'meta.json')
+    if not os.path.isfile(meta_path):
+        return None
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def is_stale(source, cfg):
+    """
+    :param source: name of the claim source
+    :param cfg: configuration dictionary
+    :return: whether or not the compiled corpus is missing or was compiled from different source files
+    """
+    meta = read_meta(get_corpus_dir(source, cfg))
+    return meta is None or meta.get('version') != FORMAT_VERSION or \
+        meta.get('sources') != fingerprint_sources(source, cfg)
+
+
+def convert_source(source, cfg):
+    """
+    Compiles the texts of a claim source's JSON files into a corpus. Records without text are skipped.
+
+    :param source: name of the claim source
+    :param cfg: configuration dictionary
+    :return: none
+    """
+    corpus_dir = get_corpus_dir(source, cfg).rstrip(os.sep)
+    parent_dir = os.path.dirname(corpus_dir) or '.'
+    os.makedirs(parent_dir, exist_ok=True)
+    # every conversion writes to its own directory, so processes converting the same source at once do not clash
+    tmp_dir = tempfile.mkdtemp(prefix=source + '.', suffix='.tmp', dir=parent_dir)
+    fingerprint = fingerprint_sources(source, cfg)
+    languages = sorted(set(language for _, language, _, _ in fingerprint if language is not None))
+    language_ids = {language: index for index, language in enumerate(languages)}
+
+    offsets = [0]
+    rows = []
+    unique = []
+    seen = set()
+    with open(os.path.join(tmp_dir, 'texts.bin'), 'wb') as blob:
+        for file_id, (path, language, _, _) in enumerate(fingerprint):
+            with open(path) as f:
+                records = json.load(f) or []
+            for record in records:
+                text = record.get(TEXT_FIELDS[source])
+                if not text:
+                    continue
+                encoded = text.encode('utf-8')
+                # the first occurrence of each exact text is kept when duplicates are pruned
+                key = hashlib.blake2b(encoded, digest_size=16).digest()
+                if key not in seen:
+                    seen.add(key)
+                    unique.append(len(rows))
+                blob.write(encoded)
+                offsets.append(offsets[-1] + len(encoded))
+                rows.append((file_id, language_ids.get(language, -1)))
+            del records
+    np.save(os.path.join(tmp_dir, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(tmp_dir, 'rows.npy'), np.array(rows, dtype=ROW_DTYPE))
+    np.save(os.path.join(tmp_dir, 'unique.npy'), np.array(unique, dtype=np.int64))
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump({'version': FORMAT_VERSION, 'source': source, 'size': len(rows), 'unique': len(unique),
+                   'bytes': offsets[-1], 'languages': languages, 'sources': fingerprint}, f)
+
+    # the old corpus is moved aside before the new one takes its place; processes that mapped it keep their copy
+    if os.path.exists(corpus_dir):
+        old_dir = tempfile.mkdtemp(prefix=source + '.', suffix='.old', dir=parent_dir)
+        try:
+            os.replace(corpus_dir, old_dir)
+        except FileNotFoundError:
+            # another conversion moved it aside first
+            pass
+        shutil.rmtree(old_dir)
+    try:
+        os.replace(tmp_dir, corpus_dir)
+    except OSError:
+        # another conversion of the same source files finished first and its corpus is kept
+        shutil.rmtree(tmp_dir)
+    print("Compiled", source, "corpus at", corpus_dir, "with", len(rows), "documents (" + str(len(unique)),
+          "unique) in", offsets[-1], "bytes.")
+
+
+def load_corpus(source, cfg):
+    """
+    Memory-maps the compiled corpus of a claim source, converting its JSON files first if they changed.
+
+    :param source: name of the claim source
+    :param cfg: configuration dictionary
+    :return: a Corpus of the source's texts, exits if the source has no claims
+    """
+    if is_stale(source, cfg):
+        convert_source(source, cfg)
+    corpus = Corpus(get_corpus_dir(source, cfg))
+    if len(corpus) == 0:
+        print("No", source, "claims found, please fetch or set up the data before continuing per the README.")
+        sys.exit(1)
+    return corpus
+
+
+class Corpus:
+    """
+    Read-only sequence of the texts of a compiled corpus, decoded on access. A corpus can be a view of some of
+    the rows of another, such as its unique texts.
+    """
+
+    def __init__(self, corpus_dir):
+        """
+        :param corpus_dir: directory of a compiled corpus
+        """
+        self.corpus_dir = corpus_dir
+        self.meta = read_meta(corpus_dir)
+        # every file is mapped up front, so a recompiled corpus replacing this one cannot mix into its views
+        self.offsets = np.load(os.path.join(corpus_dir, 'offsets.npy'), mmap_mode='r')
+        self.table = np.load(os.path.join(corpus_dir, 'rows.npy'), mmap_mode='r')
+        self.unique = np.load(os.path.join(corpus_dir, 'unique.npy'), mmap_mode='r')
+        blob_path = os.path.join(corpus_dir, 'texts.bin')
+        # an empty file cannot be memory-mapped
+        self.blob = np.memmap(blob_path, dtype=np.uint8, mode='r') if os.path.getsize(blob_path) \
+            else np.empty(0, dtype=np.uint8)
+        self.rows = None
+
+    def __len__(self):
+        return len(self.rows) if self.rows is not None else len(self.offsets) - 1
+
+    def text(self, index):
+        """
+        :param index: position of the document in this corpus
+        :return: the document's text
+        """
+        row = self.rows[index] if self.rows is not None else index
+        return self.blob[self.offsets[row]:self.offsets[row + 1]].tobytes().decode('utf-8')
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self.text(index) for index in range(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("corpus index out of range")
+        return self.text(key)
+
+    def __iter__(self):
+        if self.rows is not None:
+            for index in range(len(self)):
+                yield self.text(index)
+            return
+        for start in range(0, len(self), ITER_BLOCK):
+            offsets = np.asarray(self.offsets[start:start + ITER_BLOCK + 1])
+            block = self.blob[offsets[0]:offsets[-1]].tobytes()
+            local = (offsets - offsets[0]).tolist()
+            for begin, end in zip(local[:-1], local[1:]):
+                yield block[begin:end].decode('utf-8')
+
+    def view(self, rows):
+        """
+        :param rows: array of the rows of the compiled corpus the view holds
+        :return: a corpus of some of this corpus' rows, sharing its memory maps
+        """
+        corpus = copy.copy(self)
+        corpus.rows = rows
+        return corpus
+
+    def unique_texts(self):
+        """
+        :return: a view of the corpus holding the first occurrence of each distinct text, in corpus order
+        """
+        if self.rows is not None:
+            raise ValueError("unique_texts is only available on a whole corpus")
+        return self.view(self.unique)
+
+    def languages(self):
+        """
+        :return: a list with the language of every document, None for sources without languages
+        """
+        table = self.table['language']
+        if self.rows is not None:
+            table = table[self.rows]
+        return [self.meta['languages'][language] if language >= 0 else None for language in table.tolist()]
@@ -0,0 +1,285 @@
+"""
+This file contains a persistent, content-addressed store for SBERT
+embeddings so that documents which were already encoded by a model
+in a previous run are read from disk instead of being re-encoded.
+"""
+import hashlib, json, os, re, shutil, time, unicodedata
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = 'data/embedding_cache/'
+DEFAULT_MAX_MB = 2048
+KEY_DTYPE = 'S40'
+# lock files of the cache directories this process holds, which later caches of the same model reuse
+_held_locks = {}
+
+
+def normalize_text(text):
+    """
+    Normalizes a document so that trivially different copies of the same text share a cache entry.
+
+    :param text: string document
+    :return: the NFC-normalized document with collapsed whitespace
+    """
+    return ' '.join(unicodedata.normalize('NFC', str(text)).split())
+
+
+def hash_text(text):
+    """
+    Computes the content address of a document.
+
+    :param text: string document
+    :return: the hex sha1 digest of the normalized document as bytes
+    """
+    return hashlib.sha1(normalize_text(text).encode('utf-8')).hexdigest().encode('ascii')
+
+
+def get_model_dir(model_name, cfg):
+    """
+    Returns the directory that holds the cached embeddings for a single model.
+
+    :param model_name: name of the SBERT weights used to encode documents
+    :param cfg: configuration dictionary
+    :return: path of the model's cache directory
+    """
+    safe_name = re.sub(r'[^A-Za-z0-9_.-]', '_', model_name)
+    return os.path.join(cfg.get('embedding_cache_dir', DEFAULT_CACHE_DIR), safe_name)
+
+
+def lock_directory(directory):
+    """
+    Takes an exclusive lock on a model's cache directory, held until the process exits.
+
+    :param directory: path of the model's cache directory
+    :return: the open lock file, None if another process holds the lock, or True where file locks are unavailable
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return True
+    directory = os.path.abspath(directory)
+    if directory not in _held_locks:
+        os.makedirs(directory, exist_ok=True)
+        lock_file = open(os.path.join(directory, 'lock'), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+        _held_locks[directory] = lock_file
+    return _held_locks[directory]
+
+
+class EmbeddingCache:
+    """
+    On-disk embedding store for one model. Vectors live in a flat float32 file that is memory-mapped on read,
+    and the index maps each document hash to its row along with the last time the row was used. Only one process
+    at a time uses a model's cache: others encode every document without it.
+    """
+
+    def __init__(self, model_name, cfg):
+        self.model_name = model_name
+        self.directory = get_model_dir(model_name, cfg)
+        self.max_bytes = cfg.get('embedding_cache_max_mb', DEFAULT_MAX_MB) * 1024 * 1024
+        self.vector_file = os.path.join(self.directory, 'vectors.f32')
+        self.keys_file = os.path.join(self.directory, 'keys.npy')
+        self.access_file = os.path.join(self.directory, 'access.npy')
+        self.meta_file = os.path.join(self.directory, 'meta.json')
+        self.hits = 0
+        self.misses = 0
+        self.dim = None
+        self.keys = np.empty(0, dtype=KEY_DTYPE)
+        self.access = np.empty(0, dtype=np.float64)
+        self.lock = lock_directory(self.directory)
+        if self.lock is None:
+            print("The", model_name, "embedding cache is in use by another process, encoding without it.")
+        elif os.path.isfile(self.meta_file):
+            with open(self.meta_file) as f:
+                meta = json.load(f)
+            self.dim = meta.get('dim')
+            self.keys = np.load(self.keys_file)
+            self.access = np.load(self.access_file)
+            self.recover(meta.get('count', len(self.keys)))
+        self.rows = {key: row for row, key in enumerate(self.keys)}
+
+    def recover(self, count):
+        """
+        Brings the vector file back in line with the index after a run stopped between writing them. Vectors
+        appended after the index was last saved are cut off, and a vector file missing rows of the index, which
+        cannot be matched back to their keys, empties the cache.
+
+        :param count: number of rows recorded in the index
+        :return: none
+        """
+        expected = count * (self.dim or 0) * 4
+        if self.dim is None or count != len(self.keys) or count != len(self.access) or self.size_bytes() < expected:
+            print("The", self.model_name, "embedding cache index does not match its vectors, emptying it.")
+            self.dim = None
+            self.keys = np.empty(0, dtype=KEY_DTYPE)
+            self.access = np.empty(0, dtype=np.float64)
+            for path in [self.vector_file, self.keys_file, self.access_file, self.meta_file]:
+                if os.path.isfile(path):
+                    os.remove(path)
+        elif self.size_bytes() > expected:
+            with open(self.vector_file, 'r+b') as f:
+                f.truncate(expected)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def size_bytes(self):
+        """
+        :return: the size of the stored vectors in bytes
+        """
+        return os.path.getsize(self.vector_file) if os.path.isfile(self.vector_file) else 0
+
+    def vectors(self):
+        """
+        :return: a read-only memory map over every stored vector, or None if the cache is empty
+        """
+        if len(self.keys) == 0:
+            return None
+        return np.memmap(self.vector_file, dtype=np.float32, mode='r', shape=(len(self.keys), self.dim))
+
+    def encode(self, documents, encode_fn):
+        """
+        Returns embeddings for the documents, only sending documents that are not yet cached to the encoder.
+
+        :param documents: list of string documents
+        :param encode_fn: function that maps a list of documents to a 2D array of embeddings
+        :return: a float32 array of embeddings, one row per document
+        """
+        if self.lock is None:
+            return np.asarray(encode_fn(documents), dtype=np.float32)
+        hashes = [hash_text(doc) for doc in documents]
+        missing = {}
+        for doc, key in zip(documents, hashes):
+            if key not in self.rows and key not in missing:
+                missing[key] = doc
+        self.misses += len(missing)
+        self.hits += len(documents) - len(missing)
+        if missing:
+            print("Encoding", len(missing), "uncached documents of", len(documents), "with", self.model_name)
+            self._append(list(missing.keys()), np.asarray(encode_fn(list(missing.values())), dtype=np.float32))
+        if len(documents) == 0:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+
+        rows = np.array([self.rows[key] for key in hashes], dtype=np.int64)
+        self.access[rows] = time.time()
+        embeddings = np.array(self.vectors()[rows])
+        self._save_index()
+        self.evict()
+        return embeddings
+
+    def _append(self, keys, embeddings):
+        """
+        Appends new vectors to the vector file and registers them in the index. The index is saved right after,
+        and rows beyond the count it records are cut off on the next open.
+
+        :param keys: list of document hashes
+        :param embeddings: 2D float32 array of the documents' embeddings
+        :return: none
+        """
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+        elif embeddings.shape[1] != self.dim:
+            raise ValueError("Embedding dimension " + str(embeddings.shape[1]) + " does not match cached dimension "
+                             + str(self.dim) + " for model " + self.model_name)
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.vector_file, 'ab') as f:
+            f.write(np.ascontiguousarray(embeddings).tobytes())
+        start = len(self.keys)
+        self.keys = np.concatenate([self.keys, np.array(keys, dtype=KEY_DTYPE)])
+        self.access = np.concatenate([self.access, np.full(len(keys), time.time())])
+        for offset, key in enumerate(keys):
+            self.rows[key] = start + offset
+        self._save_index()
+
+    def _save_index(self):
+        """
+        Writes the index (hashes, access times and metadata) next to the vector file.
+
+        :return: none
+        """
+        if self.dim is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        np.save(self.keys_file, self.keys)
+        np.save(self.access_file, self.access)
+        with open(self.meta_file, 'w') as f:
+            json.dump({'model': self.model_name, 'dim': self.dim, 'count': len(self.keys)}, f)
+
+    def evict(self, max_bytes=None):
+        """
+        Drops the least recently used vectors until the store fits within the size limit, then compacts the
+        vector file.
+
+        :param max_bytes: size limit in bytes, defaults to the configured limit
+        :return: number of evicted vectors
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        if self.size_bytes() <= max_bytes or self.dim is None:
+            return 0
+        keep_count = int(max_bytes // (self.dim * 4))
+        keep = np.sort(np.argsort(-self.access, kind='stable')[:keep_count])
+        kept_vectors = np.array(self.vectors()[keep])
+        evicted = len(self.keys) - len(keep)
+        tmp_file = self.vector_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(kept_vectors.tobytes())
+        # the shorter vector file replaces the old one first, so a run stopped before the index is saved leaves
+        # an index with more rows than vectors, which is detected on open
+        os.replace(tmp_file, self.vector_file)
+        self.keys = self.keys[keep]
+        self.access = self.access[keep]
+        self.rows = {key: row for row, key in enumerate(self.keys)}
+        self._save_index()
+        print("Evicted", evicted, "embeddings from the", self.model_name, "cache")
+        return evicted
+
+    def stats(self):
+        """
+        :return: a dictionary summarizing the cache's contents and this session's hit rate
+        """
+        return {'model': self.model_name, 'directory': self.directory, 'entries': len(self.keys), 'dim': self.dim,
+                'size_mb': round(self.size_bytes() / (1024 * 1024), 2),
+                'max_mb': round(self.max_bytes / (1024 * 1024), 2), 'hits': self.hits, 'misses': self.misses}
+
+
+def inspect_cache(cfg):
+    """
+    Prints a summary of every model's embedding cache.
+
+    :param cfg: configuration dictionary
+    :return: none
+    """
+    cache_dir = cfg.get('embedding_cache_dir', DEFAULT_CACHE_DIR)
+    models = []
+    if os.path.exists(cache_dir):
+        for model_dir in sorted(os.listdir(cache_dir)):
+            meta_file = os.path.join(cache_dir, model_dir, 'meta.json')
+            if os.path.isfile(meta_file):
+                with open(meta_file) as f:
+                    models.append(json.load(f).get('model'))
+    if len(models) == 0:
+        print("Embedding cache at", cache_dir, "is empty.")
+    for model_name in models:
+        stats = EmbeddingCache(model_name, cfg).stats()
+        print(stats['model'] + ":", stats['entries'], "embeddings of dimension", stats['dim'], "using",
+              stats['size_mb'], "of", stats['max_mb'], "MB in", stats['directory'])
+
+
+def purge_cache(cfg, model_name=None):
+    """
+    Deletes the cached embeddings for one model, or for every model if none is given.
+
+    :param cfg: configuration dictionary
+    :param model_name: name of the model whose cache should be removed
+    :return: none
+    """
+    target = get_model_dir(model_name, cfg) if model_name else cfg.get('embedding_cache_dir', DEFAULT_CACHE_DIR)
+    if os.path.exists(target):
+        shutil.rmtree(target)
+        print("Purged embedding cache at", target)
+    else:
+        print("No embedding cache found at", target)
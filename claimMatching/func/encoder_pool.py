@@ -0,0 +1,184 @@
+"""
+This file contains the CPU encoding engine for the SBERT model.
+Documents are sorted by length and cut into batches of similar length,
+so little of each batch is padding, and the batches are spread across
+a pool of worker processes that each hold their own copy of the model
+with a capped number of torch threads.
+"""
+import json, multiprocessing, os, threading
+
+import numpy as np
+
+DEFAULT_BATCH_SIZE = 32
+# written next to the weights of a fine-tuned model
+MODEL_META = 'fine_tune.json'
+# number of model batches sent to a worker at a time
+BATCHES_PER_TASK = 4
+_worker_model = []
+
+
+def get_model_name(model_weights, cfg):
+    """
+    :param model_weights: name of the pre-trained weights
+    :param cfg: configuration dictionary
+    :return: the name identifying the encoder's embeddings, which differs for a quantized model and for every
+    training of a fine-tuned model
+    """
+    meta_path = os.path.join(model_weights, MODEL_META)
+    if os.path.isfile(meta_path):
+        with open(meta_path) as f:
+            model_weights = model_weights.rstrip(os.sep) + '-' + json.load(f)['version']
+    return model_weights + '-qint8' if cfg.get('quantize_model') else model_weights
+
+
+def get_num_threads(cfg):
+    """
+    :param cfg: configuration dictionary
+    :return: number of torch threads for each encoding process, or None to keep torch's default
+    """
+    workers = get_num_workers(cfg)
+    if cfg.get('encode_threads'):
+        return cfg.get('encode_threads')
+    if workers > 1:
+        return max(1, (os.cpu_count() or 1) // workers)
+    return None
+
+
+def get_num_workers(cfg):
+    """
+    :param cfg: configuration dictionary
+    :return: number of encoding processes
+    """
+    workers = cfg.get('encode_workers', 1)
+    return workers if workers is not None and workers > 0 else os.cpu_count() or 1
+
+
+def load_model(model_weights, cfg):
+    """
+    Loads the SBERT model for CPU inference, optionally with dynamically quantized int8 linear layers.
+
+    :param model_weights: name of the pre-trained weights
+    :param cfg: configuration dictionary
+    :return: the SentenceTransformer model
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    num_threads = get_num_threads(cfg)
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    model = SentenceTransformer(model_weights, device='cpu')
+    if cfg.get('quantize_model'):
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    model.eval()
+    return model
+
+
+def get_length_order(documents):
+    """
+    Orders documents by their approximate token length, so that consecutive documents form batches with little
+    padding.
+
+    :param documents: list of string documents
+    :return: an array of document indices from shortest to longest
+    """
+    lengths = np.array([len(str(document).split()) for document in documents])
+    return np.argsort(lengths, kind='stable')
+
+
+def init_worker(model_weights, cfg):
+    """
+    Loads a copy of the model in a worker process.
+
+    :param model_weights: name of the pre-trained weights
+    :param cfg: configuration dictionary
+    :return: none
+    """
+    _worker_model.append((load_model(model_weights, cfg), cfg.get('encode_batch_size', DEFAULT_BATCH_SIZE)))
+
+
+def encode_chunk(documents):
+    """
+    Encodes a chunk of length-sorted documents with the worker's model.
+
+    :param documents: list of string documents
+    :return: a 2D array of the documents' embeddings
+    """
+    model, batch_size = _worker_model[0]
+    return np.asarray(model.encode(documents, batch_size=batch_size, show_progress_bar=False))
+
+
+class EncoderPool:
+    """
+    Encodes documents in length-bucketed batches, in-process or across a pool of worker processes. The model
+    and the pool are only started on the first call to encode, once even when several threads encode at a time.
+    """
+
+    def __init__(self, model_weights, cfg):
+        self.model_weights = model_weights
+        self.cfg = cfg
+        self.workers = get_num_workers(cfg)
+        self.batch_size = cfg.get('encode_batch_size', DEFAULT_BATCH_SIZE)
+        self.model = None
+        self.pool = None
+        self.start_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_pool(self):
+        """
+        :return: the pool of encoding processes, started on first use
+        """
+        with self.start_lock:
+            if self.pool is None:
+                # torch does not survive being forked once its threads are running, so workers are spawned
+                context = multiprocessing.get_context('spawn')
+                self.pool = context.Pool(self.workers, initializer=init_worker,
+                                         initargs=(self.model_weights, self.cfg))
+            return self.pool
+
+    def get_model(self):
+        """
+        :return: the in-process model, loaded on first use
+        """
+        with self.start_lock:
+            if self.model is None:
+                self.model = load_model(self.model_weights, self.cfg)
+            return self.model
+
+    def encode(self, documents):
+        """
+        :param documents: list of string documents
+        :return: a 2D array with each document's embedding, in the order of the documents
+        """
+        if len(documents) == 0:
+            return np.empty((0, 0), dtype=np.float32)
+        order = get_length_order(documents)
+        sorted_docs = [documents[index] for index in order]
+        chunk_size = self.batch_size * BATCHES_PER_TASK
+        chunks = [sorted_docs[start:start + chunk_size] for start in range(0, len(sorted_docs), chunk_size)]
+        if self.workers > 1 and len(chunks) > 1:
+            encoded = self.get_pool().map(encode_chunk, chunks)
+        else:
+            model = self.get_model()
+            encoded = [np.asarray(model.encode(chunk, batch_size=self.batch_size, show_progress_bar=False))
+                       for chunk in chunks]
+        embeddings = np.empty((len(documents), encoded[0].shape[1]), dtype=encoded[0].dtype)
+        embeddings[order] = np.vstack(encoded)
+        return embeddings
+
+    def close(self):
+        """
+        Stops the worker processes, if any were started.
+
+        :return: none
+        """
+        with self.start_lock:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
@@ -1,33 +1,484 @@
 """
 Created on Fri Aug 28 14:08:16 2020
-This file allows for funetuning the weights provided by SBERT
-with Infodemic-specific data.
+This file allows for finetuning the weights provided by SBERT
+with Infodemic-specific data. Training pairs are taken from the claim
+matcher's own confident matches and from fact-checked claims and the
+titles of their reviews. Pairs are batched by length and tokenized in
+DataLoader worker processes, the model is trained on CPU with in-batch
+negatives and every epoch is checkpointed so a stopped run can resume.
 @author: brocklin
 """
+from datetime import datetime
+import glob, json, os, re, shutil, sys, time
+
+import numpy as np
+import orjson
+
+from func.embedding_cache import hash_text, normalize_text
+from func.encoder_pool import DEFAULT_BATCH_SIZE, MODEL_META
+from func.metrics import METRICS
+from func.similarity import top_matches
+
+DEFAULT_CHECKPOINT_DIR = 'data/fine_tune_checkpoint/'
+DEFAULT_SOURCES = ['matches', 'google']
+# number of batches whose pairs are sorted by length together, more gives less padding and less varied batches
+BUCKET_BATCHES = 50
+# held-out anchors are ranked against every held-out positive, the metrics are reported at this depth
+EVAL_K = 10
+# batched tokenization and the loss' features API need sentence-transformers 1.0, persistent workers torch 1.7
+MIN_SENTENCE_TRANSFORMERS_VERSION = (1, 0)
+MIN_TORCH_VERSION = (1, 7)
+
+
+def meets_version(version, minimum):
+    """
+    :param version: installed version string, such as 1.7.1+cpu
+    :param minimum: tuple of the lowest supported major and minor version
+    :return: whether or not the version is at least the minimum
+    """
+    numbers = re.match(r'(\d+)\.(\d+)', str(version))
+    return numbers is not None and tuple(int(number) for number in numbers.groups()) >= minimum
+
+
+def read_match_pairs(cfg):
+    """
+    Reads pairs of search documents and their confident matches from the JSONL outputs of previous runs.
+
+    :param cfg: configuration dictionary
+    :return: list of (search document, candidate document) pairs
+    """
+    max_distance = cfg.get('fine_tune_max_distance', 0.25)
+    max_rank = cfg.get('fine_tune_max_rank', 1)
+    pairs = []
+    for matches_path in sorted(glob.glob(os.path.join(cfg['output_dir'], '*.matches.jsonl'))):
+        candidates_path = matches_path[:-len('.matches.jsonl')] + '.candidates.jsonl'
+        if not os.path.isfile(candidates_path):
+            continue
+        with open(candidates_path, 'rb') as f:
+            candidates = {record['candidate_id']: record['text'] for record in map(orjson.loads, f)}
+        with open(matches_path, 'rb') as f:
+            for record in map(orjson.loads, f):
+                for match in record['matches']:
+                    if match['rank'] <= max_rank and match['distance'] <= max_distance:
+                        pairs.append((record['search_text'], candidates[match['candidate_id']]))
+    return pairs
+
+
+def read_claim_pairs(cfg):
+    """
+    Reads pairs of Google FactCheck claims and the titles of the articles reviewing them, which usually restate
+    the claim in other words.
+
+    :param cfg: configuration dictionary
+    :return: list of (claim, review title) pairs
+    """
+    pairs = []
+    for language in cfg['languages']:
+        for path in sorted(glob.glob(os.path.join(cfg['google_dir'], language, '*.json'))):
+            with open(path) as f:
+                claims = json.load(f) or []
+            for claim in claims:
+                if not claim.get('text'):
+                    continue
+                for review in claim.get('claimReview', []):
+                    if review.get('title'):
+                        pairs.append((claim['text'], review['title']))
+    return pairs
+
+
+def build_pairs(cfg):
+    """
+    Gathers the training pairs of every configured source. Pairs whose texts are the same once normalized, and
+    repeated pairs, are dropped.
+
+    :param cfg: configuration dictionary
+    :return: list of (anchor, positive) pairs
+    """
+    readers = {'matches': read_match_pairs, 'google': read_claim_pairs}
+    pairs = {}
+    for source in cfg.get('fine_tune_sources', DEFAULT_SOURCES):
+        if source not in readers:
+            print("Unknown fine-tuning source", source, "in config, please use any of", list(readers))
+            sys.exit(1)
+        source_pairs = readers[source](cfg)
+        print("Read", len(source_pairs), "training pairs from", source)
+        for anchor, positive in source_pairs:
+            key = (normalize_text(anchor), normalize_text(positive))
+            if key[0] != key[1]:
+                pairs.setdefault(key, (anchor, positive))
+    return list(pairs.values())
+
+
+def split_pairs(pairs, eval_fraction):
+    """
+    Holds out the pairs of a fraction of the anchors. Anchors are assigned by the hash of their text, so a pair
+    stays on the same side of the split as more training data is gathered.
+
+    :param pairs: list of (anchor, positive) pairs
+    :param eval_fraction: fraction of the anchors to hold out
+    :return: a list of training pairs and a list of held-out pairs
+    """
+    train, held_out = [], []
+    for pair in pairs:
+        position = int(hash_text(pair[0])[:8], 16) / 16 ** 8
+        (held_out if position < eval_fraction else train).append(pair)
+    return train, held_out
+
+
+class BucketBatchSampler:
+    """
+    Batches training pairs of similar length, so that little of each batch is padding. Each epoch the pairs are
+    shuffled, sorted by length within buckets of several batches, and the batches are shuffled again. Since every
+    pair's positive is a negative for the rest of its batch, a batch never holds the same text twice.
+    """
+
+    def __init__(self, pairs, batch_size, seed):
+        """
+        :param pairs: list of (anchor, positive) pairs
+        :param batch_size: maximum number of pairs per batch
+        :param seed: seed of the shuffles, combined with the epoch
+        """
+        self.pairs = pairs
+        self.batch_size = batch_size
+        self.seed = seed
+        self.lengths = np.array([len(anchor.split()) + len(positive.split()) for anchor, positive in pairs])
+        self.batches = []
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        """
+        Draws the batches of an epoch. The batches only depend on the seed and the epoch, so a resumed run sees
+        the same batches it would have seen.
+
+        :param epoch: index of the epoch
+        :return: none
+        """
+        rng = np.random.default_rng(self.seed + epoch)
+        order = rng.permutation(len(self.pairs))
+        bucket_size = self.batch_size * BUCKET_BATCHES
+        batches = []
+        for start in range(0, len(order), bucket_size):
+            bucket = order[start:start + bucket_size]
+            batches.extend(self.fill_batches(bucket[np.argsort(self.lengths[bucket], kind='stable')]))
+        self.batches = [batches[index] for index in rng.permutation(len(batches))]
+
+    def fill_batches(self, indices):
+        """
+        :param indices: array of pair indices, in the order they should be batched
+        :return: list of batches of pair indices, a pair sharing a text with a batch being moved to a later batch
+        """
+        batches = []
+        pending = indices.tolist()
+        while pending:
+            batch, texts, deferred = [], set(), []
+            for index in pending:
+                anchor, positive = self.pairs[index]
+                if len(batch) < self.batch_size and anchor not in texts and positive not in texts:
+                    batch.append(index)
+                    texts.update((anchor, positive))
+                else:
+                    deferred.append(index)
+            batches.append(batch)
+            pending = deferred
+        return batches
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class PairCollator:
+    """
+    Tokenizes a batch of pairs into the anchor and positive features of the model. It runs in the DataLoader
+    workers, so tokenization overlaps with training. Only the tokenizer is sent to the workers, not the model.
+    """
+
+    def __init__(self, tokenizer, max_seq_length):
+        """
+        :param tokenizer: the model's Hugging Face tokenizer
+        :param max_seq_length: number of tokens texts are truncated to
+        """
+        self.tokenizer = tokenizer
+        self.max_seq_length = max_seq_length
+
+    def tokenize(self, texts):
+        """
+        :param texts: list of string documents
+        :return: dictionary of the padded input tensors, as the model's own tokenize returns them
+        """
+        return self.tokenizer([text.strip() for text in texts], padding=True, truncation='longest_first',
+                              return_tensors='pt', max_length=self.max_seq_length)
+
+    def __call__(self, batch):
+        anchors, positives = zip(*batch)
+        return [self.tokenize(list(anchors)), self.tokenize(list(positives))]
+
+
+def init_loader_worker(worker_id):
+    """
+    Keeps each DataLoader worker to one torch thread, leaving the cores to the training process.
+
+    :param worker_id: index of the worker
+    :return: none
+    """
+    import torch
+    torch.set_num_threads(1)
+
+
+def get_loader_workers(cfg):
+    """
+    :param cfg: configuration dictionary
+    :return: number of DataLoader worker processes, 0 to tokenize in the training process
+    """
+    return max(0, cfg.get('fine_tune_workers', 2))
+
+
+def get_train_threads(cfg):
+    """
+    :param cfg: configuration dictionary
+    :return: number of torch threads for training
+    """
+    if cfg.get('fine_tune_threads'):
+        return cfg.get('fine_tune_threads')
+    return max(1, (os.cpu_count() or 1) - get_loader_workers(cfg))
+
+
+def get_schedule(warmup_steps, total_steps):
+    """
+    :param warmup_steps: number of steps over which the learning rate rises linearly to its configured value
+    :param total_steps: number of steps of the run, over the rest of which the learning rate decays linearly to 0
+    :return: a function mapping a step to its multiple of the configured learning rate
+    """
+    def schedule(step):
+        if step < warmup_steps:
+            return step / max(1, warmup_steps)
+        return max(0.0, (total_steps - step) / max(1, total_steps - warmup_steps))
+    return schedule
+
+
+def evaluate(model, pairs, cfg):
+    """
+    Ranks every held-out positive for each held-out anchor by cosine distance.
+
+    :param model: the SentenceTransformer model
+    :param pairs: list of held-out (anchor, positive) pairs
+    :param cfg: configuration dictionary
+    :return: dictionary of the recall at 1 and at EVAL_K and the mean reciprocal rank at EVAL_K, empty without
+    held-out pairs
+    """
+    if not pairs:
+        return {}
+    batch_size = cfg.get('encode_batch_size', DEFAULT_BATCH_SIZE)
+    positives = list(dict.fromkeys(positive for _, positive in pairs))
+    positions = {positive: index for index, positive in enumerate(positives)}
+    anchor_embeddings = model.encode([anchor for anchor, _ in pairs], batch_size=batch_size, show_progress_bar=False)
+    positive_embeddings = model.encode(positives, batch_size=batch_size, show_progress_bar=False)
+    _, indices = top_matches(anchor_embeddings, positive_embeddings, min(EVAL_K, len(positives)), cfg)
+    hits = indices == np.array([positions[positive] for _, positive in pairs]).reshape(-1, 1)
+    found = hits.any(axis=1)
+    reciprocal_ranks = np.where(found, 1.0 / (np.argmax(hits, axis=1) + 1), 0.0)
+    return {'recall_at_1': float(hits[:, 0].mean()), 'recall_at_' + str(EVAL_K): float(found.mean()),
+            'mrr_at_' + str(EVAL_K): float(reciprocal_ranks.mean())}
+
+
+def replace_dir(tmp_dir, target_dir):
+    """
+    Moves a completely written directory into place of another.
+
+    :param tmp_dir: directory holding the new contents
+    :param target_dir: directory to replace
+    :return: none
+    """
+    if os.path.exists(target_dir):
+        old_dir = target_dir.rstrip(os.sep) + '.old'
+        if os.path.exists(old_dir):
+            shutil.rmtree(old_dir)
+        os.replace(target_dir, old_dir)
+        shutil.rmtree(old_dir)
+    os.replace(tmp_dir, target_dir)
+
+
+def save_checkpoint(model, optimizer, scheduler, state, cfg):
+    """
+    Saves the model, the optimizer and learning rate schedule and the progress of the run.
+
+    :param model: the SentenceTransformer model
+    :param optimizer: the torch optimizer
+    :param scheduler: the learning rate scheduler
+    :param state: dictionary of the run's settings and progress
+    :param cfg: configuration dictionary
+    :return: none
+    """
+    import torch
+    checkpoint_dir = cfg.get('fine_tune_checkpoint_dir', DEFAULT_CHECKPOINT_DIR)
+    tmp_dir = checkpoint_dir.rstrip(os.sep) + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    model.save(os.path.join(tmp_dir, 'model'))
+    torch.save({'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict()},
+               os.path.join(tmp_dir, 'optimizer.pt'))
+    with open(os.path.join(tmp_dir, 'state.json'), 'w') as f:
+        json.dump(state, f, indent=2)
+    replace_dir(tmp_dir, checkpoint_dir)
+
+
+def load_checkpoint(settings, cfg):
+    """
+    :param settings: dictionary of the run's settings, which a checkpoint must have been made with to be resumed
+    :param cfg: configuration dictionary
+    :return: the checkpoint's state, or None if there is no checkpoint to resume
+    """
+    state_path = os.path.join(cfg.get('fine_tune_checkpoint_dir', DEFAULT_CHECKPOINT_DIR), 'state.json')
+    if not cfg.get('fine_tune_resume', True) or not os.path.isfile(state_path):
+        return None
+    with open(state_path) as f:
+        state = json.load(f)
+    if state['settings'] != settings:
+        print("The checkpoint was made with other training data or settings, starting over.")
+        return None
+    return state
+
+
+def save_model(model, state, cfg):
+    """
+    Saves the model to the model_output directory along with a record of its training, which gives every trained
+    model its own embedding cache and indices.
+
+    :param model: the SentenceTransformer model
+    :param state: dictionary of the run's settings and progress
+    :param cfg: configuration dictionary
+    :return: none
+    """
+    tmp_dir = cfg['model_output'].rstrip(os.sep) + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    model.save(tmp_dir)
+    with open(os.path.join(tmp_dir, MODEL_META), 'w') as f:
+        json.dump({'base_model': state['settings']['base_model'], 'epoch': state['epoch'],
+                   'eval': state['history'][-1]['eval'], 'version': datetime.now().strftime("%Y%m%d%H%M%S")}, f,
+                  indent=2)
+    replace_dir(tmp_dir, cfg['model_output'])
 
-from sentence_transformers import SentencesDataset, SentenceTransformer, losses
-from torch.utils.data import DataLoader
 
-# note: nothing in this file is finished, it simply outlines how we might begin finetuning
-# full example here: https://github.com/UKPLab/sentence-transformers/blob/master/examples/training/sts/training_stsbenchmark_continue_training.py
 def fine_tune(cfg):
     """
-    Function to finetune a model with Infodemic-specific data.
+    Function to finetune a model with Infodemic-specific data. The model with the best held-out mean reciprocal
+    rank is saved to model_output if it beats the pretrained model, or that of the last epoch without held-out
+    pairs.
 
     :param cfg: configuration dictionary
     :return: none
     """
-    model = SentenceTransformer(cfg['model'])
-    # data reading dependent on data format, see https://github.com/UKPLab/sentence-transformers/blob/master/examples/training/sts/training_stsbenchmark_continue_training.py
-    # for an example at lines 48-62
-    train_samples = None
-    train_ds = SentencesDataset(train_samples, model)
-    train_dl = DataLoader(train_ds)
-    train_loss = losses.SoftmaxLoss(model, num_labels=3)
-
-    evaluator = None # list of evaluators at https://github.com/UKPLab/sentence-transformers/tree/master/sentence_transformers/evaluation
-    model.fit(train_objectives=[(train_dl, train_loss)],
-              evaluator=evaluator,
-              epochs=30,
-              evaluation_steps=1000,
-              output_path=cfg['model_output'])
+    try:
+        import sentence_transformers, torch
+        from sentence_transformers import SentenceTransformer, losses
+        from torch.utils.data import DataLoader
+    except ImportError:
+        print("Fine-tuning requires torch 1.7 and sentence-transformers 1.0 or later, please install them.")
+        sys.exit(1)
+    if not meets_version(torch.__version__, MIN_TORCH_VERSION) or \
+            not meets_version(sentence_transformers.__version__, MIN_SENTENCE_TRANSFORMERS_VERSION):
+        print("Fine-tuning requires torch 1.7 and sentence-transformers 1.0 or later, found torch", torch.__version__,
+              "and sentence-transformers", sentence_transformers.__version__ + ", please upgrade them.")
+        sys.exit(1)
+
+    pairs = build_pairs(cfg)
+    train_pairs, eval_pairs = split_pairs(pairs, cfg.get('fine_tune_eval_fraction', 0.1))
+    if len(train_pairs) == 0:
+        print("No training pairs found, please write jsonl matches or fetch Google FactCheck API data first per "
+              "the README.")
+        sys.exit(1)
+    print("Training on", len(train_pairs), "pairs, holding out", len(eval_pairs))
+
+    epochs = cfg.get('fine_tune_epochs', 4)
+    batch_size = cfg.get('fine_tune_batch_size', 32)
+    workers = get_loader_workers(cfg)
+    settings = {'base_model': cfg['model'], 'num_train': len(train_pairs), 'num_eval': len(eval_pairs),
+                'epochs': epochs, 'batch_size': batch_size, 'learning_rate': cfg.get('fine_tune_learning_rate', 2e-5),
+                'seed': cfg.get('fine_tune_seed', 0)}
+    state = load_checkpoint(settings, cfg)
+    checkpoint_dir = cfg.get('fine_tune_checkpoint_dir', DEFAULT_CHECKPOINT_DIR)
+
+    torch.set_num_threads(get_train_threads(cfg))
+    torch.manual_seed(settings['seed'])
+    if workers:
+        # the tokenizers' own threads do not survive the fork into the loader workers
+        os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+    model = SentenceTransformer(os.path.join(checkpoint_dir, 'model') if state else cfg['model'], device='cpu')
+    sampler = BucketBatchSampler(train_pairs, batch_size, settings['seed'])
+    collator = PairCollator(model.tokenizer, model.max_seq_length)
+    loader = DataLoader(train_pairs, batch_sampler=sampler, collate_fn=collator, num_workers=workers,
+                        worker_init_fn=init_loader_worker if workers else None, persistent_workers=workers > 0)
+    train_loss = losses.MultipleNegativesRankingLoss(model)
+    optimizer = torch.optim.AdamW(train_loss.parameters(), lr=settings['learning_rate'], weight_decay=0.01)
+    total_steps = max(1, len(sampler) * epochs)
+    warmup_steps = int(total_steps * cfg.get('fine_tune_warmup', 0.1))
+    scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, get_schedule(warmup_steps, total_steps))
+
+    mrr_key = 'mrr_at_' + str(EVAL_K)
+    if state:
+        checkpoint = torch.load(os.path.join(checkpoint_dir, 'optimizer.pt'))
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        scheduler.load_state_dict(checkpoint['scheduler'])
+        print("Resuming from the checkpoint after epoch", state['epoch'], "of", epochs)
+    else:
+        with METRICS.stage('fine_tune_eval') as counts:
+            metrics = evaluate(model, eval_pairs, cfg)
+            counts['pairs'] = len(eval_pairs)
+        # the pretrained model is the one to beat, so an epoch that scores below it is never saved
+        state = {'settings': settings, 'epoch': 0, 'best': metrics.get(mrr_key), 'best_epoch': 0,
+                 'history': [{'epoch': 0, 'eval': metrics, 'seconds': 0.0}]}
+        print("Held-out metrics of", cfg['model'] + ":", metrics)
+
+    for epoch in range(state['epoch'] + 1, epochs + 1):
+        sampler.set_epoch(epoch)
+        train_loss.train()
+        started = time.time()
+        wait_seconds, total_loss, num_batches = 0.0, 0.0, 0
+        with METRICS.stage('fine_tune_epoch') as counts:
+            batches = iter(loader)
+            while True:
+                waited = time.time()
+                features = next(batches, None)
+                wait_seconds += time.time() - waited
+                if features is None:
+                    break
+                loss_value = train_loss(features, None)
+                loss_value.backward()
+                torch.nn.utils.clip_grad_norm_(train_loss.parameters(), 1.0)
+                optimizer.step()
+                scheduler.step()
+                optimizer.zero_grad()
+                total_loss += loss_value.item()
+                num_batches += 1
+            counts.update({'pairs': len(train_pairs), 'batches': num_batches})
+        train_seconds = time.time() - started
+
+        with METRICS.stage('fine_tune_eval') as counts:
+            metrics = evaluate(model, eval_pairs, cfg)
+            counts['pairs'] = len(eval_pairs)
+        state['epoch'] = epoch
+        state['history'].append({'epoch': epoch, 'eval': metrics, 'seconds': train_seconds,
+                                 'loss': total_loss / max(num_batches, 1)})
+        print("Epoch", epoch, "of", epochs, "trained in", round(train_seconds, 2), "seconds (" +
+              str(round(len(train_pairs) / max(train_seconds, 1e-9), 1)), "pairs per second,",
+              round(wait_seconds, 2), "seconds waiting on batches), loss", round(total_loss / max(num_batches, 1), 4),
+              "held-out metrics:", metrics)
+
+        if not metrics or state['best'] is None or metrics[mrr_key] > state['best']:
+            state['best'] = metrics.get(mrr_key)
+            state['best_epoch'] = epoch
+            save_model(model, state, cfg)
+            print("Saved the model of epoch", epoch, "to", cfg['model_output'])
+        save_checkpoint(model, optimizer, scheduler, state, cfg)
+
+    baseline = state['history'][0]['eval']
+    if state.get('best_epoch') == 0 and baseline:
+        print("No epoch beat the held-out", mrr_key, "of", cfg['model'], "(" + str(round(baseline[mrr_key], 4)) +
+              "), so no model was saved to", cfg['model_output'])
+        return
+    if baseline:
+        print("Held-out", mrr_key, "went from", round(baseline[mrr_key], 4), "to", round(state['best'], 4))
+    print("Set model to", cfg['model_output'], "in the config to match with the fine-tuned model.")
@@ -6,9 +6,16 @@ data, the data is written to a new file in the directory
 specified by DATA_DIR_NAME.
 @author: brocklin
 """
-import json, os, sys, time
+from concurrent.futures import ThreadPoolExecutor
+import json, os, random, sys, threading, time
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from func.claim_store import build_claim_store
+
+API_URL = "https://factchecktools.googleapis.com/v1alpha1/claims:search"
+RETRY_STATUSES = [429, 500, 502, 503, 504]
 
 def get_api_key(cfg):
     """
@@ -28,47 +35,225 @@ def get_api_key(cfg):
         print("Failed to find secret.json, please consult the README for proper instruction.")
         sys.exit(1)
 
+class FetchError(Exception):
+    """
+    Raised when a page cannot be fetched from the Fact Check API.
+    """
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket limiting the rate of API requests shared by every fetch worker.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent.
+
+        :return: none
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def get_session(cfg):
+    """
+    Creates an HTTP session with a connection pool shared by every fetch worker.
+
+    :param cfg: configuration dictionary
+    :return: a requests session
+    """
+    workers = cfg.get('fetch_workers', 4)
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=workers, pool_maxsize=workers))
+    session.mount('http://', HTTPAdapter(pool_connections=workers, pool_maxsize=workers))
+    return session
+
+
+def get_backoff(attempt, cfg, retry_after=None):
+    """
+    Computes how long to wait before retrying a request, using exponential backoff with full jitter.
+
+    :param attempt: number of failed attempts so far
+    :param cfg: configuration dictionary
+    :param retry_after: seconds the server asked to wait, if any
+    :return: seconds to wait
+    """
+    cap = cfg.get('fetch_backoff_max', 60)
+    delay = random.uniform(0, min(cap, cfg.get('fetch_backoff_base', 1) * 2 ** attempt))
+    if retry_after:
+        delay = max(delay, min(cap, retry_after))
+    return delay
+
+
+def request_page(session, bucket, params, cfg):
+    """
+    Fetches a single page of claims, retrying rate-limited and failed requests with backoff.
+
+    :param session: requests session
+    :param bucket: token bucket shared by every fetch worker
+    :param params: query parameters for the page
+    :param cfg: configuration dictionary
+    :return: the page's decoded JSON
+    """
+    url = cfg.get('fact_check_url', API_URL)
+    retries = cfg.get('fetch_retries', 8)
+    for attempt in range(retries + 1):
+        bucket.acquire()
+        retry_after = None
+        try:
+            response = session.get(url, params=params, timeout=cfg.get('fetch_timeout', 30))
+        except requests.RequestException as e:
+            error = str(e)
+        else:
+            if response.status_code == 200:
+                try:
+                    page = response.json()
+                except ValueError as e:
+                    page = "malformed JSON (" + str(e) + ")"
+                if isinstance(page, dict):
+                    return page
+                # a truncated or garbled body is retried like any other failed page
+                error = "status 200 with an unexpected body: " + str(page)[:500]
+            else:
+                error = "status " + str(response.status_code) + ": " + response.text[:500]
+                if response.status_code not in RETRY_STATUSES:
+                    raise FetchError(error)
+                header = response.headers.get('Retry-After')
+                retry_after = float(header) if header and header.isdigit() else None
+        if attempt < retries:
+            delay = get_backoff(attempt, cfg, retry_after)
+            print("Request for", params.get('query'), "in", params.get('languageCode'), "failed (" + error +
+                  "), retrying in", round(delay, 1), "seconds")
+            time.sleep(delay)
+    raise FetchError("gave up after " + str(retries + 1) + " attempts: " + error)
+
+
+def get_fetch_paths(keyword, language, cfg):
+    """
+    :param keyword: keyword being searched
+    :param language: language code being searched
+    :param cfg: configuration dictionary
+    :return: paths of the final claim file, the partially fetched claims and the page checkpoint
+    """
+    out_file = os.path.join(cfg['google_dir'], language, language + "_" + keyword + ".json")
+    return out_file, out_file + '.partial', out_file + '.checkpoint'
+
+
+def finish_fetch(out_file, partial_file, checkpoint_file):
+    """
+    Streams the fetched claims from the partial file into the final claim file as a JSON list.
+
+    :param out_file: path of the final claim file
+    :param partial_file: path of the partial file with one claim per line
+    :param checkpoint_file: path of the page checkpoint
+    :return: number of claims written
+    """
+    count = 0
+    tmp_file = out_file + '.tmp'
+    with open(tmp_file, 'w') as out:
+        out.write('[')
+        if os.path.exists(partial_file):
+            with open(partial_file) as partial:
+                for line in partial:
+                    if line.strip():
+                        out.write((',\n' if count else '\n') + json.dumps(json.loads(line), indent=2))
+                        count += 1
+        out.write('\n]' if count else ']')
+    os.replace(tmp_file, out_file)
+    for path in [partial_file, checkpoint_file]:
+        if os.path.exists(path):
+            os.remove(path)
+    return count
+
+
+def fetch_pair(keyword, language, key, session, bucket, cfg):
+    """
+    Fetches every page for a keyword and language, appending each page's claims to a partial file and
+    checkpointing the next page token. An interrupted fetch resumes from its last checkpoint.
+
+    :param keyword: keyword to search for
+    :param language: language code to search in
+    :param key: the Google Fact Check API key
+    :param session: requests session
+    :param bucket: token bucket shared by every fetch worker
+    :param cfg: configuration dictionary
+    :return: number of claims fetched, or None if the fetch failed
+    """
+    out_file, partial_file, checkpoint_file = get_fetch_paths(keyword, language, cfg)
+    params = {'key': key, 'query': keyword, 'languageCode': language}
+    offset = 0
+    pages = 0
+    if os.path.exists(checkpoint_file):
+        with open(checkpoint_file) as f:
+            checkpoint = json.load(f)
+        params['pageToken'] = checkpoint['next_page']
+        offset = checkpoint['offset']
+        pages = checkpoint['pages']
+        print("Resuming", keyword, "search in", language, "after", pages, "pages")
+    else:
+        print("Beginning", keyword, "search in", language)
+
+    with open(partial_file, 'a') as partial:
+        # drop anything written after the last checkpoint
+        partial.truncate(offset)
+        while True:
+            try:
+                response_json = request_page(session, bucket, params, cfg)
+            except FetchError as e:
+                print("Failed fetching", keyword, "in", language, "-", e)
+                print("Run again to resume from page", pages + 1)
+                return None
+            for claim in response_json.get('claims', []):
+                partial.write(json.dumps(claim) + '\n')
+            partial.flush()
+            pages += 1
+            next_page = response_json.get('nextPageToken')
+            if not next_page:
+                break
+            params['pageToken'] = next_page
+            with open(checkpoint_file + '.tmp', 'w') as f:
+                json.dump({'next_page': next_page, 'offset': partial.tell(), 'pages': pages}, f)
+            os.replace(checkpoint_file + '.tmp', checkpoint_file)
+    count = finish_fetch(out_file, partial_file, checkpoint_file)
+    print("Done fetching data for keyword", keyword, "with language code", language, "-", count, "claims in", pages,
+          "pages")
+    return count
+
+
 def fetch_api_data(key, cfg):
     """
     Helper function that, given the Fact Check API key, retrieves several fact-checked documents
-    about coronavirus. These claims are then written to a new file on disk.
+    about coronavirus. These claims are then written to a new file on disk. Keyword and language
+    pairs are fetched concurrently by a bounded pool of workers sharing one rate limit.
 
     :param key: the Google Fact Check API key
     :return: none
     """
-    for keyword in cfg['keywords']:
-        for language in cfg['languages']:
-            print("Beginning", keyword, "search in", language)
-            status_code = 503
-            data = []
-            next_page = None
-            params = {'key': key, 'query': keyword, 'languageCode': language}
-            while status_code == 503:
-                x = requests.get("https://factchecktools.googleapis.com/v1alpha1/claims:search",
-                                 params=params)
-                response_json = x.json()
-                status_code = x.status_code
-                if response_json:
-                    data = response_json.get('claims')
-                    next_page = response_json.get('nextPageToken')
-            while next_page:
-                print("Fetching page with code", next_page)
-                params['pageToken'] = next_page
-                x = requests.get("https://factchecktools.googleapis.com/v1alpha1/claims:search",
-                                 params=params)
-                response_json = x.json()
-                # sleep for one minute on error to execute more queries and avoid rate-limiting
-                if x.status_code == 503:
-                    print("Rate limit hit, waiting for one minute")
-                    time.sleep(60)
-                    continue
-                data.extend(response_json.get('claims', []))
-                next_page = response_json.get('nextPageToken')
-            print("Done fetching data for keyword", keyword, "with language code", language)
-
-            file_name = language + "_" + keyword + ".json"
-            with open(os.path.join(cfg['google_dir'], language, file_name), 'w') as out:
-                json.dump(data, out, indent=2)
+    bucket = TokenBucket(cfg.get('fetch_rate', 5), cfg.get('fetch_burst', 5))
+    pairs = [(keyword, language) for keyword in cfg['keywords'] for language in cfg['languages']]
+    with get_session(cfg) as session:
+        with ThreadPoolExecutor(max_workers=cfg.get('fetch_workers', 4)) as pool:
+            results = list(pool.map(lambda pair: fetch_pair(pair[0], pair[1], key, session, bucket, cfg), pairs))
+    failed = [pair for pair, result in zip(pairs, results) if result is None]
+    if failed:
+        print("Fetching failed for", failed, "- run again to resume.")
+        sys.exit(1)
 
 def write_fact_check_data(cfg):
     """
@@ -88,3 +273,5 @@ def write_fact_check_data(cfg):
             os.mkdir(os.path.join(cfg['google_dir'], language))
     api_key = get_api_key(cfg)
     fetch_api_data(api_key, cfg)
+    if cfg.get('use_claim_store'):
+        build_claim_store(cfg)
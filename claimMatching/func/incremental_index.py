@@ -0,0 +1,271 @@
+"""
+This file contains an incrementally updated candidate index. The
+normalized candidate embeddings are persisted as an append-only matrix
+keyed by document hash. On each run only new candidates are encoded
+and appended, removed candidates are tombstoned, and the matrix is
+compacted once tombstones make up too much of it. The metadata file
+is written last and records the generation and row count of the files
+it describes, so a run that stops midway is undone on the next open.
+"""
+import json, os, tempfile
+
+import numpy as np
+
+from func.ann_index import FaissIndex, import_faiss
+from func.embedding_cache import KEY_DTYPE, get_model_dir, hash_text, lock_directory
+from func.encoder_pool import get_model_name
+from func.similarity import normalize_embeddings, top_matches
+
+DEFAULT_COMPACTION_RATIO = 0.2
+# approximate searches fetch extra neighbours so that enough remain after dropping tombstoned rows
+OVERFETCH = 4
+
+
+class IncrementalIndex:
+    """
+    Persisted candidate matrix whose rows are appended or tombstoned as the candidate set changes.
+    """
+
+    def __init__(self, candidate_set, cfg):
+        self.cfg = cfg
+        self.index_type = cfg.get('index_type', 'exact')
+        index_cfg = dict(cfg, embedding_cache_dir=os.path.join(cfg.get('index_dir', 'data/indices/'),
+                                                               candidate_set + '-incremental'))
+        self.directory = get_model_dir(get_model_name(cfg['model'], cfg), index_cfg)
+        self.lock = lock_directory(self.directory)
+        if self.lock is None:
+            print("The", candidate_set, "candidate index is in use by another process, building a temporary one.")
+            self.tmp_dir = tempfile.TemporaryDirectory()
+            self.directory = self.tmp_dir.name
+        self.meta_file = os.path.join(self.directory, 'meta.json')
+        self.dim = None
+        self.keys = np.empty(0, dtype=KEY_DTYPE)
+        self.alive = np.empty(0, dtype=bool)
+        self.ann = None
+        self.live = None
+        self.set_generation(0)
+        if os.path.isfile(self.meta_file):
+            with open(self.meta_file) as f:
+                meta = json.load(f)
+            self.dim = meta.get('dim')
+            self.set_generation(meta.get('generation', 0))
+            if os.path.isfile(self.keys_file) and os.path.isfile(self.alive_file):
+                self.keys = np.load(self.keys_file)
+                self.alive = np.load(self.alive_file)
+            self.recover(meta.get('rows', len(self.keys)))
+            if self.index_type != 'exact' and os.path.isfile(self.ann_file):
+                self.ann = FaissIndex.load(self.ann_file, self.index_type, cfg)
+                if self.ann.index.ntotal != len(self.keys):
+                    # the approximate index was saved without the rows appended last, so it is rebuilt
+                    self.ann = None
+        self.row_docs = np.full(len(self.keys), -1, dtype=np.int64)
+        self.doc_rows = np.empty(0, dtype=np.int64)
+
+    def set_generation(self, generation):
+        """
+        Points the index at the files of a generation. Each compaction writes a new generation, which only
+        replaces the previous one once the metadata naming it is saved.
+
+        :param generation: number of compactions the matrix has been through
+        :return: none
+        """
+        self.generation = generation
+        suffix = '.' + str(generation)
+        self.vector_file = os.path.join(self.directory, 'vectors' + suffix + '.f32')
+        self.keys_file = os.path.join(self.directory, 'keys' + suffix + '.npy')
+        self.alive_file = os.path.join(self.directory, 'alive' + suffix + '.npy')
+        self.ann_file = os.path.join(self.directory, self.index_type + suffix + '.faiss')
+
+    def recover(self, count):
+        """
+        Brings the matrix back in line with the metadata after a run stopped between writing them. Rows appended
+        after the metadata was last saved are cut off, and files missing rows the metadata counts empty the index.
+
+        :param count: number of rows recorded in the metadata
+        :return: none
+        """
+        expected = count * (self.dim or 0) * 4
+        size = os.path.getsize(self.vector_file) if os.path.isfile(self.vector_file) else 0
+        if self.dim is None or len(self.keys) < count or len(self.alive) < count or size < expected:
+            print("The candidate index in", self.directory, "does not match its metadata, rebuilding it.")
+            for path in [self.meta_file, self.vector_file, self.keys_file, self.alive_file, self.ann_file]:
+                if os.path.isfile(path):
+                    os.remove(path)
+            self.dim = None
+            self.keys = np.empty(0, dtype=KEY_DTYPE)
+            self.alive = np.empty(0, dtype=bool)
+            self.set_generation(0)
+            return
+        if size > expected:
+            with open(self.vector_file, 'r+b') as f:
+                f.truncate(expected)
+        self.keys = self.keys[:count]
+        self.alive = self.alive[:count]
+
+    def __len__(self):
+        return len(self.doc_rows)
+
+    def vectors(self):
+        """
+        :return: a read-only memory map over every stored row, including tombstoned ones
+        """
+        if len(self.keys) == 0:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        return np.memmap(self.vector_file, dtype=np.float32, mode='r', shape=(len(self.keys), self.dim))
+
+    def uses_ann(self):
+        """
+        :return: whether or not searches go through an approximate index
+        """
+        if self.index_type == 'ivfpq':
+            return len(self.keys) >= 2 ** self.cfg.get('pq_nbits', 8)
+        return self.index_type == 'hnsw'
+
+    def sync(self, candidate_docs, encode_fn):
+        """
+        Updates the persisted matrix to match the current candidate set, encoding only new documents.
+
+        :param candidate_docs: list of all documents in the candidate set
+        :param encode_fn: function that maps a list of documents to a 2D array of embeddings
+        :return: the synced index
+        """
+        hashes = [hash_text(doc) for doc in candidate_docs]
+        current = set(hashes)
+        live_rows = {key: row for row, key in enumerate(self.keys) if self.alive[row]}
+        removed = [row for key, row in live_rows.items() if key not in current]
+        self.alive[removed] = False
+        new_docs = {}
+        for doc, key in zip(candidate_docs, hashes):
+            if key not in live_rows and key not in new_docs:
+                new_docs[key] = doc
+        if new_docs:
+            embeddings = normalize_embeddings(encode_fn(list(new_docs.values()))).astype(np.float32)
+            self.append(list(new_docs.keys()), embeddings)
+
+        compacted = False
+        if len(self.keys) and (~self.alive).sum() / len(self.keys) > self.cfg.get('compaction_ratio',
+                                                                              DEFAULT_COMPACTION_RATIO):
+            self.compact()
+            compacted = True
+        if self.uses_ann() and self.ann is None:
+            print("Building", self.index_type, "index over", len(self.keys), "candidates...")
+            self.ann = FaissIndex.build(self.vectors(), self.index_type, self.cfg)
+
+        rows = {key: row for row, key in enumerate(self.keys) if self.alive[row]}
+        self.doc_rows = np.array([rows[key] for key in hashes], dtype=np.int64)
+        self.row_docs = np.full(len(self.keys), -1, dtype=np.int64)
+        # with duplicates kept, identical documents share a row and it is reported as the first of them
+        self.row_docs[self.doc_rows[::-1]] = np.arange(len(hashes))[::-1]
+        self.live = None
+        self.save()
+        print("Candidate index synced:", len(new_docs), "added,", len(removed), "removed,",
+              int(self.alive.sum()), "live rows" + (", compacted" if compacted else "") + ".")
+        return self
+
+    def append(self, keys, embeddings):
+        """
+        Appends new rows to the matrix and to the approximate index, if there is one. The rows only count once the
+        metadata is saved, and are cut off on the next open otherwise.
+
+        :param keys: list of document hashes
+        :param embeddings: 2D array of the documents' normalized embeddings
+        :return: none
+        """
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+        os.makedirs(self.directory, exist_ok=True)
+        # an empty index starts a fresh vector file rather than appending to one left behind by a stopped run
+        with open(self.vector_file, 'ab' if len(self.keys) else 'wb') as f:
+            f.write(np.ascontiguousarray(embeddings).tobytes())
+        self.keys = np.concatenate([self.keys, np.array(keys, dtype=KEY_DTYPE)])
+        self.alive = np.concatenate([self.alive, np.ones(len(keys), dtype=bool)])
+        if self.ann is not None:
+            # faiss numbers vectors in insertion order, so ids stay equal to row numbers
+            self.ann.index.add(np.ascontiguousarray(embeddings))
+
+    def compact(self):
+        """
+        Rewrites the matrix without its tombstoned rows into a new generation and drops the approximate index so
+        it is rebuilt. The previous generation's files are only removed once the metadata names the new one.
+
+        :return: none
+        """
+        keep = np.flatnonzero(self.alive)
+        kept_vectors = np.array(self.vectors()[keep])
+        old_files = [self.vector_file, self.keys_file, self.alive_file, self.ann_file]
+        self.set_generation(self.generation + 1)
+        if os.path.isfile(self.ann_file):
+            os.remove(self.ann_file)
+        with open(self.vector_file, 'wb') as f:
+            f.write(kept_vectors.tobytes())
+        self.keys = self.keys[keep]
+        self.alive = np.ones(len(keep), dtype=bool)
+        self.ann = None
+        self.save()
+        for path in old_files:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def save(self):
+        """
+        Writes the row hashes, tombstones and approximate index next to the matrix, then the metadata. Every file
+        is replaced whole, so a run stopped midway leaves either the old or the new version of each.
+
+        :return: none
+        """
+        if self.dim is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        for path, values in [(self.keys_file, self.keys), (self.alive_file, self.alive)]:
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, values)
+            os.replace(path + '.tmp', path)
+        if self.ann is not None:
+            import_faiss().write_index(self.ann.index, self.ann_file + '.tmp')
+            os.replace(self.ann_file + '.tmp', self.ann_file)
+        with open(self.meta_file + '.tmp', 'w') as f:
+            json.dump({'model': self.cfg['model'], 'dim': self.dim, 'generation': self.generation,
+                       'rows': len(self.keys), 'live_rows': int(self.alive.sum())}, f)
+        os.replace(self.meta_file + '.tmp', self.meta_file)
+
+    def doc_embeddings(self):
+        """
+        :return: the normalized embedding of every candidate document, in candidate set order
+        """
+        return np.array(self.vectors()[self.doc_rows])
+
+    def find_docs(self, documents):
+        """
+        :param documents: list of documents from the candidate set
+        :return: the candidate document index of each document, the first of any identical candidates
+        """
+        rows = {key: row for row, key in enumerate(self.keys) if self.alive[row]}
+        return self.row_docs[np.array([rows[hash_text(doc)] for doc in documents], dtype=np.int64)]
+
+    def search(self, query_embeddings, k):
+        """
+        Finds the k closest candidate documents for each query, skipping tombstoned rows.
+
+        :param query_embeddings: 2D array of query embeddings
+        :param k: number of matches per query
+        :return: a 2D array of cosine distances and a 2D array of candidate document indices, -1 where missing
+        """
+        if not self.uses_ann():
+            if self.live is None:
+                # the live rows are read once per sync rather than copied out of the matrix on every search
+                rows = np.flatnonzero(self.row_docs >= 0)
+                self.live = rows, np.array(self.vectors()[rows])
+            rows, live_vectors = self.live
+            distances, indices = top_matches(query_embeddings, live_vectors, k, self.cfg)
+            return distances, self.row_docs[rows[indices]]
+
+        distances, rows = self.ann.search(query_embeddings, k * OVERFETCH)
+        docs = np.where(rows >= 0, self.row_docs[rows], -1)
+        out_distances = np.full((len(docs), k), np.inf)
+        out_docs = np.full((len(docs), k), -1, dtype=np.int64)
+        for query, (row_distances, row_docs) in enumerate(zip(distances, docs)):
+            found = row_docs >= 0
+            count = min(k, int(found.sum()))
+            out_distances[query, :count] = row_distances[found][:count]
+            out_docs[query, :count] = row_docs[found][:count]
+        return out_distances, out_docs
@@ -0,0 +1,138 @@
+"""
+This file contains the compiled keyword matcher used to filter the
+search set. Single-word keywords are looked up in a hashed set, and
+multi-word keywords are found with an Aho-Corasick automaton over
+words, so each document is scanned once regardless of how many
+keywords there are. Documents are tokenized exactly as in TF-IDF.
+"""
+from collections import deque
+from multiprocessing import Pool
+
+from func.util import make_list_unique, tokenize
+
+
+class KeywordMatcher:
+    """
+    Matches single words and multi-word phrases against tokenized documents.
+    """
+
+    def __init__(self, filter_words):
+        self.words = set()
+        # automaton state 0 is the root; each state has word transitions, a failure link and the phrases ending there
+        self.transitions = [{}]
+        self.failure = [0]
+        self.outputs = [[]]
+        for keyword in filter_words:
+            tokens = tokenize(keyword)
+            if len(tokens) == 1:
+                self.words.add(tokens[0])
+            else:
+                self.add_phrase(tokens, ' '.join(tokens))
+        self.build_failure_links()
+
+    def add_phrase(self, tokens, phrase):
+        """
+        Adds a multi-word phrase to the automaton's trie.
+
+        :param tokens: list of the phrase's lowercase words
+        :param phrase: the phrase as it should be reported when matched
+        :return: none
+        """
+        state = 0
+        for token in tokens:
+            if token not in self.transitions[state]:
+                self.transitions.append({})
+                self.failure.append(0)
+                self.outputs.append([])
+                self.transitions[state][token] = len(self.transitions) - 1
+            state = self.transitions[state][token]
+        self.outputs[state].append(phrase)
+
+    def build_failure_links(self):
+        """
+        Computes the automaton's failure links breadth-first so that overlapping phrases are all found.
+
+        :return: none
+        """
+        # states one word deep always fail back to the root
+        queue = deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for token, next_state in self.transitions[state].items():
+                queue.append(next_state)
+                fallback = self.failure[state]
+                while fallback and token not in self.transitions[fallback]:
+                    fallback = self.failure[fallback]
+                self.failure[next_state] = self.transitions[fallback].get(token, 0)
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.failure[next_state]]
+
+    def match(self, document):
+        """
+        Finds every keyword in a document.
+
+        :param document: string document
+        :return: list of unique matching keywords in the order they occur
+        """
+        matches = []
+        state = 0
+        has_phrases = len(self.transitions[0]) > 0
+        for token in tokenize(document):
+            if token in self.words:
+                matches.append(token)
+            if has_phrases:
+                while state and token not in self.transitions[state]:
+                    state = self.failure[state]
+                state = self.transitions[state].get(token, 0)
+                matches.extend(self.outputs[state])
+        return make_list_unique(matches)
+
+
+_worker_matcher = []
+
+
+def init_worker(matcher):
+    """
+    Stores the compiled matcher in a worker process so it is only sent once per worker.
+
+    :param matcher: compiled KeywordMatcher
+    :return: none
+    """
+    _worker_matcher.append(matcher)
+
+
+def match_chunk(documents):
+    """
+    Matches a chunk of documents with the worker's compiled matcher.
+
+    :param documents: list of string documents
+    :return: list of each document's matching keywords
+    """
+    return [_worker_matcher[0].match(document) for document in documents]
+
+
+def filter_documents(documents, filter_words, workers=1):
+    """
+    Given a set of documents and keywords to filter documents with, filters
+    out all documents that do not contain at least one of the keywords.
+
+    :param documents: list of documents
+    :param filter_words: list of keywords generated by tf-idf over the claims, may include multi-word phrases
+    :param workers: number of processes to match documents with
+    :return: a filtered list of the tweets and a list of the matching keywords for each tweet
+    """
+    matcher = KeywordMatcher(filter_words)
+    if workers > 1 and len(documents) > workers:
+        chunk_size = -(-len(documents) // (workers * 4))
+        chunks = [documents[start:start + chunk_size] for start in range(0, len(documents), chunk_size)]
+        with Pool(workers, initializer=init_worker, initargs=(matcher,)) as pool:
+            doc_matches = [match for chunk in pool.map(match_chunk, chunks) for match in chunk]
+    else:
+        doc_matches = [matcher.match(document) for document in documents]
+
+    all_matches = []
+    new_docs = []
+    for document, keyword_matches in zip(documents, doc_matches):
+        if keyword_matches:
+            new_docs.append(document)
+            all_matches.append(keyword_matches)
+    return new_docs, all_matches
@@ -0,0 +1,210 @@
+"""
+This file contains the two-stage retrieval used by the claim matcher.
+A BM25 inverted index over the candidate set, built with the same
+tokenization as the TF-IDF filter, shortlists the candidates that share
+the most informative words with each search document. Only those
+candidates are then ranked by embedding cosine distance.
+"""
+import time
+
+import numpy as np
+
+from func.ann_index import ExactIndex, compare_matches, index_top_matches
+from func.similarity import DEFAULT_MEMORY_MB, exclude_ids, normalize_embeddings, top_matches
+from func.util import build_word_count_matrix, build_word_encoder_decoder, get_unique_words, tokenize
+
+DEFAULT_K1 = 1.2
+DEFAULT_B = 0.75
+DEFAULT_MAX_DF = 0.1
+# number of search documents scored against the inverted index at a time
+QUERY_BLOCK = 1024
+
+
+class LexicalIndex:
+    """
+    BM25 inverted index over the candidate set's words.
+    """
+
+    def __init__(self, documents, cfg):
+        """
+        :param documents: list of candidate documents
+        :param cfg: configuration dictionary
+        """
+        k1 = cfg.get('bm25_k1', DEFAULT_K1)
+        b = cfg.get('bm25_b', DEFAULT_B)
+        self.size = len(documents)
+        unique_words = get_unique_words(documents)
+        word_encoder, _ = build_word_encoder_decoder(unique_words)
+        counts = build_word_count_matrix(documents, unique_words, word_encoder).astype(np.float64)
+
+        document_frequency = np.bincount(counts.indices, minlength=counts.shape[1])
+        # words in a large share of the candidates barely change their scores but would make every query score
+        # most of the candidates, so queries skip them
+        max_df = cfg.get('lexical_max_df', DEFAULT_MAX_DF) * self.size
+        self.word_encoder = {word: index for word, index in word_encoder.items()
+                             if document_frequency[index] <= max_df}
+        idf = np.log(1 + (self.size - document_frequency + 0.5) / (document_frequency + 0.5))
+        lengths = np.asarray(counts.sum(axis=1)).ravel()
+        norms = k1 * (1 - b + b * lengths / max(lengths.mean(), 1e-9)) if self.size else lengths
+        rows = np.repeat(np.arange(self.size), np.diff(counts.indptr))
+        tf = counts.data
+        counts.data = tf * (k1 + 1) / (tf + norms[rows]) * idf[counts.indices]
+        # each row of the transposed matrix is a word's postings list
+        self.postings = counts.T.tocsr()
+
+    def __len__(self):
+        return self.size
+
+    def query_matrix(self, queries):
+        """
+        :param queries: list of string documents
+        :return: a sparse matrix marking the candidate set words each query contains
+        """
+        from scipy import sparse
+        rows, cols = [], []
+        for row, query in enumerate(queries):
+            word_ids = set(self.word_encoder[word] for word in tokenize(query) if word in self.word_encoder)
+            rows.extend([row] * len(word_ids))
+            cols.extend(word_ids)
+        return sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(queries), self.postings.shape[0]))
+
+    def shortlist(self, queries, size):
+        """
+        Finds the candidates with the highest BM25 scores for each query.
+
+        :param queries: list of string documents
+        :param size: number of candidates per query
+        :return: a 2D array of candidate indices of shape (queries, size), best first, padded with -1 where a query
+        shares words with fewer candidates
+        """
+        shortlist = np.full((len(queries), size), -1, dtype=np.int64)
+        for start in range(0, len(queries), QUERY_BLOCK):
+            scores = self.query_matrix(queries[start:start + QUERY_BLOCK]) @ self.postings
+            for row in range(scores.shape[0]):
+                data = scores.data[scores.indptr[row]:scores.indptr[row + 1]]
+                indices = scores.indices[scores.indptr[row]:scores.indptr[row + 1]]
+                if len(data) > size:
+                    keep = np.argpartition(-data, size - 1)[:size]
+                    data, indices = data[keep], indices[keep]
+                order = np.lexsort((indices, -data))
+                shortlist[start + row, :len(order)] = indices[order]
+        return shortlist
+
+
+def rerank_shortlist(search_embeddings, candidate_embeddings, shortlist, k, cfg):
+    """
+    Ranks each search document's shortlisted candidates by cosine distance.
+
+    :param search_embeddings: embeddings for all documents in the search set
+    :param candidate_embeddings: embeddings for all documents in the candidate set
+    :param shortlist: 2D array of each search document's shortlisted candidate indices, -1 for none
+    :param k: number of matches per search document
+    :param cfg: configuration dictionary
+    :return: a 2D array of cosine distances and a 2D array of candidate indices, -1 where fewer were shortlisted
+    """
+    search_norm = normalize_embeddings(search_embeddings)
+    candidate_embeddings = np.asarray(candidate_embeddings)
+    k = min(k, shortlist.shape[1])
+    distances = np.full((len(shortlist), k), np.inf)
+    indices = np.full((len(shortlist), k), -1, dtype=np.int64)
+    if len(shortlist) == 0 or k == 0:
+        return distances, indices
+    # the raw candidate vectors are gathered and scaled by their norms after the product, rather than normalized
+    # copies being made, so the distances are those of the exhaustive search
+    norms = np.linalg.norm(candidate_embeddings, axis=1)
+    inverse_norms = np.divide(1.0, norms, out=np.zeros_like(norms, dtype=np.float64), where=norms > 0)
+    # each block gathers a float64 vector for every shortlisted candidate of every row
+    budget = cfg.get('match_memory_mb', DEFAULT_MEMORY_MB) * 1024 * 1024
+    block_size = max(1, int(budget // (shortlist.shape[1] * search_norm.shape[1] * 8)))
+    for start in range(0, len(shortlist), block_size):
+        block = shortlist[start:start + block_size]
+        found = block >= 0
+        safe = np.where(found, block, 0)
+        vectors = candidate_embeddings[safe].astype(np.float64, copy=False)
+        similarity = np.matmul(vectors, search_norm[start:start + block_size, :, np.newaxis])[:, :, 0]
+        block_dists = 1.0 - similarity * inverse_norms[safe]
+        block_dists[~found] = np.inf
+        # ties are broken by candidate index, as they are in the exhaustive search
+        order = np.lexsort((np.where(found, block, np.iinfo(np.int64).max), block_dists), axis=1)[:, :k]
+        distances[start:start + block_size] = np.take_along_axis(block_dists, order, axis=1)
+        indices[start:start + block_size] = np.where(np.isfinite(distances[start:start + block_size]),
+                                                     np.take_along_axis(block, order, axis=1), -1)
+    return distances, indices
+
+
+def shortlist_top_matches(index, search_docs, search_embeddings, candidate_embeddings, search_set, candidate_set, cfg,
+                          search_ids=None):
+    """
+    Finds the top matching candidate documents for every search document among its BM25 shortlist. Search
+    documents that share words with fewer than num_matches candidates are matched against every candidate. When
+    the search set is the candidate set, each document's own candidate is left out of its results.
+
+    :param index: LexicalIndex over the candidate set
+    :param search_docs: list of search set documents
+    :param search_embeddings: SBERT-generated embeddings for the search set documents
+    :param candidate_embeddings: SBERT-generated embeddings for all documents in the candidate set
+    :param search_set: name of the search set
+    :param candidate_set: name of the candidate set
+    :param cfg: configuration dictionary
+    :param search_ids: candidate index of each search document when the search set is the candidate set, by
+    default its position
+    :return: a 2D array of cosine distances, a 2D array of indices of the closest candidates for each search item
+    and the number of search documents matched against every candidate
+    """
+    exclude = None
+    if search_set == candidate_set:
+        exclude = np.arange(len(search_docs)) if search_ids is None else np.asarray(search_ids)
+    k = min(cfg['num_matches'], len(index) - (1 if exclude is not None else 0))
+    size = max(cfg.get('lexical_shortlist'), k)
+    shortlist = index.shortlist(search_docs, size + (1 if exclude is not None else 0))
+    if exclude is not None:
+        shortlist[shortlist == exclude.reshape(-1, 1)] = -1
+    distances, indices = rerank_shortlist(search_embeddings, candidate_embeddings, shortlist, k, cfg)
+
+    fallback = np.flatnonzero(np.sum(shortlist >= 0, axis=1) < k)
+    if len(fallback):
+        queries = np.asarray(search_embeddings)[fallback]
+        if exclude is not None:
+            fallback_dists, fallback_indices = top_matches(queries, candidate_embeddings, k + 1, cfg)
+            fallback_dists, fallback_indices = exclude_ids(fallback_dists, fallback_indices, exclude[fallback], k)
+        else:
+            fallback_dists, fallback_indices = top_matches(queries, candidate_embeddings, k, cfg)
+        distances[fallback], indices[fallback] = fallback_dists, fallback_indices
+    return distances, indices, len(fallback)
+
+
+def shortlist_report(index, search_docs, search_embeddings, candidate_embeddings, search_set, candidate_set, cfg,
+                     search_ids=None):
+    """
+    Compares the two-stage matches to the exhaustive cosine matches and prints the recall and the work saved.
+
+    :param index: LexicalIndex over the candidate set
+    :param search_docs: list of search set documents
+    :param search_embeddings: SBERT-generated embeddings for the search set documents
+    :param candidate_embeddings: SBERT-generated embeddings for all documents in the candidate set
+    :param search_set: name of the search set
+    :param candidate_set: name of the candidate set
+    :param cfg: configuration dictionary
+    :param search_ids: candidate index of each search document when the search set is the candidate set, by
+    default its position
+    :return: a dictionary with the recall at num_matches, the rate at which the top match agrees, the fraction of
+    search documents matched exhaustively and the times of both searches
+    """
+    started = time.time()
+    _, exact = index_top_matches(ExactIndex(candidate_embeddings, cfg), search_embeddings, search_set, candidate_set,
+                                 cfg, search_ids)
+    exact_seconds = time.time() - started
+    started = time.time()
+    _, shortlisted, num_fallback = shortlist_top_matches(index, search_docs, search_embeddings, candidate_embeddings,
+                                                         search_set, candidate_set, cfg, search_ids)
+    shortlist_seconds = time.time() - started
+    report = {'shortlist': cfg.get('lexical_shortlist'), 'queries': len(exact), 'k': cfg['num_matches'],
+              'fallback_rate': num_fallback / max(len(exact), 1), 'exhaustive_seconds': exact_seconds,
+              'shortlist_seconds': shortlist_seconds}
+    report.update(compare_matches(exact, shortlisted))
+    print("Recall of the", report['shortlist'], "candidate BM25 shortlist at k =", report['k'], "over",
+          report['queries'], "queries:", round(report['recall_at_k'], 4), "(top match agreement",
+          round(report['top1_agreement'], 4), "),", round(report['fallback_rate'] * 100, 2),
+          "% of queries matched exhaustively, in", round(shortlist_seconds, 2), "seconds against",
+          round(exact_seconds, 2), "for the exhaustive search.")
+    return report
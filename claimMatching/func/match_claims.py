@@ -4,21 +4,47 @@ This file creates a SBERT model that matches user-submitted
 tweets about COVID to the nearest fact-checked claims.
 @author: brocklin
 """
-from datetime import datetime
-import os, sys
+import importlib, sys, time
 
 import numpy as np
-import scipy
-from sentence_transformers import SentenceTransformer
 
-import func.google_fc_loader as GoogleLoader
-import func.ng_loader as NewsGuardLoader
-import func.tweet_loader as TweetLoader
-import func.misc_json_loader as MiscLoader
-from func.util import get_filtering_words, make_list_unique, filter_documents
+import func.claim_store as ClaimStore
+import func.corpus as Corpus
+from func.ann_index import close_index, get_candidate_index, index_top_matches, recall_report
+from func.embedding_cache import EmbeddingCache, hash_text
+from func.encoder_pool import EncoderPool, get_model_name
+from func.incremental_index import IncrementalIndex
+from func.similarity import batched_top_matches
+from func.keyword_filter import filter_documents
+from func.lexical_index import LexicalIndex, shortlist_report, shortlist_top_matches
+from func.match_writer import MatchWriter
+from func.metrics import METRICS
+from func.near_duplicates import collapse_near_duplicates
+from func.util import LRUSet, get_filtering_words, make_list_unique
 
+# loaders are imported when a set first needs them, so a run only pays for the dependencies of its own sets
+LOADER_MODULES = {'google': 'func.google_fc_loader', 'tweets': 'func.tweet_loader', 'local_tweets': 'func.tweet_loader',
+                  'ng': 'func.ng_loader', 'misc_json': 'func.misc_json_loader'}
+DEFAULT_DEDUP_WINDOW = 200000
 
-def encode_sets(search_docs, candidate_docs, model_weights, search_set, candidate_set):
+
+def get_encoder(encoder, cfg=None):
+    """
+    Builds a function that encodes a list of documents with an encoder pool. The model is only loaded the first
+    time the function is called, and when the embedding cache is enabled only documents missing from the cache
+    are passed to the model.
+
+    :param encoder: EncoderPool holding the SBERT weights to use to encode the documents, closed by the caller
+    :param cfg: configuration dictionary, used to look up the embedding cache settings
+    :return: a function mapping a list of documents to their embeddings
+    """
+    if cfg is None or not cfg.get('use_embedding_cache'):
+        return encoder.encode
+    cache = EmbeddingCache(get_model_name(encoder.model_weights, cfg), cfg)
+    return lambda documents: cache.encode(documents, encoder.encode)
+
+
+def encode_sets(search_docs, candidate_docs, model_weights, search_set, candidate_set, cfg=None):
     """
     Encodes all the items in the search and candidate sets using an
     SBERT sentence encoder with the given weights.
@@ -28,21 +54,23 @@ def encode_sets(search_docs, candidate_docs, model_weights, search_set, candidat
     :param model_weights: name of the pre-trained weights to use to encode the documents
     :param search_set: name of the search set
     :param candidate_set: name of the candidate set
+    :param cfg: configuration dictionary, used to look up the embedding cache settings
     :return: a list of embeddings for the search set and a list of embeddings for the candidate set
     """
-    embedder = SentenceTransformer(model_weights)
+    with EncoderPool(model_weights, cfg or {}) as encoder:
+        encode = get_encoder(encoder, cfg)
 
-    if search_set == candidate_set:
-        print("Encoding search and candidate set data...")
-        search_embeddings = embedder.encode(search_docs)
-        return search_embeddings, search_embeddings
-    else:
-        print("Encoding search set...")
-        search_embeddings = embedder.encode(search_docs)
+        if search_set == candidate_set:
+            print("Encoding search and candidate set data...")
+            search_embeddings = encode(search_docs)
+            return search_embeddings, search_embeddings
+        else:
+            print("Encoding search set...")
+            search_embeddings = encode(search_docs)
 
-        print("Encoding candidate set...")
-        candidate_embeddings = embedder.encode(candidate_docs)
-        return search_embeddings, candidate_embeddings
+            print("Encoding candidate set...")
+            candidate_embeddings = encode(candidate_docs)
+            return search_embeddings, candidate_embeddings
 
 
 def get_top_matches(search_embedding, candidate_embeddings, search_set, candidate_set, cfg):
@@ -54,44 +82,67 @@ def get_top_matches(search_embedding, candidate_embeddings, search_set, candidat
     :param search_set: name of the search set
     :param candidate_set: name of the target set
     :param cfg: configuration dictionary
-    :return: distances and indices of the closest candidate documents to the search document
+    :return: distances and indices of the closest candidate documents to the search document, closest first
     """
-    distances = scipy.spatial.distance.cdist([search_embedding], candidate_embeddings, "cosine")[0]
-    sorted_dists = np.argsort(distances)
-    # if the search set is the same as the candidate set, keep the same element from showing up in the matches
-    low_indices = None
-    if search_set == candidate_set:
-        low_indices = sorted_dists[1:cfg['num_matches'] + 1]
-    else:
-        low_indices = sorted_dists[:cfg['num_matches']]
-    return distances, low_indices
+    distances, low_indices = batched_top_matches([search_embedding], candidate_embeddings, search_set,
+                                                 candidate_set, cfg)
+    return distances[0], low_indices[0]
 
 
-def write_search_doc_output(file, search_doc, candidate_docs, match, distances, low_indices):
+def index_candidate_set(candidate_docs, candidate_set, encode_fn, cfg):
     """
-    Helper function to write output for matches to each document in the search set.
+    Encodes the candidate set and returns an index over it. With incremental_index enabled, only candidates
+    added since the last run are encoded.
 
-    :param file: file to output to
-    :param search_doc: document from the search set
-    :param candidate_docs: all candidate documents
-    :param match: matching keywords
-    :param distances: distances to each nearby candidate
-    :param low_indices: indices of each nearby candidate
-    :return: none
+    :param candidate_docs: list of all documents in the candidate set
+    :param candidate_set: string denoting what data to use for the candidate set
+    :param encode_fn: function that maps a list of documents to their embeddings
+    :param cfg: configuration dictionary
+    :return: an index with a search(query_embeddings, k) method
+    """
+    if cfg.get('incremental_index'):
+        return sync_candidate_index(candidate_docs, candidate_set, encode_fn, cfg)
+    with METRICS.stage('encode', set=candidate_set) as counts:
+        print("Encoding candidate set...")
+        candidate_embeddings = encode_fn(candidate_docs)
+        counts['documents'] = len(candidate_docs)
+    with METRICS.stage('index', set=candidate_set) as counts:
+        index = get_candidate_index(candidate_docs, candidate_embeddings, candidate_set, cfg)
+        counts['documents'] = len(candidate_docs)
+    return index
+
+
+def sync_candidate_index(candidate_docs, candidate_set, encode_fn, cfg):
+    """
+    Syncs the incremental index with the candidate set. The sync encodes the added candidates itself, so the
+    time spent in encode_fn is recorded as the encode stage and only the rest of the sync as the index stage.
+
+    :param candidate_docs: list of all documents in the candidate set
+    :param candidate_set: string denoting what data to use for the candidate set
+    :param encode_fn: function that maps a list of documents to their embeddings
+    :param cfg: configuration dictionary
+    :return: the synced IncrementalIndex
     """
-    file.write("Search set item:\n")
-    file.write(search_doc.replace('\n', ' ') + '\n')
-    file.write("----------------------------\n")
-    if match:
-        file.write("Matching keywords: " + str(match) + '\n')
-    file.write("Distances to candidate: " + str(distances) + '\n')
-    file.write("Top candidate set matches (high to low): \n")
-    for dist in low_indices:
-        file.write("- " + str(candidate_docs[dist]).replace('\n', ' ') + '\n')
-    file.write("\n")
+    encoded = {'documents': 0, 'seconds': 0.0}
+
+    def timed_encode_fn(documents):
+        started = time.perf_counter()
+        embeddings = encode_fn(documents)
+        encoded['seconds'] += time.perf_counter() - started
+        encoded['documents'] += len(documents)
+        return embeddings
 
+    print("Syncing candidate index...")
+    started = time.perf_counter()
+    index = IncrementalIndex(candidate_set, cfg).sync(candidate_docs, timed_encode_fn)
+    seconds = time.perf_counter() - started
+    METRICS.record('encode', {'set': candidate_set}, encoded['seconds'], {'documents': encoded['documents']})
+    METRICS.record('index', {'set': candidate_set}, seconds - encoded['seconds'], {'documents': len(candidate_docs)})
+    return index
 
-def retrieve_nearest(search_docs, candidate_docs, matches, search_set, candidate_set, cfg):
+
+def retrieve_nearest(search_docs, candidate_docs, matches, search_set, candidate_set, cfg, index_report=False,
+                     clusters=None):
     """
     Retrieves the nearest claims for each tweet passed in.
 
@@ -101,32 +152,217 @@ def retrieve_nearest(search_docs, candidate_docs, matches, search_set, candidate
     :param search_set: string denoting what data to use for the search set
     :param candidate_set: string denoting what data to use for the candidate set
     :param cfg: configuration dictionary
-    :return: none
+    :param index_report: boolean denoting whether or not to report the index's recall against the exact search
+    :param clusters: optional list of representative document indices and array of each document's cluster, so
+    only the representatives are encoded and matched
+    :return: estimated seconds spent encoding and matching the search documents
     """
-    search_embeddings, candidate_embeddings = encode_sets(search_docs, candidate_docs, cfg['model'], search_set,
-                                                          candidate_set)
+    query_docs = search_docs if clusters is None else [search_docs[i] for i in clusters[0]]
+    search_ids = None
+    two_stage = cfg.get('lexical_shortlist', 0) > 0
+    # the index is closed even when a stage fails, since a sharded index's workers would outlive the run
+    index = None
+    try:
+        if cfg.get('incremental_index'):
+            with EncoderPool(cfg['model'], cfg) as encoder:
+                encode = get_encoder(encoder, cfg)
+                index = sync_candidate_index(candidate_docs, candidate_set, encode, cfg)
+                candidate_embeddings = index.doc_embeddings() if search_set == candidate_set or index_report or \
+                    two_stage else None
+                started = time.time()
+                with METRICS.stage('encode', set=search_set) as counts:
+                    if search_set == candidate_set and len(query_docs) == len(candidate_docs):
+                        search_embeddings = candidate_embeddings
+                    elif search_set == candidate_set:
+                        # filtered search documents are looked up among the candidates, which the index numbers
+                        search_ids = index.find_docs(query_docs)
+                        search_embeddings = candidate_embeddings[search_ids]
+                    else:
+                        print("Encoding search set...")
+                        search_embeddings = encode(query_docs)
+                    counts['documents'] = len(query_docs)
+                encode_seconds = time.time() - started
+        else:
+            started = time.time()
+            with METRICS.stage('encode', set=search_set) as counts:
+                search_embeddings, candidate_embeddings = encode_sets(query_docs, candidate_docs, cfg['model'],
+                                                                      search_set, candidate_set, cfg)
+                counts['documents'] = len(query_docs) + (len(candidate_docs) if search_set != candidate_set else 0)
+            encode_seconds = time.time() - started
+            if search_set != candidate_set:
+                # both sets are encoded the same way, so the search set's share is estimated by document count
+                encode_seconds *= len(query_docs) / max(len(query_docs) + len(candidate_docs), 1)
+            with METRICS.stage('index', set=candidate_set) as counts:
+                # the two-stage search ranks the shortlisted candidates' embeddings directly
+                index = None if two_stage else get_candidate_index(candidate_docs, candidate_embeddings, candidate_set,
+                                                                   cfg)
+                counts['documents'] = len(candidate_docs)
+            if not (index_report or two_stage):
+                # the index holds what it searches, a sharded index only in its workers
+                candidate_embeddings = None
+        if two_stage:
+            with METRICS.stage('lexical', set=candidate_set) as counts:
+                print("Building BM25 index over the candidate set...")
+                lexical_index = LexicalIndex(candidate_docs, cfg)
+                counts['documents'] = len(candidate_docs)
+            if index_report:
+                shortlist_report(lexical_index, query_docs, search_embeddings, candidate_embeddings, search_set,
+                                 candidate_set, cfg, search_ids)
+        elif index_report:
+            recall_report(index, search_embeddings, candidate_embeddings, search_set, candidate_set, cfg, search_ids)
+
+        if len(matches) == 0:
+            matches = [None] * len(search_docs)
 
-    if len(matches) == 0:
-        matches = [None] * len(search_embeddings)
+        started = time.time()
+        with METRICS.stage('search', set=search_set) as counts:
+            if two_stage:
+                all_distances, all_indices, num_fallback = shortlist_top_matches(
+                    lexical_index, query_docs, search_embeddings, candidate_embeddings, search_set, candidate_set, cfg,
+                    search_ids)
+                counts['exhaustive'] = num_fallback
+            else:
+                all_distances, all_indices = index_top_matches(index, search_embeddings, search_set, candidate_set, cfg,
+                                                               search_ids)
+            counts['documents'] = len(query_docs)
+    finally:
+        close_index(index)
+    search_seconds = encode_seconds + time.time() - started
+    if clusters is not None:
+        all_distances, all_indices = all_distances[clusters[1]], all_indices[clusters[1]]
 
     print("Writing output...")
-    if not os.path.exists((cfg['output_dir'])):
-        cwd = os.getcwd()    
-        os.mkdir(os.path.join(cwd,cfg['output_dir']))
+    with METRICS.stage('write', set=search_set) as counts:
+        with MatchWriter(search_set, candidate_set, candidate_docs, cfg) as writer:
+            writer.write(search_docs, matches, all_distances, all_indices)
+        counts['documents'] = writer.num_searched
+    return search_seconds
+
+
+def import_loader(set_name):
+    """
+    :param set_name: string denoting which data to load
+    :return: the loader module of the set
+    """
+    return importlib.import_module(LOADER_MODULES[set_name])
+
+
+def load_documents(set_name, multimodal, cfg, prune_duplicates=False):
+    """
+    Loads the documents of a single search or candidate set from its source, recording the load as a stage.
+
+    :param set_name: string denoting which data to load
+    :param multimodal: boolean denoting whether or not multimodal data should be used
+    :param cfg: configuration dictionary
+    :param prune_duplicates: boolean denoting whether or not duplicates will be removed from the documents
+    :return: a list of documents
+    """
+    with METRICS.stage('load', set=set_name) as counts:
+        documents = read_documents(set_name, multimodal, cfg, prune_duplicates)
+        counts['documents'] = len(documents) if documents is not None else 0
+    return documents
+
+
+def read_documents(set_name, multimodal, cfg, prune_duplicates=False):
+    """
+    Reads the documents of a single search or candidate set with its loader. Claim sets are memory-mapped from
+    their compiled corpus when it is enabled, and deduplicated claim sets are otherwise read from the merged claim
+    store when it is enabled.
+
+    :param set_name: string denoting which data to load
+    :param multimodal: boolean denoting whether or not multimodal data should be used
+    :param cfg: configuration dictionary
+    :param prune_duplicates: boolean denoting whether or not duplicates will be removed from the documents
+    :return: a list of documents
+    """
+    if cfg.get('use_corpus') and set_name in Corpus.CORPUS_SOURCES:
+        return Corpus.load_corpus(set_name, cfg)
+    elif prune_duplicates and cfg.get('use_claim_store') and set_name in ClaimStore.STORE_SOURCES:
+        return ClaimStore.load_claims(set_name, cfg)
+    elif set_name == 'manual':
+        return cfg['sentences']
+    elif set_name not in LOADER_MODULES:
+        return None
+    loader = import_loader(set_name)
+    if set_name == 'google':
+        return [claim.get('text') for claim in loader.get_claim_data(cfg)]
+    elif set_name == 'tweets':
+        return loader.get_tweet_data(multimodal, cfg)
+    elif set_name == 'local_tweets':
+        return [tweet.get('full_text') for tweet in loader.get_local_tweet_data(multimodal, cfg)]
+    elif set_name == 'ng':
+        return [ng.get('description') for ng in loader.get_ng_data(cfg)]
+    elif set_name == 'misc_json':
+        return [misc_point.get('content') for misc_point in loader.get_json_data(cfg)]
+
+
+def load_sets(search_set, candidate_set, prune_duplicates, multimodal, cfg):
+    """
+    Loads the documents of the search and candidate sets from their sources.
+
+    :param search_set: string denoting what data to use for the search set
+    :param candidate_set: string denoting what data to use for the candidate set
+    :param prune_duplicates: boolean denoting whether or not to remove duplicates from the search and candidate sets
+    :param multimodal: boolean denoting whether or not multimodal data should be used
+    :param cfg: configuration dictionary
+    :return: a list of search set documents and a list of candidate set documents
+    """
+    candidate_docs = load_documents(candidate_set, multimodal, cfg, prune_duplicates)
+    if prune_duplicates:
+        print("Pruning duplicate from", len(candidate_docs), "candidate documents...")
+        candidate_docs = prune_documents(candidate_docs, candidate_set)
+
+    if search_set == candidate_set:
+        search_docs = candidate_docs
+    else:
+        search_docs = load_documents(search_set, multimodal, cfg, prune_duplicates)
+        if prune_duplicates:
+            print("Pruning duplicates from", len(search_docs), "search documents...")
+            search_docs = prune_documents(search_docs, search_set)
+    return search_docs, candidate_docs
+
+
+def prune_documents(documents, set_name):
+    """
+    Removes duplicated documents, recording how many were dropped.
+
+    :param documents: list of documents
+    :param set_name: name of the set the documents belong to
+    :return: the unique documents in their original order
+    """
+    with METRICS.stage('prune', set=set_name) as counts:
+        # a compiled corpus knows its unique texts, so they are not decoded to be compared
+        if isinstance(documents, Corpus.Corpus):
+            unique_docs = documents.unique_texts()
+        else:
+            unique_docs = make_list_unique(documents)
+        counts.update({'documents': len(unique_docs), 'dropped': len(documents) - len(unique_docs)})
+    return unique_docs
+
+
+def warm_embedding_cache(search_set, candidate_set, prune_duplicates, multimodal, cfg):
+    """
+    Encodes the search and candidate sets into the embedding cache without matching them.
 
-    with open(os.path.join(cfg['output_dir'], search_set + '-' + candidate_set + '-' +
-                                              datetime.now().strftime("%m%d%y-%H%M%S") + '.txt'), "w") as f:
-        f.write("Model: " + cfg['model'] + "\n")
-        f.write("Search Set: " + search_set + "\n")
-        f.write("Candidate Set: " + candidate_set + "\n")
-        f.write("Languages: " + str(cfg['languages']) + "\n\n")
-        for search_doc, search_embedding, match in zip(search_docs, search_embeddings, matches):
-            distances, low_indices = get_top_matches(search_embedding, candidate_embeddings, search_set,
-                                                     candidate_set, cfg)
-            write_search_doc_output(f, search_doc, candidate_docs, match, distances[low_indices], low_indices)
+    :param search_set: string denoting what data to use for the search set
+    :param candidate_set: string denoting what data to use for the candidate set
+    :param prune_duplicates: boolean denoting whether or not to remove duplicates from the search and candidate sets
+    :param multimodal: boolean denoting whether or not multimodal data should be used
+    :param cfg: configuration dictionary
+    :return: none
+    """
+    search_docs, candidate_docs = load_sets(search_set, candidate_set, prune_duplicates, multimodal, cfg)
+    cache = EmbeddingCache(get_model_name(cfg['model'], cfg), cfg)
+    with EncoderPool(cfg['model'], cfg) as encoder:
+        cache.encode(search_docs, encoder.encode)
+        if search_set != candidate_set:
+            cache.encode(candidate_docs, encoder.encode)
+    stats = cache.stats()
+    print("Embedding cache warmed:", stats['misses'], "documents encoded,", stats['hits'], "already cached,",
+          stats['entries'], "total entries.")
 
 
-def find_nearest_claims(search_set, candidate_set, prune_duplicates, multimodal, filter, cfg):
+def find_nearest_claims(search_set, candidate_set, prune_duplicates, multimodal, filter, cfg, index_report=False):
     """
     Finds and prints the nearest claims for each tweet. Serves as a
     controller function that dispatches work to various other helper
@@ -139,56 +375,146 @@ def find_nearest_claims(search_set, candidate_set, prune_duplicates, multimodal,
     :param cfg: configuration dictionary
     :return: none
     """
-    tweets, local_tweets, google_claims, misc_data = None, None, None, None
-    if candidate_set == 'google' or search_set == 'google':
-        google_claims = [claim.get('text') for claim in GoogleLoader.get_claim_data(cfg)]
-    if candidate_set == 'local_tweets' or search_set == 'local_tweets':
-        local_tweets = [tweet.get('full_text') for tweet in TweetLoader.get_local_tweet_data(multimodal, cfg)]
-    if candidate_set == 'tweets' or search_set == 'tweets':
-        tweets = TweetLoader.get_tweet_data(multimodal, cfg)
-    if candidate_set == 'ng' or search_set == 'ng':
-        ng_data = [ng.get('description') for ng in NewsGuardLoader.get_ng_data(cfg)]
-    if candidate_set == 'misc_json' or search_set == 'misc_json':
-        misc_data = [misc_point.get('content') for misc_point in MiscLoader.get_json_data(cfg)]
-
-    candidate_docs = None
-    if candidate_set == 'google':
-        candidate_docs = google_claims
-    elif candidate_set == 'tweets':
-        candidate_docs = tweets
-    elif candidate_set == 'local_tweets':
-        candidate_docs = local_tweets
-    elif candidate_set == 'ng':
-        candidate_docs = ng_data
-    elif candidate_set == 'misc_json':
-        candidate_docs = misc_data
-    if prune_duplicates:
-        print("Pruning duplicate from", len(candidate_docs), "candidate documents...")
-        candidate_docs = make_list_unique(candidate_docs)
-
-    search_docs = None
-    if search_set == 'google':
-        search_docs = google_claims
-    elif search_set == 'tweets':
-        search_docs = tweets
-    elif search_set == 'local_tweets':
-        search_docs = local_tweets
-    elif search_set == 'ng':
-        search_docs = ng_data
-    elif search_set == 'manual':
-        search_docs = cfg['sentences']
-    elif search_set == 'misc_json':
-        search_docs = misc_data
-    if prune_duplicates:
-        print("Pruning duplicates from", len(search_docs), "search documents...")
-        search_docs = make_list_unique(search_docs)
+    search_docs, candidate_docs = load_sets(search_set, candidate_set, prune_duplicates, multimodal, cfg)
 
     keyword_matches = []
     if filter:
         print("Filtering", len(search_docs), "search documents...")
-        filter_words = get_filtering_words(candidate_docs, cfg)
-        search_docs, keyword_matches = filter_documents(search_docs, filter_words)
+        with METRICS.stage('filter', set=search_set) as counts:
+            filter_words = get_filtering_words(candidate_docs, cfg)
+            num_docs = len(search_docs)
+            search_docs, keyword_matches = filter_documents(search_docs, filter_words, cfg.get('filter_workers', 1))
+            counts.update({'documents': len(search_docs), 'dropped': num_docs - len(search_docs)})
+
+    clusters = None
+    if cfg.get('collapse_near_duplicates') and search_set != candidate_set and len(search_docs):
+        print("Collapsing near-duplicates in", len(search_docs), "search documents...")
+        started = time.time()
+        with METRICS.stage('collapse', set=search_set) as counts:
+            clusters = collapse_near_duplicates(search_docs, cfg)
+            counts.update({'documents': len(clusters[0]), 'dropped': len(search_docs) - len(clusters[0])})
+        collapse_seconds = time.time() - started
 
     print("Retrieving nearest with", len(search_docs), "search documents and", len(candidate_docs),
           "candidate documents.")
-    retrieve_nearest(search_docs, candidate_docs, keyword_matches, search_set, candidate_set, cfg)
+    search_seconds = retrieve_nearest(search_docs, candidate_docs, keyword_matches, search_set, candidate_set, cfg,
+                                      index_report, clusters)
+    if clusters is not None:
+        num_clusters = len(clusters[0])
+        saved_seconds = search_seconds / num_clusters * (len(search_docs) - num_clusters) - collapse_seconds
+        print("Collapsed", len(search_docs), "search documents into", num_clusters, "clusters (collapse ratio",
+              str(round(len(search_docs) / num_clusters, 2)) + "x) in", round(collapse_seconds, 2),
+              "seconds, saving an estimated", round(saved_seconds, 2), "seconds of encoding and matching.")
+    report_metrics(cfg)
+
+
+def report_metrics(cfg):
+    """
+    Prints the run's stage timings and writes them to the configured Prometheus text file.
+
+    :param cfg: configuration dictionary
+    :return: none
+    """
+    METRICS.summary()
+    if cfg.get('metrics_file'):
+        METRICS.write_prometheus(cfg['metrics_file'])
+
+
+def stream_nearest_claims(candidate_set, prune_duplicates, multimodal, filter, cfg):
+    """
+    Finds and prints the nearest claims for database tweets without holding the whole tweet table in memory.
+    Tweets are fetched in chunks from a server-side cursor, and each chunk is filtered, encoded, matched and
+    written before the next one is fetched.
+
+    :param candidate_set: string denoting what data to use for the candidate set
+    :param prune_duplicates: boolean denoting whether or not to remove duplicates from the search and candidate sets
+    :param multimodal: boolean denoting whether or not multimodal data should be used
+    :param filter: boolean denoting whether or not the tweets should be filtered with words from the candidate set
+    :param cfg: configuration dictionary
+    :return: none
+    """
+    search_set = 'tweets'
+    if candidate_set == search_set:
+        print("Streaming requires a candidate set other than tweets, please choose another candidate set.")
+        sys.exit(1)
+    if cfg.get('lexical_shortlist', 0) > 0:
+        print("Warning: lexical_shortlist is ignored when streaming, every candidate is searched through the index.")
+    candidate_docs = load_documents(candidate_set, multimodal, cfg, prune_duplicates)
+    if prune_duplicates:
+        print("Pruning duplicate from", len(candidate_docs), "candidate documents...")
+        candidate_docs = prune_documents(candidate_docs, candidate_set)
+    filter_words = get_filtering_words(candidate_docs, cfg) if filter else None
+
+    with EncoderPool(cfg['model'], cfg) as encoder:
+        encode = get_encoder(encoder, cfg)
+        index = index_candidate_set(candidate_docs, candidate_set, encode, cfg)
+        try:
+            num_tweets, num_written = match_streamed_tweets(index, encode, candidate_docs, candidate_set,
+                                                            prune_duplicates, multimodal, filter_words, cfg)
+        finally:
+            close_index(index)
+    print("Done streaming", num_tweets, "tweets,", num_written, "matched against", len(candidate_docs),
+          "candidate documents.")
+    report_metrics(cfg)
+
+
+def match_streamed_tweets(index, encode, candidate_docs, candidate_set, prune_duplicates, multimodal, filter_words,
+                          cfg):
+    """
+    Streams the database tweets in chunks and matches and writes each chunk before the next one is fetched.
+
+    :param index: index over the candidate set
+    :param encode: function that maps a list of documents to their embeddings
+    :param candidate_docs: list of all documents in the candidate set
+    :param candidate_set: string denoting what data to use for the candidate set
+    :param prune_duplicates: boolean denoting whether or not to remove duplicate tweets
+    :param multimodal: boolean denoting whether or not multimodal data should be used
+    :param filter_words: words to filter the tweets with, or None to match every tweet
+    :param cfg: configuration dictionary
+    :return: the number of streamed tweets and the number of tweets matched
+    """
+    search_set = 'tweets'
+    # duplicates are pruned against a bounded window of recently streamed tweets rather than the whole table
+    seen = LRUSet(cfg.get('stream_dedup_window', DEFAULT_DEDUP_WINDOW))
+    num_tweets, num_written = 0, 0
+    chunks = import_loader('tweets').iter_tweet_data(multimodal, cfg)
+    with MatchWriter(search_set, candidate_set, candidate_docs, cfg) as writer:
+        while True:
+            with METRICS.stage('load', set=search_set) as counts:
+                search_docs = next(chunks, None)
+                counts['documents'] = len(search_docs or [])
+            if search_docs is None:
+                break
+            num_tweets += len(search_docs)
+            if prune_duplicates:
+                with METRICS.stage('prune', set=search_set) as counts:
+                    # only 64 bits of the hashes of previous chunks are kept to prune duplicates across chunks
+                    unique_docs = [doc for doc in make_list_unique(search_docs)
+                                   if seen.add(int(hash_text(doc)[:16], 16))]
+                    counts.update({'documents': len(unique_docs), 'dropped': len(search_docs) - len(unique_docs)})
+                search_docs = unique_docs
+            matches = [None] * len(search_docs)
+            if filter_words is not None:
+                with METRICS.stage('filter', set=search_set) as counts:
+                    num_docs = len(search_docs)
+                    search_docs, matches = filter_documents(search_docs, filter_words,
+                                                            cfg.get('filter_workers', 1))
+                    counts.update({'documents': len(search_docs), 'dropped': num_docs - len(search_docs)})
+            if len(search_docs) == 0:
+                continue
+            with METRICS.stage('encode', set=search_set) as counts:
+                search_embeddings = encode(search_docs)
+                counts['documents'] = len(search_docs)
+            with METRICS.stage('search', set=search_set) as counts:
+                all_distances, all_indices = index_top_matches(index, search_embeddings, search_set, candidate_set,
+                                                               cfg)
+                counts['documents'] = len(search_docs)
+            with METRICS.stage('write', set=search_set) as counts:
+                writer.write(search_docs, matches, all_distances, all_indices)
+                counts['documents'] = len(search_docs)
+            num_written += len(search_docs)
+            print("Matched", num_written, "of", num_tweets, "streamed tweets...")
+            if cfg.get('metrics_file'):
+                # long streams keep their metrics file current rather than only writing it at the end
+                METRICS.write_prometheus(cfg['metrics_file'])
+    return num_tweets, num_written
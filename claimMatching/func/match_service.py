@@ -0,0 +1,334 @@
+"""
+This file contains a long-running HTTP service for the claim matcher.
+The SBERT model and the encoded candidate set stay resident in memory,
+so matching a handful of texts only costs encoding those texts and a
+search of the candidate index. The candidate set is reloaded when its
+source files change.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json, os, threading, time
+
+from func.batch_scheduler import MicroBatcher
+from func.embedding_cache import EmbeddingCache
+from func.encoder_pool import EncoderPool, get_model_name
+from func.match_claims import index_candidate_set, load_documents
+from func.metrics import METRICS
+from func.util import make_list_unique
+
+DEFAULT_MAX_K = 100
+DEFAULT_MAX_TEXTS = 1000
+
+
+def get_source_paths(candidate_set, cfg):
+    """
+    Helper function that lists the directories holding a candidate set's source files.
+
+    :param candidate_set: string denoting what data to use for the candidate set
+    :param cfg: configuration dictionary
+    :return: list of directories to watch for changes
+    """
+    if candidate_set == 'google':
+        return [os.path.join(cfg['google_dir'], language) for language in cfg['languages']]
+    elif candidate_set == 'ng':
+        return [cfg['ng_dir']]
+    elif candidate_set == 'misc_json':
+        return [cfg['json_dir']]
+    elif candidate_set == 'local_tweets':
+        return [cfg['tweet_dir']]
+    return []
+
+
+def snapshot_sources(paths):
+    """
+    Records the name, size and modification time of every file in the watched directories.
+
+    :param paths: list of directories
+    :return: a sorted list of (path, size, mtime) tuples
+    """
+    snapshot = []
+    for path in paths:
+        if not os.path.isdir(path):
+            continue
+        for file in os.listdir(path):
+            file_path = os.path.join(path, file)
+            if os.path.isfile(file_path):
+                stat = os.stat(file_path)
+                snapshot.append((file_path, stat.st_size, stat.st_mtime))
+    return sorted(snapshot)
+
+
+def parse_match_request(body, cfg):
+    """
+    Validates the body of a match request.
+
+    :param body: decoded JSON body of the request
+    :param cfg: configuration dictionary
+    :return: the list of texts to match and the number of matches per text
+    """
+    if not isinstance(body, dict):
+        raise ValueError('the request body must be a JSON object')
+    texts = body.get('texts')
+    if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+        raise ValueError('texts must be a list of strings')
+    max_texts = cfg.get('service_max_texts', DEFAULT_MAX_TEXTS)
+    if len(texts) > max_texts:
+        raise ValueError('at most ' + str(max_texts) + ' texts can be matched per request')
+    k = body.get('k')
+    if k is None:
+        k = cfg['num_matches']
+    max_k = cfg.get('service_max_k', DEFAULT_MAX_K)
+    # bool is a subclass of int, but true is not a number of matches
+    if not isinstance(k, int) or isinstance(k, bool) or not 1 <= k <= max_k:
+        raise ValueError('k must be an integer between 1 and ' + str(max_k))
+    return texts, k
+
+
+class CandidateState:
+    """
+    Immutable snapshot of a loaded candidate set and its index. Reloading builds a new state and swaps it in.
+    """
+
+    def __init__(self, candidate_set, encode_fn, prune_duplicates, cfg):
+        self.snapshot = snapshot_sources(get_source_paths(candidate_set, cfg))
+        start = time.time()
+        candidate_docs = load_documents(candidate_set, False, cfg, prune_duplicates)
+        if prune_duplicates:
+            candidate_docs = make_list_unique(candidate_docs)
+        if cfg.get('use_embedding_cache'):
+            cache = EmbeddingCache(get_model_name(cfg['model'], cfg), cfg)
+            cached_encode_fn = lambda documents: cache.encode(documents, encode_fn)
+        else:
+            cached_encode_fn = encode_fn
+        self.candidate_docs = candidate_docs
+        # the service searches its candidates in process, since a state swapped out on reload could still be
+        # serving requests when its shard workers would have to be stopped
+        self.index = index_candidate_set(candidate_docs, candidate_set, cached_encode_fn, dict(cfg, num_shards=0))
+        self.loaded_at = time.time()
+        self.load_seconds = self.loaded_at - start
+
+
+class MatchService:
+    """
+    Keeps the model and the candidate index resident and answers top-k match requests.
+    """
+
+    def __init__(self, candidate_set, prune_duplicates, cfg):
+        self.candidate_set = candidate_set
+        self.prune_duplicates = prune_duplicates
+        self.cfg = cfg
+        # requests are small, so the model is kept in the service's process rather than in a worker pool
+        self.encode_fn = EncoderPool(cfg['model'], dict(cfg, encode_workers=1)).encode
+        self.reload_lock = threading.Lock()
+        # requests are handled in concurrent threads, which update the counts under this lock
+        self.counts_lock = threading.Lock()
+        self.num_requests = 0
+        self.num_texts = 0
+        self.batcher = None
+        if cfg.get('service_batching', True):
+            self.batcher = MicroBatcher(self.search, cfg.get('max_batch_size', 64),
+                                        cfg.get('max_batch_wait_ms', 5)).start()
+        if cfg.get('lexical_shortlist', 0) > 0:
+            print("Warning: lexical_shortlist is ignored by the service, every candidate is searched through the "
+                  "index.")
+        print("Loading", candidate_set, "candidate set...")
+        self.state = CandidateState(candidate_set, self.encode_fn, prune_duplicates, cfg)
+        print("Loaded", len(self.state.candidate_docs), "candidates in", round(self.state.load_seconds, 2), "seconds.")
+
+    def close(self):
+        """
+        Stops the batching scheduler, if there is one.
+
+        :return: none
+        """
+        if self.batcher:
+            self.batcher.close()
+
+    def match(self, texts, k=None):
+        """
+        Finds the nearest candidates for each text. With batching enabled, the texts are encoded and searched
+        together with those of concurrent requests.
+
+        :param texts: list of string documents
+        :param k: number of matches per text, defaults to num_matches
+        :return: a list with each text's matches, closest first
+        """
+        if k is None:
+            k = self.cfg['num_matches']
+        with self.counts_lock:
+            self.num_requests += 1
+            self.num_texts += len(texts)
+        if len(texts) == 0:
+            return []
+        if self.batcher:
+            return self.batcher.match(texts, k)
+        return self.search(texts, k)
+
+    def search(self, texts, k):
+        """
+        Encodes texts and searches the candidate index for them.
+
+        :param texts: list of string documents
+        :param k: number of matches per text
+        :return: a list with each text's matches, closest first
+        """
+        state = self.state
+        with METRICS.stage('encode', set='service') as counts:
+            embeddings = self.encode_fn(texts)
+            counts['documents'] = len(texts)
+        with METRICS.stage('search', set='service') as counts:
+            distances, indices = state.index.search(embeddings, k)
+            counts['documents'] = len(texts)
+        results = []
+        for row_distances, row_indices in zip(distances, indices):
+            results.append([{'candidate_id': int(index), 'distance': float(distance),
+                             'text': str(state.candidate_docs[index])}
+                            for distance, index in zip(row_distances, row_indices) if index >= 0])
+        return results
+
+    def reload(self, force=False):
+        """
+        Rebuilds the candidate state if its source files changed, keeping the old state in service meanwhile.
+
+        :param force: boolean denoting whether to reload even if no source file changed
+        :return: whether or not the candidate set was reloaded
+        """
+        with self.reload_lock:
+            paths = get_source_paths(self.candidate_set, self.cfg)
+            if not force and snapshot_sources(paths) == self.state.snapshot:
+                return False
+            print("Candidate files changed, reloading", self.candidate_set, "candidate set...")
+            self.state = CandidateState(self.candidate_set, self.encode_fn, self.prune_duplicates, self.cfg)
+            print("Reloaded", len(self.state.candidate_docs), "candidates in", round(self.state.load_seconds, 2),
+                  "seconds.")
+            return True
+
+    def watch(self, interval):
+        """
+        Polls the candidate source files and reloads when they change. Runs in a daemon thread.
+
+        :param interval: seconds between polls
+        :return: none
+        """
+        while True:
+            time.sleep(interval)
+            try:
+                self.reload()
+            except Exception as e:
+                print("Failed to reload candidate set -", e)
+
+    def prometheus_text(self):
+        """
+        :return: the service's stage metrics and current state in the Prometheus text format
+        """
+        METRICS.set('service_candidates', len(self.state.candidate_docs), set=self.candidate_set)
+        METRICS.set('service_requests', self.num_requests)
+        METRICS.set('service_texts', self.num_texts)
+        if self.batcher:
+            for key, value in self.batcher.metrics().items():
+                if not isinstance(value, dict):
+                    METRICS.set('service_batch_' + key, value)
+        return METRICS.prometheus_text()
+
+    def stats(self):
+        """
+        :return: a dictionary describing the service's candidate set and request counts
+        """
+        return {'model': self.cfg['model'], 'candidate_set': self.candidate_set,
+                'num_candidates': len(self.state.candidate_docs), 'index_type': self.state.index.index_type,
+                'loaded_at': self.state.loaded_at, 'num_requests': self.num_requests, 'num_texts': self.num_texts,
+                'batching': self.batcher.metrics() if self.batcher else None}
+
+
+class MatchServer(ThreadingHTTPServer):
+    # the default backlog of 5 drops connections when many clients connect at once
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def make_handler(service):
+    """
+    Creates the HTTP request handler for a service.
+
+    :param service: the MatchService answering requests
+    :return: a BaseHTTPRequestHandler subclass
+    """
+    class MatchHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # headers and body are written separately, so Nagle's algorithm would delay every keep-alive response
+        disable_nagle_algorithm = True
+
+        def send_json(self, status, body):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def read_json(self):
+            length = int(self.headers.get('Content-Length', 0))
+            return json.loads(self.rfile.read(length) or b'{}')
+
+        def do_GET(self):
+            if self.path == '/health':
+                self.send_json(200, service.stats())
+            elif self.path == '/metrics':
+                payload = service.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+            else:
+                self.send_json(404, {'error': 'unknown path ' + self.path})
+
+        def do_POST(self):
+            try:
+                if self.path == '/match':
+                    try:
+                        texts, k = parse_match_request(self.read_json(), service.cfg)
+                    except ValueError as e:
+                        self.send_json(400, {'error': str(e)})
+                        return
+                    self.send_json(200, {'results': service.match(texts, k)})
+                elif self.path == '/reload':
+                    self.send_json(200, {'reloaded': service.reload(force=True)})
+                else:
+                    self.send_json(404, {'error': 'unknown path ' + self.path})
+            except Exception as e:
+                # any other failure still answers the client instead of dropping the connection
+                print("Failed to answer", self.path, "request -", repr(e))
+                self.send_json(500, {'error': 'internal error: ' + str(e)})
+
+        def log_message(self, format, *args):
+            if service.cfg.get('service_log_requests'):
+                BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    return MatchHandler
+
+
+def serve(candidate_set, prune_duplicates, cfg):
+    """
+    Loads the candidate set and serves match requests until interrupted.
+
+    :param candidate_set: string denoting what data to use for the candidate set
+    :param prune_duplicates: boolean denoting whether or not to remove duplicates from the candidate set
+    :param cfg: configuration dictionary
+    :return: none
+    """
+    service = MatchService(candidate_set, prune_duplicates, cfg)
+    # load the model now rather than on the first request
+    service.encode_fn(["warm up"])
+    interval = cfg.get('service_reload_interval', 60)
+    if interval and get_source_paths(candidate_set, cfg):
+        threading.Thread(target=service.watch, args=(interval,), daemon=True).start()
+    host, port = cfg.get('service_host', '127.0.0.1'), cfg.get('service_port', 8765)
+    server = MatchServer((host, port), make_handler(service))
+    print("Serving", candidate_set, "matches on http://" + host + ":" + str(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
@@ -0,0 +1,216 @@
+"""
+This file contains the writers for the claim matcher's output. Besides
+the human-readable text report, matches can be written as structured
+JSONL or Parquet records that reference candidates by id, with each
+candidate's text stored only once per run.
+"""
+from datetime import datetime
+import os, sys
+
+import numpy as np
+import orjson
+
+OUTPUT_FORMATS = ['txt', 'jsonl', 'parquet']
+BUFFER_SIZE = 1024 * 1024
+
+
+def import_pyarrow():
+    """
+    Helper function that imports pyarrow for Parquet output, exiting with instructions if it is missing.
+
+    :return: the pyarrow and pyarrow.parquet modules
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        print("Parquet output requires pyarrow, please run pip install pyarrow or remove parquet from "
+              "output_formats.")
+        sys.exit(1)
+    return pa, pq
+
+
+def write_search_doc_output(file, search_doc, candidate_docs, match, distances, low_indices):
+    """
+    Helper function to write output for matches to each document in the search set.
+
+    :param file: file to output to
+    :param search_doc: document from the search set
+    :param candidate_docs: all candidate documents
+    :param match: matching keywords
+    :param distances: distances to each nearby candidate, in the same order as low_indices
+    :param low_indices: indices of each nearby candidate
+    :return: none
+    """
+    file.write("Search set item:\n")
+    file.write(search_doc.replace('\n', ' ') + '\n')
+    file.write("----------------------------\n")
+    if match:
+        file.write("Matching keywords: " + str(match) + '\n')
+    file.write("Distances to candidate: " + str(distances) + '\n')
+    file.write("Top candidate set matches (high to low): \n")
+    for dist in low_indices:
+        file.write("- " + str(candidate_docs[dist]).replace('\n', ' ') + '\n')
+    file.write("\n")
+
+
+class MatchWriter:
+    """
+    Writes the matches of a run in every configured output format. Matches can be written in several batches,
+    and search documents are numbered across batches.
+    """
+
+    def __init__(self, search_set, candidate_set, candidate_docs, cfg):
+        self.candidate_docs = candidate_docs
+        self.formats = cfg.get('output_formats', ['txt'])
+        for output_format in self.formats:
+            if output_format not in OUTPUT_FORMATS:
+                print("Unknown output format", output_format, "in config, please use any of", OUTPUT_FORMATS)
+                sys.exit(1)
+        if not os.path.exists((cfg['output_dir'])):
+            cwd = os.getcwd()
+            os.mkdir(os.path.join(cwd,cfg['output_dir']))
+        self.stem = os.path.join(cfg['output_dir'], search_set + '-' + candidate_set + '-' +
+                                 datetime.now().strftime("%m%d%y-%H%M%S"))
+        self.metadata = {'model': cfg['model'], 'search_set': search_set, 'candidate_set': candidate_set,
+                         'languages': cfg['languages'], 'num_matches': cfg['num_matches'],
+                         'index_type': cfg.get('index_type', 'exact'), 'created': datetime.now().isoformat()}
+        self.num_searched = 0
+        self.written_candidates = set()
+        self.files = {}
+        self.columns = {}
+        self.parquet_writers = {}
+
+        if 'txt' in self.formats:
+            f = open(self.stem + '.txt', 'w', buffering=BUFFER_SIZE)
+            f.write("Model: " + cfg['model'] + "\n")
+            f.write("Search Set: " + search_set + "\n")
+            f.write("Candidate Set: " + candidate_set + "\n")
+            f.write("Languages: " + str(cfg['languages']) + "\n\n")
+            self.files['txt'] = f
+        if 'jsonl' in self.formats:
+            self.files['matches'] = open(self.stem + '.matches.jsonl', 'wb', buffering=BUFFER_SIZE)
+            self.files['candidates'] = open(self.stem + '.candidates.jsonl', 'wb', buffering=BUFFER_SIZE)
+        if 'parquet' in self.formats:
+            self.open_parquet()
+
+    def open_parquet(self):
+        """
+        Opens the Parquet matches and candidates files, which receive one row group per written batch. Ranks are
+        implied by the order of each row's candidate ids.
+
+        :return: none
+        """
+        pa, pq = import_pyarrow()
+        self.schemas = {
+            'matches': pa.schema([('search_id', pa.int64()), ('search_text', pa.string()),
+                                  ('keywords', pa.list_(pa.string())), ('candidate_ids', pa.list_(pa.int64())),
+                                  ('distances', pa.list_(pa.float64()))],
+                                 metadata={key: str(value) for key, value in self.metadata.items()}),
+            'candidates': pa.schema([('candidate_id', pa.int64()), ('text', pa.string())])}
+        for table, schema in self.schemas.items():
+            self.parquet_writers[table] = pq.ParquetWriter(self.stem + '.' + table + '.parquet', schema)
+        self.reset_columns()
+
+    def reset_columns(self):
+        """
+        Empties the Parquet columns buffered for the current batch.
+
+        :return: none
+        """
+        self.columns = {'matches': {name: [] for name in self.schemas['matches'].names},
+                        'candidates': {name: [] for name in self.schemas['candidates'].names}}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, search_docs, matches, all_distances, all_indices):
+        """
+        Writes the matches for a batch of search set documents.
+
+        :param search_docs: list of search set documents in the batch
+        :param matches: list of the batch's matching keywords
+        :param all_distances: distances to each document's nearby candidates
+        :param all_indices: indices of each document's nearby candidates
+        :return: none
+        """
+        for search_doc, match, distances, low_indices in zip(search_docs, matches, all_distances, all_indices):
+            # approximate indices mark missing neighbours with -1
+            found = low_indices >= 0
+            distances, low_indices = distances[found], low_indices[found]
+            if 'txt' in self.files:
+                write_search_doc_output(self.files['txt'], search_doc, self.candidate_docs, match, distances,
+                                        low_indices)
+            self.write_record(search_doc, match, distances, low_indices)
+            self.num_searched += 1
+        if self.parquet_writers:
+            self.write_parquet()
+
+    def write_record(self, search_doc, match, distances, low_indices):
+        """
+        Adds the structured record of one search document's matches, along with any candidates not yet written.
+
+        :param search_doc: document from the search set
+        :param match: matching keywords
+        :param distances: distances to each nearby candidate
+        :param low_indices: indices of each nearby candidate
+        :return: none
+        """
+        if 'matches' not in self.files and not self.columns:
+            return
+        candidate_ids = [int(index) for index in low_indices]
+        new_candidates = [index for index in candidate_ids if index not in self.written_candidates]
+        self.written_candidates.update(new_candidates)
+        if 'matches' in self.files:
+            self.files['matches'].write(orjson.dumps({
+                'search_id': self.num_searched, 'search_text': search_doc, 'keywords': match or [],
+                'matches': [{'rank': rank + 1, 'candidate_id': index, 'distance': float(distance)}
+                            for rank, (index, distance) in enumerate(zip(candidate_ids, distances))]}) + b'\n')
+            for index in new_candidates:
+                self.files['candidates'].write(orjson.dumps({'candidate_id': index,
+                                                             'text': str(self.candidate_docs[index])}) + b'\n')
+        if self.columns:
+            matches = self.columns['matches']
+            matches['search_id'].append(self.num_searched)
+            matches['search_text'].append(search_doc)
+            matches['keywords'].append(list(match or []))
+            matches['candidate_ids'].append(candidate_ids)
+            matches['distances'].append(np.asarray(distances, dtype=np.float64).tolist())
+            self.columns['candidates']['candidate_id'].extend(new_candidates)
+            self.columns['candidates']['text'].extend(str(self.candidate_docs[index]) for index in new_candidates)
+
+    def write_parquet(self):
+        """
+        Writes the current batch's columns as a row group of the matches and candidates files, so that only one
+        batch of rows is held in memory at a time.
+
+        :return: none
+        """
+        pa, _ = import_pyarrow()
+        for table, writer in self.parquet_writers.items():
+            columns = self.columns[table]
+            if len(next(iter(columns.values()))) > 0:
+                writer.write_table(pa.table(columns, schema=self.schemas[table]))
+        self.reset_columns()
+
+    def close(self):
+        """
+        Flushes every output and writes the run's metadata.
+
+        :return: none
+        """
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        for writer in self.parquet_writers.values():
+            writer.close()
+        self.parquet_writers = {}
+        self.columns = {}
+        if any(output_format != 'txt' for output_format in self.formats):
+            self.metadata['num_searched'] = self.num_searched
+            self.metadata['num_candidates'] = len(self.candidate_docs)
+            with open(self.stem + '.run.json', 'wb') as f:
+                f.write(orjson.dumps(self.metadata, option=orjson.OPT_INDENT_2))
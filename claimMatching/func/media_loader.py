@@ -0,0 +1,260 @@
+"""
+This file contains the batched multimodal pipeline used to caption
+tweet media. Image URLs for a whole chunk of tweets are looked up at
+once, the images are downloaded concurrently over a pooled HTTP
+session, and OCR is fanned out over a pool of worker processes.
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+import json
+
+from PIL import Image
+import pytesseract
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from func.caption_cache import CaptionCache, hash_image
+from func.metrics import METRICS
+
+DEFAULT_MEDIA_CFG = {
+    'media_download_workers': 16,
+    'media_timeout': 10,
+    'media_retries': 3,
+    'ocr_workers': 4,
+}
+
+
+def get_media_cfg(cfg, key):
+    """
+    Helper function that reads a multimodal setting, falling back to its default.
+
+    :param cfg: configuration dictionary, may be None
+    :param key: name of the setting
+    :return: the configured value
+    """
+    if cfg is None:
+        return DEFAULT_MEDIA_CFG[key]
+    return cfg.get(key, DEFAULT_MEDIA_CFG[key])
+
+
+def get_session(cfg):
+    """
+    Creates an HTTP session with a connection pool sized to the download workers, retrying failed requests with
+    exponential backoff.
+
+    :param cfg: configuration dictionary
+    :return: a requests session
+    """
+    workers = get_media_cfg(cfg, 'media_download_workers')
+    retries = Retry(total=get_media_cfg(cfg, 'media_retries'), backoff_factor=0.5,
+                    status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=retries)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def download_image(session, image_url, timeout):
+    """
+    Downloads the raw bytes of a single image.
+
+    :param session: requests session to download with
+    :param image_url: url of the image
+    :param timeout: seconds to wait for the server before giving up
+    :return: the image's bytes, or None if it could not be downloaded
+    """
+    try:
+        response = session.get(image_url, timeout=timeout)
+        response.raise_for_status()
+        return response.content
+    except requests.RequestException as e:
+        print("Failed to fetch image", image_url, "-", e)
+        return None
+
+
+def download_images(image_urls, cfg):
+    """
+    Downloads images concurrently over a pooled session.
+
+    :param image_urls: list of unique image urls
+    :param cfg: configuration dictionary
+    :return: a dictionary mapping each url to its bytes, or None if the download failed
+    """
+    if len(image_urls) == 0:
+        return {}
+    timeout = get_media_cfg(cfg, 'media_timeout')
+    with METRICS.stage('download') as counts:
+        with get_session(cfg) as session:
+            with ThreadPoolExecutor(max_workers=get_media_cfg(cfg, 'media_download_workers')) as pool:
+                contents = dict(zip(image_urls, pool.map(lambda url: download_image(session, url, timeout),
+                                                         image_urls)))
+        failed = sum(1 for data in contents.values() if data is None)
+        counts.update({'documents': len(image_urls) - failed, 'dropped': failed})
+    return contents
+
+
+def caption_image(image):
+    # ocr captioning
+    ocr_caption = pytesseract.image_to_string(image)
+
+    # image captioning
+    # print(os.popen("th").read())
+    image_caption = ""
+
+    return ocr_caption + image_caption
+
+
+def caption_image_bytes(image_bytes):
+    """
+    Captions an image given its raw bytes. Defined at module level so it can run in a worker process.
+
+    :param image_bytes: the image's bytes
+    :return: the caption for the image, or None if the image could not be read or OCR'd
+    """
+    try:
+        return caption_image(Image.open(BytesIO(image_bytes)))
+    except (OSError, pytesseract.TesseractError) as e:
+        print("Failed to caption image -", e)
+        return None
+
+
+def create_ocr_pool(cfg):
+    """
+    Creates the pool of worker processes that runs OCR, so that a whole load can share one pool across its batches.
+
+    :param cfg: configuration dictionary
+    :return: a process pool, or None if OCR runs in the main process
+    """
+    ocr_workers = get_media_cfg(cfg, 'ocr_workers')
+    return ProcessPoolExecutor(max_workers=ocr_workers) if ocr_workers > 1 else None
+
+
+def ocr_images(images, cfg, ocr_pool=None):
+    """
+    Captions images, running OCR across a pool of worker processes.
+
+    :param images: dictionary mapping keys to image bytes
+    :param cfg: configuration dictionary
+    :param ocr_pool: process pool to run OCR in, a pool is created for this call alone if none is given
+    :return: a dictionary mapping the same keys to captions, None for images that failed
+    """
+    keys = list(images.keys())
+    with METRICS.stage('ocr') as counts:
+        if ocr_pool is not None and len(keys) > 1:
+            captions = dict(zip(keys, ocr_pool.map(caption_image_bytes, [images[key] for key in keys])))
+        elif ocr_pool is None and get_media_cfg(cfg, 'ocr_workers') > 1 and len(keys) > 1:
+            with create_ocr_pool(cfg) as pool:
+                captions = dict(zip(keys, pool.map(caption_image_bytes, [images[key] for key in keys])))
+        else:
+            captions = {key: caption_image_bytes(images[key]) for key in keys}
+        counts['documents'] = len(keys)
+    return captions
+
+
+def caption_urls(image_urls, cfg, ocr_pool=None):
+    """
+    Downloads and captions every unique image url. When the caption cache is enabled, urls that were captioned
+    before are not downloaded, and downloaded images whose bytes were captioned before are not OCR'd again.
+
+    :param image_urls: list of image urls, may contain duplicates
+    :param cfg: configuration dictionary
+    :param ocr_pool: process pool to run OCR in, or None to create one per call
+    :return: a dictionary mapping each url to its caption, empty for images that failed to download or caption
+    """
+    unique_urls = list(dict.fromkeys(url for url in image_urls if url))
+    captions = {url: "" for url in unique_urls}
+    if cfg is None or not cfg.get('use_caption_cache'):
+        images = download_images(unique_urls, cfg)
+        new_captions = ocr_images({url: data for url, data in images.items() if data}, cfg, ocr_pool)
+        captions.update({url: caption for url, caption in new_captions.items() if caption is not None})
+        return captions
+
+    with CaptionCache(cfg) as cache:
+        cached = cache.get_by_urls(unique_urls)
+        captions.update(cached)
+        images = download_images([url for url in unique_urls if url not in cached], cfg)
+        url_hashes = {url: hash_image(data) for url, data in images.items() if data}
+        hash_captions = cache.get_by_hashes(list(dict.fromkeys(url_hashes.values())))
+        new_images = {image_hash: images[url] for url, image_hash in url_hashes.items()
+                      if image_hash not in hash_captions}
+        # failed captions are left out of the cache so the images are captioned again on the next run
+        new_captions = {image_hash: caption for image_hash, caption in ocr_images(new_images, cfg, ocr_pool).items()
+                        if caption is not None}
+        hash_captions.update(new_captions)
+        url_hashes = {url: image_hash for url, image_hash in url_hashes.items() if image_hash in hash_captions}
+        for url, image_hash in url_hashes.items():
+            captions[url] = hash_captions[image_hash]
+        cache.put(url_hashes, new_captions)
+        stats = cache.stats()
+    print("Caption cache:", stats['url_hits'], "url hits,", stats['hash_hits'], "image hits,", stats['misses'],
+          "images captioned.")
+    return captions
+
+
+def get_db_media_urls(cursor, media_id_lists):
+    """
+    Looks up the image url of every tweet in a chunk with a single query.
+
+    :param cursor: cursor to execute SQL queries for connected to Mona's DB
+    :param media_id_lists: list of JSON-encoded lists of media ids, one per tweet
+    :return: a list with the url of each tweet's first media item, or None for tweets without media
+    """
+    media_id_lists = [json.loads(media_ids) if media_ids else [] for media_ids in media_id_lists]
+    all_ids = list(dict.fromkeys(media_id for media_ids in media_id_lists for media_id in media_ids))
+    if len(all_ids) == 0:
+        return [None] * len(media_id_lists)
+    query = "select id, media_url_https from media where id IN %s"
+    cursor.execute(query, (tuple(all_ids),))
+    id_urls = {str(media_id): url for media_id, url in cursor.fetchall()}
+    tweet_urls = []
+    for media_ids in media_id_lists:
+        urls = [id_urls[str(media_id)] for media_id in media_ids if str(media_id) in id_urls]
+        tweet_urls.append(urls[0] if urls else None)
+    return tweet_urls
+
+
+def caption_db_tweets(cursor, media_id_lists, cfg, ocr_pool=None):
+    """
+    Captions the media of a chunk of database tweets.
+
+    :param cursor: cursor to execute SQL queries for connected to Mona's DB
+    :param media_id_lists: list of JSON-encoded lists of media ids, one per tweet
+    :param cfg: configuration dictionary
+    :param ocr_pool: process pool to run OCR in, or None to create one per call
+    :return: a list with the caption of each tweet's media, empty for tweets without media
+    """
+    tweet_urls = get_db_media_urls(cursor, media_id_lists)
+    captions = caption_urls(tweet_urls, cfg, ocr_pool)
+    return [captions.get(url, "") if url else "" for url in tweet_urls]
+
+
+def get_local_media_url(tweet_obj):
+    """
+    :param tweet_obj: hydrated tweet dictionary
+    :return: the url of the tweet's first photo, or None if it has none
+    """
+    entities = tweet_obj.get('entities')
+    if entities:
+        media = entities.get("media")
+        if media and media[0].get('type') == 'photo':
+            return media[0].get("media_url_https")
+    return None
+
+
+def caption_local_tweets(tweets, cfg, ocr_pool=None):
+    """
+    Appends the caption of each tweet's photo to its full_text.
+
+    :param tweets: list of hydrated tweets, as dictionaries or JSON strings
+    :param cfg: configuration dictionary
+    :param ocr_pool: process pool to run OCR in, or None to create one per call
+    :return: a list of new tweet dictionaries with captioned full_text
+    """
+    tweet_objs = [dict(json.loads(tweet) if isinstance(tweet, str) else tweet) for tweet in tweets]
+    tweet_urls = [get_local_media_url(tweet_obj) for tweet_obj in tweet_objs]
+    captions = caption_urls(tweet_urls, cfg, ocr_pool)
+    for tweet_obj, url in zip(tweet_objs, tweet_urls):
+        tweet_obj["full_text"] = tweet_obj.get("full_text") + (captions.get(url, "") if url else "")
+    return tweet_objs
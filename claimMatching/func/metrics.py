@@ -0,0 +1,193 @@
+"""
+This file contains the instrumentation of the claim matcher. Pipeline
+stages are timed and their document counts recorded in a process-wide
+registry. Each stage can be logged as a JSON line and profiled with
+cProfile. The totals are exported in the Prometheus text format, to a
+file after each run or from the matching service's /metrics endpoint.
+"""
+from contextlib import contextmanager
+import cProfile, json, os, threading, time
+
+PREFIX = 'claim_matcher_'
+
+
+def format_labels(labels):
+    """
+    :param labels: dictionary of label names and values
+    :return: the labels in Prometheus exposition syntax
+    """
+    if not labels:
+        return ''
+    escaped = [key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+               for key, value in sorted(labels.items())]
+    return '{' + ','.join(escaped) + '}'
+
+
+class Metrics:
+    """
+    Registry of stage timers, document counters and gauges shared by every module of a process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profilers = {}
+        self.profiling = False
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self.log_path = None
+        self.profile_dir = None
+
+    def configure(self, cfg):
+        """
+        Sets where stages are logged and profiled.
+
+        :param cfg: configuration dictionary
+        :return: none
+        """
+        self.log_path = cfg.get('metrics_log')
+        self.profile_dir = cfg.get('profile_dir')
+        if self.profile_dir:
+            os.makedirs(self.profile_dir, exist_ok=True)
+
+    @contextmanager
+    def stage(self, name, **labels):
+        """
+        Times the code in the with block as a pipeline stage. The block may add counts, such as the number of
+        documents it kept, to the yielded dictionary. With a profile_dir, the stage is also profiled with
+        cProfile and the profile of all its runs is written to the profile_dir.
+
+        :param name: name of the stage
+        :param labels: labels that distinguish runs of the stage, e.g. the document set
+        :return: yields a dictionary for the stage's counts
+        """
+        counts = {}
+        key = (name, tuple(sorted(labels.items())))
+        profiler = None
+        if self.profile_dir:
+            with self.lock:
+                # only one profiler can be active in a process, so stages nested in or concurrent with a
+                # profiled stage are only timed
+                if not self.profiling:
+                    self.profiling = True
+                    profiler = self.profilers.setdefault(key, cProfile.Profile())
+            if profiler is not None:
+                profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            seconds = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                # repeated runs of a stage accumulate in the same profile
+                suffix = '-'.join(str(value) for _, value in key[1])
+                profiler.dump_stats(os.path.join(self.profile_dir, name + ('-' + suffix if suffix else '') + '-' +
+                                                 str(os.getpid()) + '.prof'))
+                with self.lock:
+                    self.profiling = False
+            self.record(name, labels, seconds, counts)
+
+    def record(self, name, labels, seconds, counts):
+        """
+        Adds a finished stage to the totals and logs it.
+
+        :param name: name of the stage
+        :param labels: dictionary of the stage's labels
+        :param seconds: duration of the stage
+        :param counts: dictionary of the stage's counts
+        :return: none
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            calls, total = self.stages.get(key, (0, 0.0))
+            self.stages[key] = (calls + 1, total + seconds)
+            for count_name, value in counts.items():
+                if isinstance(value, (int, float)):
+                    self.counters[(count_name, key)] = self.counters.get((count_name, key), 0) + value
+        self.log('stage', stage=name, seconds=round(seconds, 6), **labels, **counts)
+
+    def set(self, name, value, **labels):
+        """
+        :param name: name of the gauge
+        :param value: current value
+        :param labels: labels of the gauge
+        :return: none
+        """
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def log(self, event, **fields):
+        """
+        Appends a structured JSON line to the metrics log, if one is configured.
+
+        :param event: name of the event
+        :param fields: the event's fields
+        :return: none
+        """
+        if not self.log_path:
+            return
+        record = {'time': time.time(), 'event': event, 'pid': os.getpid()}
+        record.update(fields)
+        line = json.dumps(record, default=str) + '\n'
+        with self.lock:
+            with open(self.log_path, 'a') as f:
+                f.write(line)
+
+    def prometheus_text(self):
+        """
+        :return: every metric in the Prometheus text exposition format
+        """
+        lines = ['# HELP ' + PREFIX + 'stage_seconds_total Time spent in each pipeline stage.',
+                 '# TYPE ' + PREFIX + 'stage_seconds_total counter']
+        with self.lock:
+            stages = sorted(self.stages.items())
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+        for (name, labels), (_, total) in stages:
+            lines.append(PREFIX + 'stage_seconds_total' + format_labels(dict(labels, stage=name)) + ' ' + repr(total))
+        lines += ['# HELP ' + PREFIX + 'stage_runs_total Number of times each pipeline stage ran.',
+                  '# TYPE ' + PREFIX + 'stage_runs_total counter']
+        for (name, labels), (calls, _) in stages:
+            lines.append(PREFIX + 'stage_runs_total' + format_labels(dict(labels, stage=name)) + ' ' + str(calls))
+        for count_name in sorted(set(name for (name, _), _ in counters)):
+            lines.append('# TYPE ' + PREFIX + count_name + '_total counter')
+            for (name, (stage, labels)), value in counters:
+                if name == count_name:
+                    lines.append(PREFIX + name + '_total' + format_labels(dict(labels, stage=stage)) + ' ' + str(value))
+        for gauge_name in sorted(set(name for (name, _), _ in gauges)):
+            lines.append('# TYPE ' + PREFIX + gauge_name + ' gauge')
+            for (name, labels), value in gauges:
+                if name == gauge_name:
+                    lines.append(PREFIX + name + format_labels(dict(labels)) + ' ' + str(value))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """
+        Writes the metrics to a file, replacing it atomically so collectors never read a partial file.
+
+        :param path: file to write
+        :return: none
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(path + '.tmp', path)
+
+    def summary(self):
+        """
+        Prints the time spent in each stage, slowest first.
+
+        :return: none
+        """
+        with self.lock:
+            stages = sorted(self.stages.items(), key=lambda item: -item[1][1])
+        print("Stage timings:")
+        for (name, labels), (calls, total) in stages:
+            label_text = ' '.join(str(value) for _, value in labels)
+            print("  {:<10} {:<22} {:>9.3f}s over {} run(s)".format(name, label_text, total, calls))
+
+
+METRICS = Metrics()
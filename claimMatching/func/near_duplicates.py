@@ -0,0 +1,130 @@
+"""
+This file collapses near-duplicate search documents before encoding.
+Retweets and copy-paste variants that only differ by urls, mentions or
+emojis are clustered with MinHash signatures over character shingles,
+which are bucketed with locality-sensitive hashing. Only one
+representative per cluster needs to be encoded and matched.
+"""
+import re, zlib
+
+import numpy as np
+
+# hash values are kept below 2^31 so the permutations' products fit in 64 bits
+PRIME = (1 << 31) - 1
+URL_PATTERN = re.compile(r'https?://\S+|www\.\S+')
+MENTION_PATTERN = re.compile(r'(^|\s)rt\s+@\w+:?|@\w+')
+NON_WORD_PATTERN = re.compile(r'[\W_]+')
+
+
+def normalize_document(document):
+    """
+    Strips the parts of a document that differ between copies of the same text.
+
+    :param document: string document
+    :return: the lowercase document without urls, mentions, retweet markers, punctuation or emojis
+    """
+    document = URL_PATTERN.sub(' ', str(document).lower())
+    document = MENTION_PATTERN.sub(' ', document)
+    return ' '.join(NON_WORD_PATTERN.sub(' ', document).split())
+
+
+def get_shingles(document, shingle_size):
+    """
+    :param document: normalized string document
+    :param shingle_size: number of characters per shingle
+    :return: an array with the hash of every distinct character shingle of the document
+    """
+    if len(document) <= shingle_size:
+        shingles = {document}
+    else:
+        shingles = {document[i:i + shingle_size] for i in range(len(document) - shingle_size + 1)}
+    return np.array([zlib.crc32(shingle.encode('utf-8')) & PRIME for shingle in shingles], dtype=np.uint64)
+
+
+def get_minhash(shingles, a, b):
+    """
+    Computes a document's MinHash signature under a family of random linear permutations.
+
+    :param shingles: array of shingle hashes
+    :param a: array of permutation multipliers
+    :param b: array of permutation offsets
+    :return: an array with the minimum permuted hash for each permutation
+    """
+    return ((np.outer(shingles, a) + b) % PRIME).min(axis=0)
+
+
+def find_root(parents, node):
+    """
+    Finds the root of a node in a union-find forest, halving the path on the way.
+
+    :param parents: list of parent indices
+    :param node: index of the node
+    :return: index of the root
+    """
+    while parents[node] != node:
+        parents[node] = parents[parents[node]]
+        node = parents[node]
+    return node
+
+
+def collapse_near_duplicates(documents, cfg):
+    """
+    Clusters near-duplicate documents. Documents with identical normalized text always share a cluster, and
+    any two remaining texts are joined when LSH places them in a common bucket and their estimated Jaccard
+    similarity is at least near_duplicate_threshold. Clusters are closed under these joins.
+
+    :param documents: list of string documents
+    :param cfg: configuration dictionary
+    :return: a list with the index of each cluster's first document, and an array with each document's cluster
+    """
+    num_permutations = cfg.get('minhash_permutations', 128)
+    num_bands = cfg.get('lsh_bands', 32)
+    rows = num_permutations // num_bands
+    threshold = cfg.get('near_duplicate_threshold', 0.8)
+    shingle_size = cfg.get('shingle_size', 5)
+    rng = np.random.RandomState(0)
+    a = rng.randint(1, PRIME, size=num_permutations).astype(np.uint64)
+    b = rng.randint(0, PRIME, size=num_permutations).astype(np.uint64)
+
+    # exact copies after normalization are grouped first, so only distinct texts are hashed
+    text_ids = {}
+    doc_texts = np.empty(len(documents), dtype=np.int64)
+    texts = []
+    for i, document in enumerate(documents):
+        # documents that are nothing but urls and mentions are only grouped with exact copies
+        text = normalize_document(document) or '\0' + str(document)
+        if text not in text_ids:
+            text_ids[text] = len(texts)
+            texts.append(text)
+        doc_texts[i] = text_ids[text]
+
+    signatures = np.empty((len(texts), num_permutations), dtype=np.uint64)
+    for i, text in enumerate(texts):
+        signatures[i] = get_minhash(get_shingles(text, shingle_size), a, b)
+
+    # every pair of texts sharing a bucket is a candidate pair, and clusters are the connected components of the
+    # similar candidate pairs, so they do not depend on the order of the documents
+    parents = list(range(len(texts)))
+    for band in range(num_bands):
+        buckets = {}
+        band_signatures = signatures[:, band * rows:(band + 1) * rows]
+        for i in range(len(texts)):
+            if not texts[i].startswith('\0'):
+                buckets.setdefault(band_signatures[i].tobytes(), []).append(i)
+        for members in buckets.values():
+            for position, i in enumerate(members[:-1]):
+                root = find_root(parents, i)
+                # pairs that are already in the same cluster cannot change it
+                others = [j for j in members[position + 1:] if find_root(parents, j) != root]
+                if not others:
+                    continue
+                similar = np.mean(signatures[others] == signatures[i], axis=1) >= threshold
+                for j in np.asarray(others)[similar]:
+                    root, other = find_root(parents, i), find_root(parents, j)
+                    parents[max(root, other)] = min(root, other)
+
+    # texts are numbered in order of first appearance, so each root's first document is the cluster's first
+    text_roots = np.array([find_root(parents, i) for i in range(len(texts))], dtype=np.int64)
+    doc_roots = text_roots[doc_texts]
+    _, first_docs, labels = np.unique(doc_roots, return_index=True, return_inverse=True)
+    return first_docs.tolist(), labels
@@ -0,0 +1,185 @@
+"""
+This file contains a compact exact index for large candidate sets. The
+candidate embeddings are held in memory as float16, int8 or binary
+codes, which are scanned to shortlist the closest candidates of each
+query. The shortlist is then re-ranked with the full float32 embeddings,
+which stay on disk and are memory-mapped so only the shortlisted rows
+are read.
+"""
+import os, sys
+
+import numpy as np
+
+from func.similarity import DEFAULT_MEMORY_MB, normalize_embeddings, top_k_rows
+
+QUANTIZATIONS = ['none', 'float16', 'int8', 'binary']
+DEFAULT_RERANK_FACTOR = 4
+
+
+def load_vectors(vector_path, shape):
+    """
+    Memory-maps previously saved float32 embeddings.
+
+    :param vector_path: .npy path of the embeddings
+    :param shape: expected shape of the embeddings
+    :return: a read-only memory map, or None if the file is missing or does not hold float32 embeddings of the shape
+    """
+    if not os.path.isfile(vector_path):
+        return None
+    try:
+        vectors = np.load(vector_path, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    if vectors.shape != tuple(shape) or vectors.dtype != np.float32:
+        return None
+    return vectors
+
+
+def save_vectors(vectors, vector_path):
+    """
+    Saves float32 embeddings and memory-maps them. The file is replaced rather than overwritten, so other
+    processes mapping the old file are unaffected.
+
+    :param vectors: 2D float32 array of embeddings
+    :param vector_path: .npy path to save the embeddings to
+    :return: a read-only memory map of the saved embeddings
+    """
+    directory = os.path.dirname(vector_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = vector_path + '.' + str(os.getpid()) + '.tmp.npy'
+    np.save(tmp_path, vectors)
+    os.replace(tmp_path, vector_path)
+    return np.load(vector_path, mmap_mode='r')
+
+
+class QuantizedIndex:
+    """
+    Cosine index that searches quantized candidate codes and re-ranks the best of them exactly.
+    """
+
+    def __init__(self, embeddings, quantization, vector_path, cfg):
+        """
+        :param embeddings: 2D array of candidate embeddings
+        :param quantization: one of float16, int8 or binary
+        :param vector_path: .npy path where the full precision embeddings are kept for re-ranking, an existing file
+                            of the same shape is assumed to hold the same embeddings
+        :param cfg: configuration dictionary
+        """
+        if quantization not in QUANTIZATIONS[1:]:
+            print("Unknown embedding_quantization", quantization, "in config, please use one of", QUANTIZATIONS)
+            sys.exit(1)
+        self.quantization = quantization
+        self.index_type = 'exact-' + quantization
+        self.cfg = cfg
+        self.rerank_factor = cfg.get('rerank_factor', DEFAULT_RERANK_FACTOR)
+        vectors = normalize_embeddings(embeddings).astype(np.float32)
+        self.dim = vectors.shape[1]
+        self.scales = None
+        if quantization == 'float16':
+            self.codes = vectors.astype(np.float16)
+        elif quantization == 'int8':
+            # each row gets its own scale so that its largest component uses the full int8 range
+            self.scales = np.abs(vectors).max(axis=1) / 127
+            self.scales[self.scales == 0] = 1
+            self.codes = np.round(vectors / self.scales.reshape(-1, 1)).astype(np.int8)
+        else:
+            self.codes = np.packbits(vectors > 0, axis=1)
+
+        self.vectors = load_vectors(vector_path, vectors.shape)
+        if self.vectors is None:
+            self.vectors = save_vectors(vectors, vector_path)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def memory_bytes(self):
+        """
+        :return: number of bytes the index holds in memory
+        """
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def block_similarities(self, queries, start, stop):
+        """
+        Scores queries against a block of candidate codes.
+
+        :param queries: 2D float32 array of normalized queries
+        :param start: first candidate of the block
+        :param stop: end of the block
+        :return: a 2D array of approximate cosine similarities
+        """
+        codes = self.codes[start:stop]
+        if self.quantization == 'binary':
+            # the queries stay in full precision and are compared to the sign of every component
+            signs = np.unpackbits(codes, axis=1, count=self.dim).astype(np.float32) * 2 - 1
+            return queries @ signs.T
+        similarities = queries @ codes.astype(np.float32).T
+        if self.scales is not None:
+            similarities *= self.scales[start:stop]
+        return similarities
+
+    def shortlist(self, queries, size, candidate_block):
+        """
+        Finds the candidates with the highest approximate similarity to each query, scanning the codes in blocks.
+
+        :param queries: 2D float32 array of normalized queries
+        :param size: number of candidates per query
+        :param candidate_block: number of candidates scored at a time
+        :return: a 2D array of approximate cosine distances and a 2D array of candidate indices
+        """
+        distances = np.empty((len(queries), 0), dtype=np.float32)
+        indices = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self), candidate_block):
+            stop = min(start + candidate_block, len(self))
+            block_distances = 1.0 - self.block_similarities(queries, start, stop)
+            block_indices = top_k_rows(block_distances, size)
+            distances = np.hstack([distances, np.take_along_axis(block_distances, block_indices, axis=1)])
+            indices = np.hstack([indices, block_indices + start])
+            keep = top_k_rows(distances, size)
+            distances = np.take_along_axis(distances, keep, axis=1)
+            indices = np.take_along_axis(indices, keep, axis=1)
+        return distances, indices
+
+    def rerank(self, queries, candidates, k):
+        """
+        Orders shortlisted candidates by their exact cosine distance to each query.
+
+        :param queries: 2D float64 array of normalized queries
+        :param candidates: 2D array of shortlisted candidate indices for each query
+        :param k: number of matches per query
+        :return: a 2D array of cosine distances and a 2D array of candidate indices
+        """
+        # sorting the shortlist by candidate index breaks ties the same way as the exact index
+        candidates = np.sort(candidates, axis=1)
+        vectors = self.vectors[candidates.ravel()].reshape(candidates.shape + (self.dim,)).astype(np.float64)
+        distances = 1.0 - np.einsum('qd,qmd->qm', queries, vectors)
+        order = top_k_rows(distances, k)
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(candidates, order, axis=1)
+
+    def search(self, query_embeddings, k, rerank=True):
+        """
+        Finds the k closest candidates for each query.
+
+        :param query_embeddings: 2D array of query embeddings
+        :param k: number of matches per query
+        :param rerank: boolean denoting whether or not to re-rank a shortlist with the full precision embeddings
+        :return: a 2D array of cosine distances and a 2D array of candidate indices
+        """
+        queries = normalize_embeddings(query_embeddings)
+        k = min(k, len(self))
+        size = min(len(self), k * self.rerank_factor) if rerank else k
+        budget = self.cfg.get('match_memory_mb', DEFAULT_MEMORY_MB) * 1024 * 1024
+        # a block of decoded candidates and a block of query scores both stay within the memory budget
+        candidate_block = max(size, min(len(self), int(budget // (self.dim * 4))))
+        block_size = max(1, int(budget // (max(candidate_block, size * self.dim) * 8)))
+        all_distances, all_indices = [], []
+        for start in range(0, len(queries), block_size):
+            block = queries[start:start + block_size]
+            distances, indices = self.shortlist(block.astype(np.float32), size, candidate_block)
+            if rerank:
+                distances, indices = self.rerank(block, indices, k)
+            all_distances.append(distances.astype(np.float64))
+            all_indices.append(indices)
+        if not all_indices:
+            return np.empty((0, 0)), np.empty((0, 0), dtype=np.int64)
+        return np.vstack(all_distances), np.vstack(all_indices)
@@ -0,0 +1,238 @@
+"""
+This file contains the sharded exact index used for candidate sets too
+large for one process. The candidate embeddings are saved once and cut
+into contiguous shards, each loaded by a worker that finds the top
+matches within its shard. Workers are local processes or, on other
+nodes, main.py started with --shard_worker, and they talk to the
+coordinator over a socket. The coordinator merges the shards' partial
+results exactly.
+"""
+from multiprocessing.connection import Client, Listener
+import json, multiprocessing, os, sys, threading, time, traceback
+
+import numpy as np
+
+from func.quantized_index import load_vectors, save_vectors
+from func.similarity import exclude_ids, normalize_embeddings, top_matches
+
+DEFAULT_SHARD_ADDRESS = '127.0.0.1:8766'
+DEFAULT_CONNECT_TIMEOUT = 300
+
+
+def parse_address(address):
+    """
+    :param address: string address in host:port form
+    :return: a (host, port) tuple
+    """
+    host, _, port = address.rpartition(':')
+    return host, int(port)
+
+
+def get_shard_authkey(cfg):
+    """
+    Helper function that fetches the key shard workers on other nodes authenticate with from the secret.json file.
+
+    :param cfg: configuration dictionary
+    :return: the shard key stored in secret.json as bytes
+    """
+    if os.path.isfile(cfg['secret_loc']):
+        with open(cfg['secret_loc']) as f:
+            secret_json = json.load(f)
+            if not secret_json or not secret_json.get('shard_authkey'):
+                print("Shard workers on other nodes require a shard_authkey in secret.json, please consult the README.")
+                sys.exit(1)
+            return secret_json.get('shard_authkey').encode()
+    else:
+        print("Failed to find secret.json, please consult the README for proper instruction.")
+        sys.exit(1)
+
+
+def merge_shard_results(shard_distances, shard_indices, k):
+    """
+    Merges the per-shard top matches into the overall top k. Ties are broken by global candidate index, as
+    they are in an unsharded search.
+
+    :param shard_distances: list of 2D arrays of each shard's closest distances
+    :param shard_indices: list of 2D arrays of each shard's global candidate indices
+    :param k: number of matches per query
+    :return: a 2D array of cosine distances and a 2D array of global indices of the closest candidates
+    """
+    distances = np.hstack(shard_distances)
+    indices = np.hstack(shard_indices)
+    order = np.lexsort((indices, distances), axis=1)[:, :k]
+    return np.take_along_axis(distances, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+
+def run_shard_worker(address, authkey):
+    """
+    Connects to a coordinator and serves searches over the shard it is sent until it is told to stop.
+
+    :param address: (host, port) tuple of the coordinator
+    :param authkey: bytes key the coordinator authenticates workers with
+    :return: none
+    """
+    conn = Client(address, authkey=authkey)
+    embeddings, offset, cfg = None, 0, {}
+    try:
+        while True:
+            message = conn.recv()
+            try:
+                if message[0] == 'load':
+                    _, vector_path, offset, end, cfg = message
+                    # only this shard's rows of the memory-mapped file are read
+                    embeddings = normalize_embeddings(np.load(vector_path, mmap_mode='r')[offset:end])
+                    conn.send(('loaded', len(embeddings)))
+                elif message[0] == 'search':
+                    _, queries, k, exclude = message
+                    # one extra match per query makes up for its own candidate if it is in this shard
+                    extra = 1 if exclude is not None else 0
+                    distances, indices = top_matches(queries, embeddings, k + extra, cfg)
+                    indices = indices + offset
+                    if exclude is not None:
+                        distances, indices = exclude_ids(distances, indices, exclude, k)
+                    conn.send(('result', distances, indices))
+                elif message[0] == 'close':
+                    break
+            except Exception:
+                conn.send(('error', traceback.format_exc()))
+    except EOFError:
+        # the coordinator went away
+        pass
+    finally:
+        conn.close()
+
+
+class ShardedIndex:
+    """
+    Exact cosine index whose candidates are partitioned across shard worker processes.
+    """
+    index_type = 'exact-sharded'
+    excludes_self = True
+
+    def __init__(self, embeddings, vector_path, cfg):
+        """
+        :param embeddings: 2D array of candidate embeddings
+        :param vector_path: .npy path the embeddings are saved to for the workers to load their shards from, an
+                            existing file of the same shape is assumed to hold the same embeddings. Workers on other
+                            nodes need the path on shared storage.
+        :param cfg: configuration dictionary
+        """
+        vectors = normalize_embeddings(embeddings).astype(np.float32)
+        self.size = len(vectors)
+        if load_vectors(vector_path, vectors.shape) is None:
+            save_vectors(vectors, vector_path)
+        # the coordinator keeps no copy of the embeddings, each worker reads its own shard from the file
+        del embeddings, vectors
+        self.num_shards = max(1, min(cfg.get('num_shards', 1), self.size))
+        self.lock = threading.Lock()
+        self.processes = []
+        if cfg.get('shard_local_workers', True):
+            authkey = os.urandom(32)
+            self.listener = Listener(('127.0.0.1', 0), authkey=authkey)
+            # spawned workers start from a clean interpreter rather than a copy of the coordinator's memory
+            context = multiprocessing.get_context('spawn')
+            for _ in range(self.num_shards):
+                process = context.Process(target=run_shard_worker, args=(self.listener.address, authkey),
+                                          daemon=True)
+                process.start()
+                self.processes.append(process)
+        else:
+            address = cfg.get('shard_address', DEFAULT_SHARD_ADDRESS)
+            self.listener = Listener(parse_address(address), authkey=get_shard_authkey(cfg))
+            print("Waiting for", self.num_shards, "shard workers to connect to", address + "...")
+        self.connections = []
+        self.accept_workers(cfg.get('shard_connect_timeout', DEFAULT_CONNECT_TIMEOUT))
+
+        bounds = np.linspace(0, self.size, self.num_shards + 1).astype(np.int64)
+        shard_cfg = {'match_memory_mb': cfg.get('match_memory_mb')} if cfg.get('match_memory_mb') else {}
+        for conn, start, end in zip(self.connections, bounds[:-1], bounds[1:]):
+            conn.send(('load', vector_path, int(start), int(end), shard_cfg))
+        self.receive()
+        print("Sharded", self.size, "candidates across", self.num_shards, "shard workers.")
+
+    def __len__(self):
+        return self.size
+
+    def accept_workers(self, timeout):
+        """
+        Waits for every shard worker to connect. Gives up when the timeout passes or a local worker exits first.
+
+        :param timeout: seconds to wait for the workers
+        :return: none
+        """
+        failures = []
+
+        def accept():
+            try:
+                while len(self.connections) < self.num_shards:
+                    self.connections.append(self.listener.accept())
+            except Exception as e:
+                failures.append(e)
+        accepter = threading.Thread(target=accept, daemon=True)
+        accepter.start()
+        deadline = time.time() + timeout
+        while accepter.is_alive():
+            accepter.join(0.1)
+            dead = [process for process in self.processes if not process.is_alive()]
+            if accepter.is_alive() and (dead or time.time() > deadline):
+                reason = "a shard worker exited" if dead else "timed out after " + str(timeout) + " seconds"
+                print("Only", len(self.connections), "of", self.num_shards, "shard workers connected,", reason + ".")
+                self.close()
+                sys.exit(1)
+        if failures:
+            print("Failed to accept shard workers -", failures[0])
+            self.close()
+            sys.exit(1)
+
+    def receive(self):
+        """
+        :return: the reply of every shard worker, in shard order
+        """
+        replies = [conn.recv() for conn in self.connections]
+        for reply in replies:
+            if reply[0] == 'error':
+                print("A shard worker failed:\n" + reply[1])
+                sys.exit(1)
+        return replies
+
+    def search(self, query_embeddings, k, exclude=None):
+        """
+        Searches every shard at once and merges their matches.
+
+        :param query_embeddings: 2D array of query embeddings
+        :param k: number of matches per query
+        :param exclude: optional array with the global candidate index to leave out of each query's matches
+        :return: a 2D array of cosine distances and a 2D array of global indices of the closest candidates
+        """
+        k = min(k, self.size - (1 if exclude is not None else 0))
+        queries = np.asarray(query_embeddings)
+        if len(queries) == 0 or k <= 0:
+            return np.empty((len(queries), 0)), np.empty((len(queries), 0), dtype=np.int64)
+        if exclude is not None:
+            exclude = np.asarray(exclude, dtype=np.int64)
+        with self.lock:
+            for conn in self.connections:
+                conn.send(('search', queries, k, exclude))
+            replies = self.receive()
+        return merge_shard_results([reply[1] for reply in replies], [reply[2] for reply in replies], k)
+
+    def close(self):
+        """
+        Stops the shard workers.
+
+        :return: none
+        """
+        with self.lock:
+            for conn in self.connections:
+                try:
+                    conn.send(('close',))
+                except OSError:
+                    pass
+                conn.close()
+            self.connections = []
+        for process in self.processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+        self.listener.close()
@@ -0,0 +1,136 @@
+"""
+This file contains the batched similarity engine used by the claim matcher
+to find the nearest candidate documents for every search document at once.
+"""
+import numpy as np
+
+# default memory budget (in megabytes) for a single block of the similarity matrix
+DEFAULT_MEMORY_MB = 256
+
+
+def normalize_embeddings(embeddings):
+    """
+    Scales every embedding to unit length so that cosine distance reduces to a dot product.
+
+    :param embeddings: 2D array-like of embeddings, one per row
+    :return: a float64 array of the unit-length embeddings
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    if embeddings.ndim == 1:
+        embeddings = embeddings.reshape(1, -1)
+    norms = np.linalg.norm(embeddings, axis=1).reshape(-1, 1)
+    norms[norms == 0] = 1
+    return embeddings / norms
+
+
+def get_block_size(num_candidates, cfg):
+    """
+    Computes how many search rows fit into a single similarity block given the configured memory budget.
+
+    :param num_candidates: number of documents in the candidate set
+    :param cfg: configuration dictionary
+    :return: number of search rows to process per block
+    """
+    budget = cfg.get('match_memory_mb', DEFAULT_MEMORY_MB) * 1024 * 1024
+    # each block holds a float64 distance for every candidate of every row
+    return max(1, int(budget // (max(num_candidates, 1) * 8)))
+
+
+def top_k_rows(distances, k):
+    """
+    Finds the indices of the k smallest distances in each row, ordered from closest to farthest. Ties are
+    broken by candidate index so the ordering matches a stable full sort.
+
+    :param distances: 2D array of distances, one row per search document
+    :param k: number of indices to keep per row
+    :return: a 2D array of candidate indices of shape (rows, k)
+    """
+    num_candidates = distances.shape[1]
+    k = min(k, num_candidates)
+    if k == 0:
+        return np.empty((distances.shape[0], 0), dtype=np.int64)
+    if k < num_candidates:
+        partition = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        # argpartition gives no guarantee on which of several tied values makes the cut, so pull in every
+        # candidate that ties with the k-th distance before ordering
+        kth = np.take_along_axis(distances, partition, axis=1).max(axis=1)
+        if np.any(np.sum(distances <= kth.reshape(-1, 1), axis=1) > k):
+            partition = np.argsort(distances, axis=1, kind='stable')[:, :k]
+    else:
+        partition = np.tile(np.arange(num_candidates), (distances.shape[0], 1))
+    part_dists = np.take_along_axis(distances, partition, axis=1)
+    order = np.lexsort((partition, part_dists), axis=1)
+    return np.take_along_axis(partition, order, axis=1)
+
+
+def exclude_ids(distances, indices, exclude, k):
+    """
+    Removes each query's own candidate from its matches.
+
+    :param distances: 2D array of each query's closest distances, closest first
+    :param indices: 2D array of the matching global candidate indices
+    :param exclude: array with the global candidate index to leave out of each query's matches
+    :param k: number of matches to keep per query
+    :return: the first k remaining distances and indices of each query
+    """
+    excluded = indices == exclude.reshape(-1, 1)
+    # a stable sort moves the excluded candidate, if present, behind the others without reordering them, and an
+    # infinite distance keeps it behind any matches it is merged with when there were no more than k candidates
+    order = np.argsort(excluded, axis=1, kind='stable')[:, :k]
+    distances = np.where(excluded, np.inf, distances)
+    return np.take_along_axis(distances, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+
+def top_matches(search_embeddings, candidate_embeddings, k, cfg):
+    """
+    Finds the k closest candidate documents for every search document using blocked matrix multiplication
+    over normalized embeddings.
+
+    :param search_embeddings: embeddings for all documents in the search set
+    :param candidate_embeddings: embeddings for all documents in the candidate set
+    :param k: number of matches to find for each search document
+    :param cfg: configuration dictionary
+    :return: a 2D array of cosine distances and a 2D array of indices of the closest candidates for each search item
+    """
+    return normalized_top_matches(normalize_embeddings(search_embeddings), normalize_embeddings(candidate_embeddings),
+                                  k, cfg)
+
+
+def normalized_top_matches(search_norm, candidate_norm, k, cfg):
+    """
+    Finds the k closest candidate documents for every search document, for embeddings that are already unit length.
+
+    :param search_norm: normalized embeddings for all documents in the search set
+    :param candidate_norm: normalized embeddings for all documents in the candidate set
+    :param k: number of matches to find for each search document
+    :param cfg: configuration dictionary
+    :return: a 2D array of cosine distances and a 2D array of indices of the closest candidates for each search item
+    """
+    block_size = get_block_size(len(candidate_norm), cfg)
+    all_distances = []
+    all_indices = []
+    for start in range(0, len(search_norm), block_size):
+        block_dists = 1.0 - search_norm[start:start + block_size] @ candidate_norm.T
+        block_indices = top_k_rows(block_dists, k)
+        all_indices.append(block_indices)
+        all_distances.append(np.take_along_axis(block_dists, block_indices, axis=1))
+    if not all_indices:
+        return np.empty((0, 0)), np.empty((0, 0), dtype=np.int64)
+    return np.vstack(all_distances), np.vstack(all_indices)
+
+
+def batched_top_matches(search_embeddings, candidate_embeddings, search_set, candidate_set, cfg):
+    """
+    Finds the top matching candidate documents for every search document. When the search set is the
+    candidate set, the closest match of each document (itself) is left out of its results.
+
+    :param search_embeddings: SBERT-generated embeddings for all documents in the search set
+    :param candidate_embeddings: SBERT-generated embeddings for all documents in the candidate set
+    :param search_set: name of the search set
+    :param candidate_set: name of the candidate set
+    :param cfg: configuration dictionary
+    :return: a 2D array of cosine distances and a 2D array of indices of the closest candidates for each search item
+    """
+    skip = 1 if search_set == candidate_set else 0
+    distances, indices = top_matches(search_embeddings, candidate_embeddings, cfg['num_matches'] + skip, cfg)
+    return distances[:, skip:], indices[:, skip:]
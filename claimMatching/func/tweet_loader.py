@@ -4,15 +4,14 @@ This file contains several functions used for reading and
 filtering data.
 @author: brocklin
 """
-from io import BytesIO
+from multiprocessing import Pool
 import json, os, re, sys
-from PIL import Image
 
-import jsonlines
-from langdetect import detect
-import psycopg2
-import pytesseract
-import requests
+import orjson
+
+# langdetect, psycopg2 and the media loader's OCR dependencies are imported on first use, so runs that never
+# detect languages, query the database or caption media do not load them
+_detect = []
 
 def get_db_pwd(cfg):
     """
@@ -33,36 +32,41 @@ def get_db_pwd(cfg):
         print("Failed to find secret.json, please consult the README for proper instruction.")
         sys.exit(1)
 
-def get_db_tweet_caption(cursor, media_ids):
+def get_db_tweet_caption(cursor, media_ids, cfg=None):
     """
     Returns an OCR and image-captioning caption for a given tweet.
 
     :param cursor: cursor to execute SQL queries for connected to Mona's DB
     :param media_ids: list of all ids of media associated with a tweet
+    :param cfg: configuration dictionary
     :return: the caption given for the supplied media image
     """
-    media_ids = json.loads(media_ids)
-    if len(media_ids) == 0:
-        return ""
-    query = "select media_url_https from media where id IN %s"
-    cursor.execute(query, (tuple(media_ids),))
-    media_data = cursor.fetchall()
-    return caption_image(image_fetch(media_data[0][0]))
+    from func.media_loader import caption_db_tweets
+    return caption_db_tweets(cursor, [media_ids], cfg)[0]
 
-def get_tweet_data(multimodal, cfg):
+def get_db_connection(cfg):
     """
-    Helper function that fetches twitter data from the database.
+    Helper function that connects to the tweet database.
 
-    :param multimodal: boolean denoting whether or not multimodal data should be used
     :param cfg: configuration dictionary
-    :return: a list of tweets
+    :return: an open psycopg2 connection
     """
-    conn = psycopg2.connect(
-        host="coviz-infodemic.cntqhtt2u1xx.us-east-1.rds.amazonaws.com",
-        port="5432",
-        user="postgres",
+    import psycopg2
+    return psycopg2.connect(
+        host=cfg.get('db_host', "coviz-infodemic.cntqhtt2u1xx.us-east-1.rds.amazonaws.com"),
+        port=str(cfg.get('db_port', 5432)),
+        user=cfg.get('db_user', "postgres"),
         password=get_db_pwd(cfg))
-    cursor = conn.cursor()
+
+
+def build_tweet_query(multimodal, cfg):
+    """
+    Helper function that builds the query used to select tweets from the database.
+
+    :param multimodal: boolean denoting whether or not multimodal data should be used
+    :param cfg: configuration dictionary
+    :return: the SQL query string
+    """
     num_tweets = cfg['num_tweets']
     query_fields = ""
     if multimodal:
@@ -72,49 +76,142 @@ def get_tweet_data(multimodal, cfg):
         cursor_command = f'{cursor_command} limit {num_tweets};'
     else:
         cursor_command += ';'
-    cursor.execute(cursor_command)
-    server_data = cursor.fetchall()
+    return cursor_command
+
+
+def iter_tweet_data(multimodal, cfg):
+    """
+    Generator that streams twitter data from the database in chunks through a server-side cursor, so that only
+    one chunk of tweets is held in memory at a time.
+
+    :param multimodal: boolean denoting whether or not multimodal data should be used
+    :param cfg: configuration dictionary
+    :return: yields lists of at most tweet_chunk_size tweets
+    """
+    chunk_size = cfg.get('tweet_chunk_size', 2000)
+    conn = get_db_connection(cfg)
+    ocr_pool = None
+    if multimodal:
+        from func.media_loader import caption_db_tweets, create_ocr_pool
+        # one OCR pool serves every chunk of the stream
+        ocr_pool = create_ocr_pool(cfg)
+    try:
+        # a named cursor keeps the result set on the server; media lookups need a separate client-side cursor
+        cursor = conn.cursor(name='tweet_stream')
+        cursor.itersize = chunk_size
+        media_cursor = conn.cursor() if multimodal else None
+        cursor.execute(build_tweet_query(multimodal, cfg).rstrip(';'))
+        while True:
+            server_data = cursor.fetchmany(chunk_size)
+            if not server_data:
+                break
+            tweets = [datapoint[0] for datapoint in server_data]
+            if multimodal:
+                captions = caption_db_tweets(media_cursor, [datapoint[1] for datapoint in server_data], cfg, ocr_pool)
+                tweets = [tweet + caption for tweet, caption in zip(tweets, captions)]
+            yield tweets
+        cursor.close()
+    finally:
+        conn.close()
+        if ocr_pool is not None:
+            ocr_pool.shutdown()
+
+
+def get_tweet_data(multimodal, cfg):
+    """
+    Helper function that fetches twitter data from the database.
+
+    :param multimodal: boolean denoting whether or not multimodal data should be used
+    :param cfg: configuration dictionary
+    :return: a list of tweets
+    """
     tweets = []
-    for datapoint in server_data:
-        if multimodal:
-            tweets.append(datapoint[0] + get_db_tweet_caption(cursor, datapoint[1]))
-        else:
-            tweets.append(datapoint[0])
+    for chunk in iter_tweet_data(multimodal, cfg):
+        tweets.extend(chunk)
     return tweets
 
 
-def image_fetch(image_url):
-    response = requests.get(image_url)
-    image = Image.open(BytesIO(response.content))
-    return image
+def get_local_tweet_caption(tweet, cfg=None):
+    """
+    Appends the OCR and image-captioning caption of a tweet's photo to its text.
+
+    :param tweet: hydrated tweet, as a dictionary or JSON string
+    :param cfg: configuration dictionary
+    :return: a new tweet dictionary with the caption appended to its full_text
+    """
+    from func.media_loader import caption_local_tweets
+    return caption_local_tweets([tweet], cfg)[0]
+
+
+def get_language_detector():
+    """
+    :return: langdetect's detect function, seeded on first use
+    """
+    if not _detect:
+        from langdetect import DetectorFactory, detect
+        # langdetect is randomized, seeding it makes the detected language of a tweet the same on every run
+        DetectorFactory.seed = 0
+        _detect.append(detect)
+    return _detect[0]
+
+
+def is_english_tweet(tweet):
+    """
+    Checks whether a tweet is in English, using Twitter's own language tag before the slower language detector.
+
+    :param tweet: hydrated tweet dictionary
+    :return: whether or not both Twitter and langdetect consider the tweet English
+    """
+    if tweet.get('lang') != 'en':
+        return False
+    detect = get_language_detector()
+    try:
+        return detect(tweet.get('full_text')) == 'en'
+    except:
+        return False
 
 
-def caption_image(image):
-    # ocr captioning
-    ocr_caption = pytesseract.image_to_string(image)
+def read_tweet_file(args):
+    """
+    Reads the English tweets of a single jsonl file. Runs in a worker process, so the language of each tweet is
+    detected in parallel and only the kept tweets are sent back.
 
-    # image captioning
-    # print(os.popen("th").read())
-    image_caption = ""
+    :param args: tuple of the file's path and the maximum number of tweets to read from it, 0 for no limit
+    :return: a list of the file's English tweet dictionaries, in file order
+    """
+    file, limit = args
+    tweets = []
+    with open(file, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            tweet = orjson.loads(line)
+            if is_english_tweet(tweet):
+                tweets.append(tweet)
+                if len(tweets) == limit:
+                    break
+    return tweets
 
-    return ocr_caption + image_caption
 
+def iter_tweet_files(tweet_files, limit, cfg):
+    """
+    Generator that reads tweet files across a pool of worker processes, yielding each file's tweets in file order.
 
-def get_local_tweet_caption(tweet):
-    tweet_obj = json.loads(tweet)
-    entities = tweet_obj.get('entities')
-    caption = None
-    if entities:
-        media = entities.get("media")
-        if media:
-            image_url = media[0].get("media_url_https")
-            image_type = media[0].get('type')
-            if image_type == 'photo':
-                caption = caption_image(image_fetch(image_url))
-    if not caption:
-        caption = ''
-    tweet_obj["full_text"] = tweet_obj.get("full_text") + caption
-    return tweet_obj
+    :param tweet_files: list of jsonl file paths
+    :param limit: maximum number of tweets to read from each file, 0 for no limit
+    :param cfg: configuration dictionary
+    :return: yields a list of English tweets per file
+    """
+    workers = min(cfg.get('ingest_workers') or os.cpu_count() or 1, len(tweet_files))
+    jobs = [(file, limit) for file in tweet_files]
+    if workers <= 1:
+        for job in jobs:
+            yield read_tweet_file(job)
+        return
+    with Pool(workers) as pool:
+        # leaving the with block terminates the workers once the caller has enough tweets
+        for file_tweets in pool.imap(read_tweet_file, jobs):
+            yield file_tweets
 
 
 def get_local_tweet_data(multimodal, cfg):
@@ -129,29 +226,75 @@ def get_local_tweet_data(multimodal, cfg):
     if not os.path.exists(cfg['tweet_dir']):
         print("Please fetch and set up Twitter data before continuing per the README.")
         sys.exit(1)
-    tweet_files = [os.path.join(cfg['tweet_dir'], file) for file in os.listdir(cfg['tweet_dir'])
-                   if re.match(combined_regex, file)]
-    tweets = []
+    tweet_files = sorted(os.path.join(cfg['tweet_dir'], file) for file in os.listdir(cfg['tweet_dir'])
+                         if re.match(combined_regex, file))
     print("Tweet files matched:")
     print(tweet_files)
-    num_entries = 0
-    for file in tweet_files:
-        with jsonlines.open(file) as f:
-            for tweet in f:
-                tweet_text = tweet.get('full_text')
-                try:
-                    tweet_lang = detect(tweet_text)
-                except:
-                    tweet_lang = None
-                if tweet_lang == 'en' and tweet.get('lang') == 'en':
-                    if multimodal:
-                        captioned_tweet = get_local_tweet_caption(tweet)
-                        if cfg['remove_text_only'] and captioned_tweet.get("full_text") == tweet.get("full_text"):
-                            # if we are removing text only tweets, the tweet will be unchanged, continue without it
-                            # Note to Nina: until image captioning is added, this will also remove tweets w/o OCR-detected text
-                            continue
-                tweets.append(tweet)
-                num_entries += 1
-                if num_entries == cfg['num_entries']:
-                    return tweets
+    if len(tweet_files) == 0:
+        return []
+    if not multimodal:
+        return read_local_tweets(tweet_files, False, None, cfg)
+    from func.media_loader import create_ocr_pool
+    # one OCR pool serves every batch of the load
+    ocr_pool = create_ocr_pool(cfg)
+    try:
+        return read_local_tweets(tweet_files, True, ocr_pool, cfg)
+    finally:
+        if ocr_pool is not None:
+            ocr_pool.shutdown()
+
+
+def read_local_tweets(tweet_files, multimodal, ocr_pool, cfg):
+    """
+    Reads the English tweets of the matched files in order, captioning them in batches when multimodal.
+
+    :param tweet_files: sorted list of jsonl file paths
+    :param multimodal: boolean denoting whether or not multimodal data should be used
+    :param ocr_pool: process pool running OCR, or None to run OCR in the main process
+    :param cfg: configuration dictionary
+    :return: a list of tweets
+    """
+    tweets = []
+    # no file can contribute more than num_entries tweets, unless tweets may still be dropped after captioning
+    file_limit = 0 if multimodal and cfg['remove_text_only'] else cfg['num_entries']
+    for file_tweets in iter_tweet_files(tweet_files, file_limit, cfg):
+        if multimodal:
+            # caption in batches so the media of many tweets is downloaded and OCR'd together
+            batch_size = cfg.get('media_batch_size', 256)
+            for start in range(0, len(file_tweets), batch_size):
+                add_captioned_tweets(tweets, file_tweets[start:start + batch_size], ocr_pool, cfg)
+                if reached_entry_limit(tweets, cfg):
+                    return tweets[:cfg['num_entries']]
+        else:
+            tweets.extend(file_tweets)
+            if reached_entry_limit(tweets, cfg):
+                return tweets[:cfg['num_entries']]
     return tweets
+
+
+def reached_entry_limit(tweets, cfg):
+    """
+    :param tweets: list of tweets kept so far
+    :param cfg: configuration dictionary
+    :return: whether or not num_entries tweets have been kept
+    """
+    return cfg['num_entries'] != 0 and len(tweets) >= cfg['num_entries']
+
+
+def add_captioned_tweets(tweets, pending, ocr_pool, cfg):
+    """
+    Captions a batch of tweets and adds them to the kept tweets in their original order.
+
+    :param tweets: list of tweets kept so far
+    :param pending: list of tweets to caption
+    :param ocr_pool: process pool running OCR, or None to run OCR in the main process
+    :param cfg: configuration dictionary
+    :return: none
+    """
+    from func.media_loader import caption_local_tweets
+    for tweet, captioned_tweet in zip(pending, caption_local_tweets(pending, cfg, ocr_pool)):
+        if cfg['remove_text_only'] and captioned_tweet.get("full_text") == tweet.get("full_text"):
+            # if we are removing text only tweets, the tweet will be unchanged, continue without it
+            # Note to Nina: until image captioning is added, this will also remove tweets w/o OCR-detected text
+            continue
+        tweets.append(captioned_tweet)
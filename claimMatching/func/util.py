@@ -3,8 +3,33 @@ Created on Wed Jul 29 16:40:36 2020
 This file contains several utility functions used by the claim matcher.
 @author: brocklin
 """
+from collections import OrderedDict
+
 import numpy as np
-from nltk.corpus import stopwords
+
+def tokenize(document):
+    """
+    Splits a document into the lowercase words used for TF-IDF and keyword filtering.
+
+    :param document: string document
+    :return: list of lowercase string words
+    """
+    return [word.lower() for word in document.split(' ')]
+
+def tokenize_documents(documents):
+    """
+    Tokenizes every document into a single flat list of words.
+
+    :param documents: list of string documents
+    :return: a flat list of all lowercase words and an array with the number of words in each document
+    """
+    tokens = []
+    lengths = np.empty(len(documents), dtype=np.int64)
+    for index, document in enumerate(documents):
+        doc_tokens = tokenize(document)
+        tokens.extend(doc_tokens)
+        lengths[index] = len(doc_tokens)
+    return tokens, lengths
 
 def get_unique_words(documents):
     """
@@ -13,12 +38,8 @@ def get_unique_words(documents):
     :param documents: list of string documents containing words
     :return: list of all unique lowercase string words across the documents
     """
-    unique_words = []
-    for document in documents:
-        doc_words = document.split(' ')
-        unique_words.extend(doc_words)
-    unique_words = [word.lower() for word in unique_words]
-    return list(dict.fromkeys(unique_words))
+    tokens, _ = tokenize_documents(documents)
+    return list(dict.fromkeys(tokens))
 
 def build_word_encoder_decoder(unique_words):
     """
@@ -39,18 +60,21 @@ def build_word_encoder_decoder(unique_words):
 
 def build_word_count_matrix(documents, unique_words, word_encoder):
     """
-    Given a set of D documents and W unique words, creates a DxW matrix
+    Given a set of D documents and W unique words, creates a sparse DxW matrix
     to store the number of occurrences of each word across all documents.
 
     :param documents: all documents to use for counting words
     :param unique_words: all unique words that occur within the documents
     :param word_encoder: a dictionary mapping each unique word to an integer
-    :return: a matrix storing the number of times each word appears in each document
-    """
-    word_counts = np.zeros((len(documents), len(unique_words)), dtype=np.int32)
-    for index, claim in enumerate(documents):
-        for word in claim.split(' '):
-            word_counts[index, word_encoder[word.lower()]] += 1
+    :return: a CSR matrix storing the number of times each word appears in each document
+    """
+    from scipy import sparse
+    tokens, lengths = tokenize_documents(documents)
+    word_ids = np.fromiter((word_encoder[word] for word in tokens), dtype=np.int64, count=len(tokens))
+    doc_ids = np.repeat(np.arange(len(documents)), lengths)
+    word_counts = sparse.csr_matrix((np.ones(len(tokens), dtype=np.int32), (doc_ids, word_ids)),
+                                    shape=(len(documents), len(unique_words)))
+    word_counts.sum_duplicates()
     return word_counts
 
 def build_idf_matrix(documents, word_counts):
@@ -58,11 +82,12 @@ def build_idf_matrix(documents, word_counts):
     Creates the IDF matrix for TF-IDF matrix computation.
 
     :param documents: all documents
-    :param word_counts: the counts of all words across documents
-    :return: the computed IDF matrix
+    :param word_counts: the sparse counts of all words across documents
+    :return: the computed IDF vector, one value per word
     """
-    word_counts[word_counts > 0] = 1
-    return np.log(len(documents) / np.sum(word_counts, axis=0))
+    # every stored entry of a CSR matrix is a document containing that column's word
+    document_frequency = np.bincount(word_counts.indices, minlength=word_counts.shape[1])
+    return np.log(len(documents) / document_frequency)
 
 def do_tf_idf(documents):
     """
@@ -71,14 +96,16 @@ def do_tf_idf(documents):
     :param documents: list of all documents to perform tf-idf over
     :return: list of most important keywords from claims to filter tweets with
     """
+    from scipy import sparse
     # get all unique words
     unique_words = get_unique_words(documents)
     word_encoder, word_decoder = build_word_encoder_decoder(unique_words)
     word_counts = build_word_count_matrix(documents, unique_words, word_encoder)
 
-    tf_matrix = word_counts / np.sum(word_counts, axis=1).reshape(-1, 1)
-    idf_matrix = build_idf_matrix(documents, word_counts.copy())
-    tf_idf_matrix = tf_matrix * idf_matrix
+    doc_lengths = np.asarray(word_counts.sum(axis=1)).ravel()
+    tf_matrix = sparse.diags(1 / doc_lengths) @ word_counts
+    idf_matrix = build_idf_matrix(documents, word_counts)
+    tf_idf_matrix = (tf_matrix @ sparse.diags(idf_matrix)).tocsr()
 
     return tf_idf_matrix, word_encoder, word_decoder
 
@@ -90,12 +117,13 @@ def get_filtering_words(documents, cfg):
     :param cfg: configuration dictionary
     :return: a list of words to filter search set documents with
     """
+    from nltk.corpus import stopwords
     tf_idf_matrix, word_encoder, word_decoder = do_tf_idf(documents)
-    tf_idf_averages = np.sum(tf_idf_matrix, axis=0)
+    tf_idf_averages = np.asarray(tf_idf_matrix.sum(axis=0)).ravel()
     filter_exclude = stopwords.words('english')
     filter_exclude.extend(cfg['stopwords'])
     for word in filter_exclude:
-        if word in word_decoder:
+        if word in word_encoder:
             tf_idf_averages[word_encoder[word]] = 0
 
     top_overall = np.argsort(tf_idf_averages)[-cfg['num_filters']:]
@@ -113,26 +141,30 @@ def make_list_unique(elem_list):
     """
     return list(dict.fromkeys(elem_list))
 
-def filter_documents(documents, filter_words):
-    """
-    Given a set of documents and keywords to filter documents with, filters
-    out all documents that do not contain at least one of the keywords.
-
-    :param documents: list of documents
-    :param filter_words: list of keywords generated by tf-idf over the claims
-    :return: a filtered list of the tweets and a list of the matching keywords for each tweet
-    """
-    all_matches = []
-    new_docs = []
-    for document in documents:
-        keyword_matches = []
-        contains_filter = False
-        for word in document.split(' '):
-            if word.lower() in filter_words:
-                contains_filter = True
-                keyword_matches.append(word.lower())
-        if contains_filter:
-            keyword_matches = make_list_unique(keyword_matches)
-            new_docs.append(document)
-            all_matches.append(keyword_matches)
-    return new_docs, all_matches
+class LRUSet:
+    """
+    Set that remembers at most max_size items, forgetting the least recently seen first.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def add(self, item):
+        """
+        :param item: hashable item
+        :return: whether or not the item was new, it becomes the most recently seen item either way
+        """
+        if item in self.items:
+            self.items.move_to_end(item)
+            return False
+        self.items[item] = None
+        if len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+        return True
@@ -9,11 +9,13 @@ The main functions are:
     3) Match each tweet to its nearest fact-checked claim.
 @author: brocklin
 """
-import func.get_google_fact_check as FactCheck
-import func.match_claims as ClaimMatcher
+import func.metrics as Metrics
 
 import argparse, os, sys, yaml
 
+# the remaining modules are imported by the branch that uses them, so e.g. a fetch-only run never loads the
+# matcher's numerical and model dependencies (benchmarks/startup.py measures the import cost of each mode)
+
 if __name__ == "__main__":
     # argument parsing
     parser = argparse.ArgumentParser()
@@ -34,6 +36,22 @@ if __name__ == "__main__":
                         help='specifies that multimodal Twitter data should be fetched')
     parser.add_argument('-f', '--filter', dest='filter', action='store_true',
                         help='specifies that the search set should be filtered with words from the target set')
+    parser.add_argument('-e', '--embedding_cache', dest='embedding_cache', type=str, default=None,
+                        choices=['warm', 'inspect', 'purge'],
+                        help='warms the embedding cache with the search and candidate sets, prints its contents, '
+                             'or deletes it, then exits')
+    parser.add_argument('-t', '--stream', dest='stream', action='store_true',
+                        help='specifies that database tweets in the search set should be streamed and matched in chunks')
+    parser.add_argument('--serve', dest='serve', action='store_true',
+                        help='serves matches against the candidate set over HTTP instead of matching the search set')
+    parser.add_argument('-r', '--index_report', dest='index_report', action='store_true',
+                        help='specifies that the recall of the configured index should be reported against exact search')
+    parser.add_argument('--compile_corpus', dest='compile_corpus', action='store_true',
+                        help='compiles the google, ng and misc_json JSON files into memory-mapped corpora, then exits')
+    parser.add_argument('--fine_tune', dest='fine_tune', action='store_true',
+                        help='fine-tunes the model on pairs from jsonl matches and claim data, then exits')
+    parser.add_argument('--shard_worker', dest='shard_worker', type=str, default=None,
+                        help='serves a shard of the candidate set to the matcher listening at this host:port')
     arguments = parser.parse_args()
 
     # configuration setup
@@ -45,7 +63,46 @@ if __name__ == "__main__":
         print('Config file not found, please supply a valid, non-empty config or use the default.')
         sys.exit(1)
     cfg['CWD'] = CWD
+    Metrics.METRICS.configure(cfg)
+    if arguments.shard_worker:
+        import func.sharded_index as Sharding
+        Sharding.run_shard_worker(Sharding.parse_address(arguments.shard_worker), Sharding.get_shard_authkey(cfg))
+        sys.exit(0)
     if arguments.fetch_data:
+        import func.get_google_fact_check as FactCheck
         FactCheck.write_fact_check_data(cfg)
-    ClaimMatcher.find_nearest_claims(arguments.search_set, arguments.candidate_set, not arguments.keep_duplicates,
-                                     arguments.multimodal, arguments.filter, cfg)
+    if arguments.compile_corpus:
+        import func.corpus as Corpus
+        for source in Corpus.CORPUS_SOURCES:
+            Corpus.convert_source(source, cfg)
+        sys.exit(0)
+    if arguments.fine_tune:
+        import func.fine_tune as FineTune
+        FineTune.fine_tune(cfg)
+        sys.exit(0)
+    if arguments.embedding_cache == 'warm':
+        import func.match_claims as ClaimMatcher
+        ClaimMatcher.warm_embedding_cache(arguments.search_set, arguments.candidate_set, not arguments.keep_duplicates,
+                                          arguments.multimodal, cfg)
+        sys.exit(0)
+    elif arguments.embedding_cache in ('inspect', 'purge'):
+        import func.embedding_cache as EmbeddingCache
+        if arguments.embedding_cache == 'inspect':
+            EmbeddingCache.inspect_cache(cfg)
+        else:
+            EmbeddingCache.purge_cache(cfg)
+        sys.exit(0)
+    if arguments.serve:
+        import func.match_service as MatchService
+        MatchService.serve(arguments.candidate_set, not arguments.keep_duplicates, cfg)
+        sys.exit(0)
+    import func.match_claims as ClaimMatcher
+    if arguments.stream:
+        if arguments.search_set != 'tweets':
+            print('Streaming is only supported with tweets as the search set.')
+            sys.exit(1)
+        ClaimMatcher.stream_nearest_claims(arguments.candidate_set, not arguments.keep_duplicates,
+                                           arguments.multimodal, arguments.filter, cfg)
+    else:
+        ClaimMatcher.find_nearest_claims(arguments.search_set, arguments.candidate_set, not arguments.keep_duplicates,
+                                         arguments.multimodal, arguments.filter, cfg, arguments.index_report)
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from func.ann_index import ExactIndex, compare_matches, get_candidate_index, index_top_matches
+
+
+class ShuffledIndex:
+    """
+    Stands in for an approximate index that returns a query's own candidate after its true nearest neighbour.
+    """
+    index_type = 'shuffled'
+
+    def search(self, query_embeddings, k):
+        indices = np.array([[(row + 1) % len(query_embeddings), row] + list(range(100, 100 + k - 2))
+                            for row in range(len(query_embeddings))])
+        return np.tile(np.arange(k, dtype=np.float64), (len(indices), 1)), indices
+
+
+def test_self_search_excludes_own_candidate_by_id():
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((30, 5))
+    # document 7 is an exact duplicate of document 3, and ties are broken by index so 3 comes first for both
+    embeddings[7] = embeddings[3]
+    cfg = {'num_matches': 3}
+    distances, indices = index_top_matches(ExactIndex(embeddings, cfg), embeddings, 'ng', 'ng', cfg)
+    assert indices.shape == (30, 3)
+    assert not np.any(indices == np.arange(30).reshape(-1, 1))
+    assert indices[7, 0] == 3 and indices[3, 0] == 7
+    assert distances[7, 0] == pytest.approx(0.0, abs=1e-12)
+
+
+def test_self_search_keeps_top_match_of_approximate_index():
+    cfg = {'num_matches': 3}
+    _, indices = index_top_matches(ShuffledIndex(), np.zeros((4, 2)), 'ng', 'ng', cfg)
+    assert indices[:, 0].tolist() == [1, 2, 3, 0]
+    assert not np.any(indices == np.arange(4).reshape(-1, 1))
+
+
+def test_exact_index_matches_unnormalized_search():
+    rng = np.random.default_rng(1)
+    candidates, queries = rng.standard_normal((200, 6)) * 5, rng.standard_normal((10, 6))
+    distances, indices = ExactIndex(candidates, {}).search(queries, 4)
+    unit = candidates / np.linalg.norm(candidates, axis=1, keepdims=True)
+    expected = 1 - (queries / np.linalg.norm(queries, axis=1, keepdims=True)) @ unit.T
+    assert np.array_equal(indices, np.argsort(expected, axis=1, kind='stable')[:, :4])
+    assert np.allclose(distances, np.sort(expected, axis=1)[:, :4])
+
+
+def test_hnsw_index_is_saved_and_reloaded(tmp_path, capsys):
+    pytest.importorskip('faiss')
+    rng = np.random.default_rng(2)
+    embeddings = rng.standard_normal((500, 16)).astype(np.float32)
+    docs = ['document ' + str(row) for row in range(500)]
+    cfg = {'index_type': 'hnsw', 'index_dir': str(tmp_path), 'model': 'model', 'num_matches': 5}
+    index = get_candidate_index(docs, embeddings, 'ng', cfg)
+    assert 'Building hnsw' in capsys.readouterr().out
+    reloaded = get_candidate_index(docs, embeddings, 'ng', cfg)
+    assert 'Loading hnsw' in capsys.readouterr().out
+
+    _, exact = index_top_matches(ExactIndex(embeddings, cfg), embeddings, 'ng', 'ng', cfg)
+    _, approx = index_top_matches(reloaded, embeddings, 'ng', 'ng', cfg)
+    assert compare_matches(exact, approx)['recall_at_k'] > 0.9
+    assert not np.any(approx == np.arange(500).reshape(-1, 1))
+    assert len(index) == len(reloaded) == 500
+
+
+def test_compare_matches():
+    report = compare_matches(np.array([[1, 2], [3, 4]]), np.array([[1, 5], [4, 3]]))
+    assert report == {'recall_at_k': 0.75, 'top1_agreement': 0.5}
@@ -0,0 +1,67 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio, threading
+
+import pytest
+
+from func.batch_scheduler import MicroBatcher
+
+
+class RecordingProcess:
+    """
+    Batch function that returns k results per text, each naming the text, and records the size of every batch.
+    """
+
+    def __init__(self):
+        self.batch_sizes = []
+        self.lock = threading.Lock()
+
+    def __call__(self, texts, k):
+        with self.lock:
+            self.batch_sizes.append(len(texts))
+        if 'boom' in texts:
+            raise RuntimeError('process failed')
+        return [[text + str(rank) for rank in range(k)] for text in texts]
+
+
+def test_concurrent_requests_share_bounded_batches():
+    process = RecordingProcess()
+    with MicroBatcher(process, max_batch_size=8, max_wait_ms=50) as batcher:
+        requests = [(['r' + str(request) + '-' + str(text) for text in range(request % 5 + 1)], request % 3 + 1)
+                    for request in range(40)]
+        with ThreadPoolExecutor(max_workers=20) as pool:
+            results = list(pool.map(lambda request: batcher.match(*request), requests))
+        for (texts, k), result in zip(requests, results):
+            assert result == [[text + str(rank) for rank in range(k)] for text in texts]
+        assert max(process.batch_sizes) <= 8
+        assert sum(process.batch_sizes) == sum(len(texts) for texts, _ in requests)
+        assert len(process.batch_sizes) < len(requests)
+
+
+def test_oversized_requests_are_split():
+    process = RecordingProcess()
+    with MicroBatcher(process, max_batch_size=4, max_wait_ms=1) as batcher:
+        texts = ['t' + str(index) for index in range(10)]
+        assert batcher.match(texts, 1) == [[text + '0'] for text in texts]
+        assert process.batch_sizes == [4, 4, 2]
+
+
+def test_errors_reach_every_request_of_the_batch():
+    process = RecordingProcess()
+    with MicroBatcher(process, max_batch_size=16, max_wait_ms=200) as batcher:
+        requests = [asyncio.run_coroutine_threadsafe(batcher.submit(texts, 1), batcher.loop)
+                    for texts in [['boom'], ['fine']]]
+        for request in requests:
+            with pytest.raises(RuntimeError, match='process failed'):
+                request.result(timeout=10)
+        assert process.batch_sizes == [2]
+        # the scheduler keeps processing batches after a failure
+        assert batcher.match(['fine'], 2) == [['fine0', 'fine1']]
+
+
+def test_close_stops_the_loop_and_pending_requests():
+    batcher = MicroBatcher(RecordingProcess(), max_batch_size=4, max_wait_ms=10000).start()
+    pending = asyncio.run_coroutine_threadsafe(batcher.submit(['waiting'], 1), batcher.loop)
+    thread = batcher.thread
+    batcher.close()
+    assert not thread.is_alive()
+    assert pending.cancelled()
@@ -0,0 +1,32 @@
+import pytest
+
+pytest.importorskip('pytesseract')
+from func import caption_cache
+from func.caption_cache import CaptionCache, hash_image
+
+
+@pytest.fixture
+def cfg(tmp_path, monkeypatch):
+    monkeypatch.setattr(caption_cache, '_engine_version', ['tesseract-4.1'])
+    return {'caption_cache_path': str(tmp_path / 'cache' / 'captions.sqlite')}
+
+
+def test_captions_are_found_by_url_and_by_image(cfg):
+    first, second = hash_image(b'first image'), hash_image(b'second image')
+    with CaptionCache(cfg) as cache:
+        cache.put({'http://a/1.png': first, 'http://a/2.png': second}, {first: ' one', second: ' two'})
+    with CaptionCache(cfg) as cache:
+        assert cache.get_by_urls(['http://a/1.png', 'http://a/3.png']) == {'http://a/1.png': ' one'}
+        # the same image shared under another url is found by its bytes
+        assert cache.get_by_hashes([second, hash_image(b'third image')]) == {second: ' two'}
+        assert cache.stats() == {'url_hits': 1, 'hash_hits': 1, 'misses': 1}
+
+
+def test_captions_of_another_engine_are_not_used(cfg, monkeypatch):
+    image_hash = hash_image(b'image')
+    with CaptionCache(cfg) as cache:
+        cache.put({'http://a/1.png': image_hash}, {image_hash: ' old'})
+    monkeypatch.setattr(caption_cache, '_engine_version', ['tesseract-5.0'])
+    with CaptionCache(cfg) as cache:
+        assert cache.get_by_urls(['http://a/1.png']) == {}
+        assert cache.get_by_hashes([image_hash]) == {}
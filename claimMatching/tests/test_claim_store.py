@@ -0,0 +1,71 @@
+import json, os
+
+import pytest
+
+from func.claim_store import build_claim_store, is_stale, load_claims
+
+
+def write_json(path, records):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(records, f)
+
+
+def get_cfg(tmp_path):
+    return {'google_dir': str(tmp_path / 'google'), 'ng_dir': str(tmp_path / 'ng'),
+            'json_dir': str(tmp_path / 'misc'), 'languages': ['en', 'es'],
+            'claim_store_path': str(tmp_path / 'claim_store.sqlite')}
+
+
+def review(url):
+    return [{'url': url, 'title': 'review'}]
+
+
+@pytest.fixture
+def sources(tmp_path):
+    write_json(tmp_path / 'google' / 'en' / 'en_covid.json', [
+        {'text': 'Masks cause  hypoxia', 'claimReview': review('https://example.org/masks')},
+        {'text': 'Vaccines alter DNA', 'claimReview': review('https://example.org/dna')}])
+    # an overlapping fetch repeats a claim under another keyword, next to another claim reviewed by the same article
+    write_json(tmp_path / 'google' / 'en' / 'en_vaccine.json', [
+        {'text': 'Vaccines alter your DNA', 'claimReview': review('https://example.org/dna')},
+        {'text': 'masks cause hypoxia'}])
+    write_json(tmp_path / 'google' / 'es' / 'es_covid.json', [
+        {'text': 'Las vacunas alteran el ADN', 'claimReview': review('https://example.org/dna')}])
+    write_json(tmp_path / 'ng' / 'ng.json', [{'id': 1, 'description': 'Garlic cures the virus'},
+                                             {'id': 2, 'description': '5G spreads the virus'}])
+    write_json(tmp_path / 'ng' / 'ng_update.json', [{'id': 2, 'description': '5G networks spread the virus'}])
+    write_json(tmp_path / 'misc' / 'misc.json', [{'id': 1, 'content': 'Bleach cures the virus'},
+                                                 {'id': 3, 'content': 'Garlic cures the virus'},
+                                                 {'content': ''}])
+    return get_cfg(tmp_path)
+
+
+def test_records_merge_by_source_id_and_text(sources):
+    # distinct claims and translations reviewed in the same article are not merged by its url
+    assert load_claims('google', sources) == ['Masks cause  hypoxia', 'Vaccines alter DNA', 'Vaccines alter your DNA',
+                                              'Las vacunas alteran el ADN']
+    assert load_claims('google', dict(sources, languages=['es'])) == ['Las vacunas alteran el ADN']
+    assert load_claims('ng', sources) == ['Garlic cures the virus', '5G spreads the virus']
+    # ids only merge records of the same source, and the identical text still merges across sources
+    assert load_claims('misc_json', sources) == ['Garlic cures the virus', 'Bleach cures the virus']
+
+
+def test_store_is_rebuilt_when_sources_change(sources, tmp_path):
+    build_claim_store(sources)
+    assert not is_stale(sources)
+    write_json(tmp_path / 'misc' / 'more.json', [{'content': 'Hot baths prevent infection'}])
+    assert is_stale(sources)
+    assert 'Hot baths prevent infection' in load_claims('misc_json', sources)
+
+    os.remove(tmp_path / 'misc' / 'more.json')
+    assert is_stale(sources)
+    assert 'Hot baths prevent infection' not in load_claims('misc_json', sources)
+    assert not is_stale(sources)
+    assert is_stale(dict(sources, languages=['en']))
+
+
+def test_empty_source_exits(tmp_path):
+    write_json(tmp_path / 'ng' / 'ng.json', [{'id': 1, 'description': 'Garlic cures the virus'}])
+    with pytest.raises(SystemExit):
+        load_claims('misc_json', get_cfg(tmp_path))
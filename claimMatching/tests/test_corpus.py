@@ -0,0 +1,60 @@
+import json, os, shutil
+
+import pytest
+
+from func.corpus import convert_source, get_corpus_dir, is_stale, load_corpus
+
+
+def write_json(path, records):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(records, f)
+
+
+@pytest.fixture
+def cfg(tmp_path):
+    write_json(tmp_path / 'google' / 'en' / 'en_covid.json', [
+        {'text': 'Masks cause hypoxia'}, {'text': 'Vaccines alter DNA'}, {'text': ''}, {'text': 'Masks cause hypoxia'}])
+    write_json(tmp_path / 'google' / 'es' / 'es_covid.json', [{'text': 'Las vacunas alteran el ADN ñ'}])
+    return {'google_dir': str(tmp_path / 'google'), 'languages': ['en', 'es'],
+            'corpus_dir': str(tmp_path / 'corpus')}
+
+
+def test_corpus_holds_every_text(cfg):
+    corpus = load_corpus('google', cfg)
+    texts = ['Masks cause hypoxia', 'Vaccines alter DNA', 'Masks cause hypoxia', 'Las vacunas alteran el ADN ñ']
+    assert list(corpus) == texts
+    assert corpus[1] == texts[1] and corpus[-1] == texts[-1] and corpus[1:3] == texts[1:3]
+    assert corpus.languages() == ['en', 'en', 'en', 'es']
+    unique = corpus.unique_texts()
+    assert list(unique) == [texts[0], texts[1], texts[3]]
+    assert unique.languages() == ['en', 'en', 'es']
+    with pytest.raises(IndexError):
+        corpus[len(texts)]
+
+
+def test_views_survive_recompilation(cfg, tmp_path):
+    corpus = load_corpus('google', cfg)
+    write_json(tmp_path / 'google' / 'en' / 'en_covid.json', [{'text': 'Garlic cures the virus'}])
+    assert is_stale('google', cfg)
+    assert list(load_corpus('google', cfg)) == ['Garlic cures the virus', 'Las vacunas alteran el ADN ñ']
+    # the replaced corpus was mapped when it was loaded, so its views still read the old files
+    assert list(corpus.unique_texts()) == ['Masks cause hypoxia', 'Vaccines alter DNA', 'Las vacunas alteran el ADN ñ']
+    assert corpus.unique_texts().languages() == ['en', 'en', 'es']
+
+
+def test_conversions_use_their_own_directories(cfg, tmp_path):
+    stale_tmp = get_corpus_dir('google', cfg) + '.tmp'
+    os.makedirs(stale_tmp)
+    convert_source('google', cfg)
+    convert_source('google', cfg)
+    # a leftover directory is not taken over, and no conversion leaves its working directories behind
+    assert sorted(os.listdir(tmp_path / 'corpus')) == ['google', 'google.tmp']
+    shutil.rmtree(stale_tmp)
+    assert not is_stale('google', cfg)
+
+
+def test_empty_source_exits(cfg, tmp_path):
+    write_json(tmp_path / 'google' / 'en' / 'en_covid.json', [{'text': ''}])
+    with pytest.raises(SystemExit):
+        load_corpus('google', dict(cfg, languages=['en']))
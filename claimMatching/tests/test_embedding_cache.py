@@ -0,0 +1,79 @@
+import fcntl, os
+
+import numpy as np
+
+from func.embedding_cache import EmbeddingCache, hash_text
+
+
+def fake_encoder(calls):
+    def encode(documents):
+        calls.append(list(documents))
+        return np.array([[len(document), sum(map(ord, document)) % 97, 1.0] for document in documents])
+    return encode
+
+
+def get_cfg(tmp_path, max_mb=64):
+    return {'embedding_cache_dir': str(tmp_path), 'embedding_cache_max_mb': max_mb}
+
+
+def test_only_uncached_documents_are_encoded(tmp_path):
+    calls = []
+    cache = EmbeddingCache('model', get_cfg(tmp_path))
+    first = cache.encode(['a claim', 'another claim', 'a claim'], fake_encoder(calls))
+    second = EmbeddingCache('model', get_cfg(tmp_path)).encode(['another  claim', 'a third'], fake_encoder(calls))
+    # whitespace differences share an entry, and a reopened cache reads the earlier entries from disk
+    assert calls == [['a claim', 'another claim'], ['a third']]
+    assert np.array_equal(first[1], second[0])
+    assert first.dtype == np.float32
+
+
+def test_orphan_vectors_are_cut_off_on_open(tmp_path):
+    calls = []
+    cache = EmbeddingCache('model', get_cfg(tmp_path))
+    expected = cache.encode(['one', 'two'], fake_encoder(calls))
+    # a run that stopped after writing vectors but before saving the index
+    with open(cache.vector_file, 'ab') as f:
+        f.write(np.ones((3, 3), dtype=np.float32).tobytes())
+
+    reopened = EmbeddingCache('model', get_cfg(tmp_path))
+    assert len(reopened) == 2
+    assert reopened.size_bytes() == 2 * 3 * 4
+    # later appends line up with their keys again
+    embeddings = reopened.encode(['three', 'one', 'two'], fake_encoder(calls))
+    assert np.array_equal(embeddings[1:], expected)
+    assert np.array_equal(embeddings[0], fake_encoder([])(['three'])[0])
+
+
+def test_short_vector_file_empties_the_cache(tmp_path):
+    cache = EmbeddingCache('model', get_cfg(tmp_path))
+    cache.encode(['one', 'two'], fake_encoder([]))
+    with open(cache.vector_file, 'r+b') as f:
+        f.truncate(3 * 4)
+
+    calls = []
+    reopened = EmbeddingCache('model', get_cfg(tmp_path))
+    assert len(reopened) == 0
+    reopened.encode(['one'], fake_encoder(calls))
+    assert calls == [['one']]
+
+
+def test_locked_cache_is_bypassed(tmp_path):
+    directory = tmp_path / 'model'
+    directory.mkdir()
+    with open(directory / 'lock', 'w') as other:
+        fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        calls = []
+        cache = EmbeddingCache('model', get_cfg(tmp_path))
+        embeddings = cache.encode(['one', 'one'], fake_encoder(calls))
+    assert calls == [['one', 'one']]
+    assert embeddings.shape == (2, 3)
+    assert not os.path.exists(cache.vector_file)
+
+
+def test_least_recently_used_vectors_are_evicted(tmp_path):
+    cache = EmbeddingCache('model', get_cfg(tmp_path))
+    cache.encode(['old', 'newer'], fake_encoder([]))
+    cache.access[cache.rows[hash_text('old')]] = 0
+    assert cache.evict(max_bytes=3 * 4) == 1
+    assert list(cache.rows) == [hash_text('newer')]
+    assert len(EmbeddingCache('model', get_cfg(tmp_path))) == 1
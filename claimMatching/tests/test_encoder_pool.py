@@ -0,0 +1,49 @@
+from concurrent.futures import ThreadPoolExecutor
+import json, threading, time
+
+import numpy as np
+
+from func import encoder_pool
+from func.ann_index import fingerprint_candidates
+from func.encoder_pool import MODEL_META, EncoderPool, get_model_name
+
+
+class FakeModel:
+    def encode(self, documents, batch_size, show_progress_bar):
+        return np.array([[len(document), document.count('a')] for document in documents], dtype=np.float32)
+
+
+def test_concurrent_encodes_load_the_model_once(monkeypatch):
+    loads = []
+    lock = threading.Lock()
+
+    def load_model(model_weights, cfg):
+        with lock:
+            loads.append(model_weights)
+        # a slow load gives every thread the chance to find the model missing
+        time.sleep(0.2)
+        return FakeModel()
+    monkeypatch.setattr(encoder_pool, 'load_model', load_model)
+    documents = ['a longer banana document', 'a', 'bb aa', 'cat']
+    with EncoderPool('model', {'encode_workers': 1, 'encode_batch_size': 1}) as encoder:
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(lambda _: encoder.encode(documents), range(8)))
+    assert loads == ['model']
+    # documents are encoded shortest first, and the embeddings are returned in the documents' order
+    for embeddings in results:
+        assert embeddings.tolist() == [[len(document), document.count('a')] for document in documents]
+
+
+def test_model_name_tracks_quantization_and_fine_tuning(tmp_path):
+    assert get_model_name('weights', {}) == 'weights'
+    assert get_model_name('weights', {'quantize_model': True}) == 'weights-qint8'
+    with open(tmp_path / MODEL_META, 'w') as f:
+        json.dump({'version': '20260101-000000'}, f)
+    assert get_model_name(str(tmp_path) + '/', {}) == str(tmp_path) + '-20260101-000000'
+
+
+def test_index_fingerprint_changes_with_the_model_quantization():
+    docs = ['claim one', 'claim two']
+    cfg = {'model': 'weights', 'index_type': 'hnsw'}
+    assert fingerprint_candidates(docs, cfg) == fingerprint_candidates(docs, dict(cfg))
+    assert fingerprint_candidates(docs, cfg) != fingerprint_candidates(docs, dict(cfg, quantize_model=True))
@@ -0,0 +1,88 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import json, os, threading
+
+import pytest
+
+from func.get_google_fact_check import fetch_api_data
+
+
+class FactCheckHandler(BaseHTTPRequestHandler):
+    """
+    Serves two pages of claims per query. Queued failures are answered before the real page, one per request.
+    """
+    failures = {}
+    requests_seen = []
+
+    def do_GET(self):
+        params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        page = int(params.get('pageToken', 1))
+        self.requests_seen.append((params['query'], params['languageCode'], page))
+        queued = self.failures.get((params['query'], page))
+        if queued:
+            status, body = queued.pop(0)
+        else:
+            claims = [{'text': params['query'] + ' claim ' + str(page) + '-' + str(index),
+                       'languageCode': params['languageCode']} for index in range(2)]
+            status, body = 200, json.dumps({'claims': claims, **({'nextPageToken': '2'} if page == 1 else {})})
+        payload = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fact_check_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FactCheckHandler)
+    FactCheckHandler.failures = {}
+    FactCheckHandler.requests_seen = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:' + str(server.server_address[1]) + '/claims:search'
+    server.shutdown()
+    server.server_close()
+
+
+def get_cfg(tmp_path, url, **overrides):
+    for language in ['en', 'es']:
+        os.makedirs(tmp_path / language, exist_ok=True)
+    cfg = {'google_dir': str(tmp_path), 'keywords': ['covid', 'vaccine'], 'languages': ['en', 'es'],
+           'fact_check_url': url, 'fetch_workers': 2, 'fetch_rate': 1000, 'fetch_burst': 10, 'fetch_retries': 3,
+           'fetch_backoff_base': 0.01, 'fetch_backoff_max': 0.05, 'fetch_timeout': 5}
+    cfg.update(overrides)
+    return cfg
+
+
+def read_claims(tmp_path, language, keyword):
+    with open(tmp_path / language / (language + '_' + keyword + '.json')) as f:
+        return [claim['text'] for claim in json.load(f)]
+
+
+def test_malformed_and_rate_limited_pages_are_retried(tmp_path, fact_check_server):
+    FactCheckHandler.failures = {('covid', 2): [(200, '{"claims": [{"text": '), (200, '[]')],
+                                 ('vaccine', 1): [(429, '{}')]}
+    fetch_api_data('key', get_cfg(tmp_path, fact_check_server))
+    for keyword in ['covid', 'vaccine']:
+        for language in ['en', 'es']:
+            assert read_claims(tmp_path, language, keyword) == [
+                keyword + ' claim 1-0', keyword + ' claim 1-1', keyword + ' claim 2-0', keyword + ' claim 2-1']
+            assert not os.path.exists(tmp_path / language / (language + '_' + keyword + '.json.partial'))
+
+
+def test_failed_fetch_resumes_from_checkpoint(tmp_path, fact_check_server):
+    FactCheckHandler.failures = {('covid', 2): [(400, '{"error": "bad request"}')]}
+    cfg = get_cfg(tmp_path, fact_check_server, keywords=['covid'], languages=['en'])
+    with pytest.raises(SystemExit):
+        fetch_api_data('key', cfg)
+    assert not os.path.exists(tmp_path / 'en' / 'en_covid.json')
+
+    FactCheckHandler.requests_seen = []
+    fetch_api_data('key', cfg)
+    # only the page that failed is fetched again
+    assert FactCheckHandler.requests_seen == [('covid', 'en', 2)]
+    assert read_claims(tmp_path, 'en', 'covid') == ['covid claim 1-0', 'covid claim 1-1', 'covid claim 2-0',
+                                                    'covid claim 2-1']
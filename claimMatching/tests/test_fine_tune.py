@@ -0,0 +1,59 @@
+import pickle
+
+from func.fine_tune import BucketBatchSampler, PairCollator, get_schedule, meets_version, split_pairs
+
+
+class FakeTokenizer:
+    def __call__(self, texts, **kwargs):
+        return {'texts': texts, 'max_length': kwargs['max_length']}
+
+
+def make_pairs(count):
+    return [('anchor ' + 'word ' * (index % 7) + str(index), 'positive ' + str(index)) for index in range(count)]
+
+
+def test_versions_are_compared_numerically():
+    assert meets_version('1.7.1+cpu', (1, 7))
+    assert meets_version('1.10.0', (1, 7))
+    assert meets_version('2.2.2', (1, 0))
+    assert not meets_version('1.5.1', (1, 7))
+    assert not meets_version('0.3.0', (1, 0))
+    assert not meets_version('unknown', (1, 0))
+
+
+def test_collator_only_holds_the_tokenizer():
+    collator = pickle.loads(pickle.dumps(PairCollator(FakeTokenizer(), 128)))
+    anchors, positives = collator([(' a ', 'b'), ('c', 'd ')])
+    assert anchors == {'texts': ['a', 'c'], 'max_length': 128}
+    assert positives == {'texts': ['b', 'd'], 'max_length': 128}
+
+
+def test_batches_cover_every_pair_without_repeated_texts():
+    pairs = make_pairs(500) + [('anchor 0', 'another positive')]
+    sampler = BucketBatchSampler(pairs, 16, seed=3)
+    for epoch in (0, 1):
+        sampler.set_epoch(epoch)
+        batches = list(sampler)
+        assert sorted(index for batch in batches for index in batch) == list(range(len(pairs)))
+        for batch in batches:
+            assert len(batch) <= 16
+            texts = [text for index in batch for text in pairs[index]]
+            assert len(texts) == len(set(texts))
+    # a resumed run draws the same batches for an epoch
+    resumed = BucketBatchSampler(pairs, 16, seed=3)
+    resumed.set_epoch(1)
+    assert resumed.batches == sampler.batches
+
+
+def test_split_keeps_an_anchor_on_one_side():
+    pairs = make_pairs(1000)
+    train, held_out = split_pairs(pairs, 0.1)
+    assert 50 < len(held_out) < 150 and len(train) + len(held_out) == len(pairs)
+    _, held_out_again = split_pairs(pairs + make_pairs(2000)[1000:], 0.1)
+    assert set(held_out) <= set(held_out_again)
+
+
+def test_schedule_warms_up_then_decays():
+    schedule = get_schedule(10, 110)
+    assert schedule(0) == 0 and schedule(5) == 0.5 and schedule(10) == 1
+    assert schedule(60) == 0.5 and schedule(110) == 0
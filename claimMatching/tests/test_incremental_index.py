@@ -0,0 +1,182 @@
+import json, os
+
+import numpy as np
+import pytest
+
+from func import match_claims
+from func.ann_index import ExactIndex, exclude_ids
+from func.incremental_index import IncrementalIndex
+
+DOCS = ['claim ' + str(index) for index in range(100)]
+
+
+def embed(documents):
+    return np.array([np.random.default_rng(int(doc.split()[1])).standard_normal(16) for doc in documents])
+
+
+class CountingEncoder:
+    def __init__(self):
+        self.encoded = []
+
+    def __call__(self, documents):
+        self.encoded.extend(documents)
+        return embed(documents)
+
+
+class FakeEncoderPool:
+    def __init__(self, model, cfg):
+        self.encode = embed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+
+class FakeMatchWriter:
+    written = []
+
+    def __init__(self, search_set, candidate_set, candidate_docs, cfg):
+        self.num_searched = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def write(self, search_docs, matches, distances, indices):
+        self.written.append((search_docs, indices))
+        self.num_searched += len(search_docs)
+
+
+def get_cfg(tmp_path, **overrides):
+    cfg = {'model': 'model', 'index_dir': str(tmp_path), 'index_type': 'exact', 'compaction_ratio': 0.2}
+    cfg.update(overrides)
+    return cfg
+
+
+def assert_matches_exact(index, documents, cfg):
+    queries = embed(DOCS[:10]) + 0.3
+    distances, indices = index.search(queries, 5)
+    expected_distances, expected_indices = ExactIndex(embed(documents), cfg).search(queries, 5)
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(distances, expected_distances, atol=1e-5)
+
+
+def test_only_new_documents_are_encoded(tmp_path):
+    cfg = get_cfg(tmp_path)
+    encoder = CountingEncoder()
+    IncrementalIndex('ng', cfg).sync(DOCS[:60], encoder)
+    assert len(encoder.encoded) == 60
+
+    encoder = CountingEncoder()
+    documents = DOCS[5:70]
+    index = IncrementalIndex('ng', cfg).sync(documents, encoder)
+    assert encoder.encoded == DOCS[60:70]
+    assert len(index) == len(documents)
+    # five of 70 rows are tombstoned, too few to compact
+    assert len(index.keys) == 70 and int(index.alive.sum()) == 65
+    assert_matches_exact(index, documents, cfg)
+    first = embed(documents[:1])[0]
+    np.testing.assert_allclose(index.doc_embeddings()[0], first / np.linalg.norm(first), atol=1e-6)
+
+
+def test_removed_rows_are_compacted(tmp_path):
+    cfg = get_cfg(tmp_path)
+    IncrementalIndex('ng', cfg).sync(DOCS, CountingEncoder())
+    documents = DOCS[40:] + DOCS[:10]
+    index = IncrementalIndex('ng', cfg).sync(documents, CountingEncoder())
+    assert len(index.keys) == 70 and index.alive.all()
+    assert_matches_exact(index, documents, cfg)
+
+    # a reloaded index needs no encoding when the candidates are unchanged
+    encoder = CountingEncoder()
+    index = IncrementalIndex('ng', cfg).sync(documents, encoder)
+    assert encoder.encoded == []
+    assert_matches_exact(index, documents, cfg)
+
+
+def test_approximate_index_skips_tombstoned_rows(tmp_path):
+    pytest.importorskip('faiss')
+    cfg = get_cfg(tmp_path, index_type='hnsw')
+    IncrementalIndex('ng', cfg).sync(DOCS, CountingEncoder())
+    documents = DOCS[:90]
+    index = IncrementalIndex('ng', cfg).sync(documents, CountingEncoder())
+    assert index.ann is not None
+    _, indices = index.search(embed(DOCS[90:]), 5)
+    assert ((indices >= 0) & (indices < len(documents))).all()
+
+
+def test_rows_appended_after_the_last_save_are_cut_off(tmp_path):
+    cfg = get_cfg(tmp_path)
+    index = IncrementalIndex('ng', cfg).sync(DOCS[:50], CountingEncoder())
+    # a run stopped after appending vectors but before saving the metadata
+    index.append([b'x' * 40] * 3, np.ones((3, 16), dtype=np.float32))
+    assert os.path.getsize(index.vector_file) == 53 * 16 * 4
+
+    index = IncrementalIndex('ng', cfg)
+    assert os.path.getsize(index.vector_file) == 50 * 16 * 4 and len(index.keys) == 50
+    encoder = CountingEncoder()
+    index.sync(DOCS[:60], encoder)
+    assert encoder.encoded == DOCS[50:60]
+    assert_matches_exact(index, DOCS[:60], cfg)
+
+
+def test_stopped_compaction_keeps_the_previous_generation(tmp_path, monkeypatch):
+    cfg = get_cfg(tmp_path)
+    IncrementalIndex('ng', cfg).sync(DOCS, CountingEncoder())
+    index = IncrementalIndex('ng', cfg)
+    index.alive[:50] = False
+
+    # a run stopped after writing the compacted matrix but before saving the metadata that names it
+    def stop():
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(index, 'save', stop)
+    with pytest.raises(KeyboardInterrupt):
+        index.compact()
+    assert os.path.isfile(index.vector_file) and index.generation == 1
+    with open(index.meta_file) as f:
+        assert json.load(f)['generation'] == 0
+
+    index = IncrementalIndex('ng', cfg)
+    assert index.generation == 0 and len(index.keys) == 100
+    encoder = CountingEncoder()
+    index.sync(DOCS, encoder)
+    assert encoder.encoded == []
+    assert_matches_exact(index, DOCS, cfg)
+
+
+def test_locked_index_is_built_in_a_temporary_directory(tmp_path):
+    fcntl = pytest.importorskip('fcntl')
+    cfg = get_cfg(tmp_path)
+    directory = tmp_path / 'ng-incremental' / 'model'
+    os.makedirs(directory)
+    with open(directory / 'lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        encoder = CountingEncoder()
+        index = IncrementalIndex('ng', cfg).sync(DOCS[:20], encoder)
+        assert len(encoder.encoded) == 20 and index.directory != str(directory)
+        assert_matches_exact(index, DOCS[:20], cfg)
+    assert os.listdir(directory) == ['lock']
+
+
+def test_filtered_search_set_is_matched_against_the_whole_candidate_set(tmp_path, monkeypatch):
+    monkeypatch.setattr(match_claims, 'EncoderPool', FakeEncoderPool)
+    monkeypatch.setattr(match_claims, 'MatchWriter', FakeMatchWriter)
+    cfg = get_cfg(tmp_path, incremental_index=True, num_matches=5)
+    candidates = DOCS[:30]
+    search_docs = DOCS[10:20]
+    match_claims.retrieve_nearest(search_docs, candidates, [], 'ng', 'ng', cfg)
+    written_docs, indices = FakeMatchWriter.written.pop()
+    assert written_docs == search_docs
+    # each search document is left out of its own matches by its position among the candidates
+    search_ids = np.arange(10, 20)
+    distances, expected = ExactIndex(embed(candidates), cfg).search(embed(search_docs), 6)
+    _, expected = exclude_ids(distances, expected, search_ids, 5)
+    np.testing.assert_array_equal(indices, expected)
@@ -0,0 +1,26 @@
+from func.keyword_filter import KeywordMatcher, filter_documents
+
+KEYWORDS = ['vaccine', 'Bill Gates', 'gates foundation', 'bill gates foundation funds', 'masks']
+
+
+def test_words_and_phrases_are_matched_in_order():
+    matcher = KeywordMatcher(KEYWORDS)
+    assert matcher.match('The Bill Gates Foundation funds the vaccine') == [
+        'bill gates', 'gates foundation', 'bill gates foundation funds', 'vaccine']
+    assert matcher.match('masks and masks') == ['masks']
+    # phrases only match whole consecutive words
+    assert matcher.match('bill and gates foundations') == []
+
+
+def test_failure_links_find_overlapping_phrases():
+    matcher = KeywordMatcher(['a b c d', 'b c', 'c d e'])
+    assert matcher.match('a b c d e') == ['b c', 'a b c d', 'c d e']
+    assert matcher.match('a b c e') == ['b c']
+
+
+def test_filter_keeps_documents_with_keywords():
+    documents = ['vaccine news', 'nothing here', 'what bill gates said', 'masks work'] * 5
+    expected = ([doc for doc in documents if doc != 'nothing here'],
+                [['vaccine'], ['bill gates'], ['masks']] * 5)
+    assert filter_documents(documents, KEYWORDS) == expected
+    assert filter_documents(documents, KEYWORDS, workers=2) == expected
@@ -0,0 +1,67 @@
+import numpy as np
+
+from func.ann_index import ExactIndex, index_top_matches
+from func.lexical_index import LexicalIndex, shortlist_top_matches
+
+CANDIDATES = ['masks cause hypoxia in children', 'vaccines alter your dna', 'garlic cures the virus',
+              '5g towers spread the virus', 'bleach cures the virus', 'masks do not cause hypoxia',
+              'the vaccine contains a microchip', 'hot baths prevent the virus']
+SEARCH = ['do masks cause hypoxia', 'garlic and bleach cures', 'microchip in the vaccine', 'nothing about the virus']
+
+
+def get_cfg(**overrides):
+    cfg = {'num_matches': 2, 'lexical_shortlist': 3, 'lexical_max_df': 0.3}
+    cfg.update(overrides)
+    return cfg
+
+
+def embed(documents):
+    rng = np.random.default_rng(0)
+    vocabulary = {word: rng.standard_normal(16) for word in sorted(set(' '.join(CANDIDATES + SEARCH).split()))}
+    return np.array([sum(vocabulary[word] for word in document.split()) for document in documents])
+
+
+def test_shortlist_ranks_candidates_sharing_rare_words():
+    index = LexicalIndex(CANDIDATES, get_cfg())
+    shortlist = index.shortlist(SEARCH, 3)
+    assert sorted(shortlist[0][:2]) == [0, 5]
+    assert sorted(shortlist[1][:2]) == [2, 4]
+    assert shortlist[2][0] == 6
+    # "the" and "virus" are in too many candidates to shortlist with, so nothing is found
+    assert list(shortlist[3]) == [-1, -1, -1]
+
+
+def test_shortlisted_candidates_are_ranked_exactly():
+    cfg = get_cfg(lexical_shortlist=len(CANDIDATES), lexical_max_df=1.0)
+    index = LexicalIndex(CANDIDATES, cfg)
+    distances, indices, num_fallback = shortlist_top_matches(index, SEARCH, embed(SEARCH), embed(CANDIDATES),
+                                                             'tweets', 'ng', cfg)
+    # with every word usable, each search document shares a word with some candidate
+    assert num_fallback == 0
+    for row, shortlist in enumerate(index.shortlist(SEARCH, len(CANDIDATES))):
+        shortlist = shortlist[shortlist >= 0]
+        expected_distances, expected_indices = ExactIndex(embed(CANDIDATES)[shortlist], cfg).search(
+            embed(SEARCH[row:row + 1]), 2)
+        np.testing.assert_array_equal(indices[row], shortlist[expected_indices[0]])
+        np.testing.assert_allclose(distances[row], expected_distances[0])
+
+
+def test_unshortlisted_documents_fall_back_to_exhaustive_search():
+    cfg = get_cfg()
+    distances, indices, num_fallback = shortlist_top_matches(LexicalIndex(CANDIDATES, cfg), SEARCH, embed(SEARCH),
+                                                             embed(CANDIDATES), 'tweets', 'ng', cfg)
+    expected_distances, expected_indices = index_top_matches(ExactIndex(embed(CANDIDATES), cfg), embed(SEARCH),
+                                                             'tweets', 'ng', cfg)
+    assert num_fallback == 1
+    np.testing.assert_array_equal(indices[3], expected_indices[3])
+    np.testing.assert_allclose(distances[3], expected_distances[3])
+
+
+def test_own_candidate_is_excluded():
+    cfg = get_cfg()
+    index = LexicalIndex(CANDIDATES, cfg)
+    embeddings = embed(CANDIDATES)
+    distances, indices, _ = shortlist_top_matches(index, CANDIDATES, embeddings, embeddings, 'ng', 'ng', cfg)
+    assert indices.shape == (len(CANDIDATES), 2)
+    assert not (indices == np.arange(len(CANDIDATES)).reshape(-1, 1)).any()
+    assert indices[0][0] == 5 and indices[5][0] == 0
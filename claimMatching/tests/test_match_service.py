@@ -0,0 +1,107 @@
+from concurrent.futures import ThreadPoolExecutor
+import http.client, json, threading
+
+import numpy as np
+import pytest
+
+from func import match_service
+from func.ann_index import ExactIndex
+
+CANDIDATES = ['aaa', 'bbb', 'aab', 'abb', 'ccc']
+
+
+def fake_encode(documents):
+    if 'boom' in documents:
+        raise RuntimeError('encoder failed')
+    return np.array([[doc.count('a'), doc.count('b'), doc.count('c')] for doc in documents], dtype=np.float32)
+
+
+class FakeEncoderPool:
+    def __init__(self, model, cfg):
+        self.encode = fake_encode
+
+
+class FakeCandidateState:
+    def __init__(self, candidate_set, encode_fn, prune_duplicates, cfg):
+        self.snapshot = []
+        self.candidate_docs = CANDIDATES
+        self.index = ExactIndex(encode_fn(CANDIDATES), cfg)
+        self.loaded_at = 0.0
+        self.load_seconds = 0.0
+
+
+@pytest.fixture(scope='module', params=[True, False], ids=['batched', 'direct'])
+def server(request):
+    cfg = {'model': 'fake', 'num_matches': 2, 'service_batching': request.param, 'service_max_k': 4,
+           'service_max_texts': 3}
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(match_service, 'EncoderPool', FakeEncoderPool)
+        monkeypatch.setattr(match_service, 'CandidateState', FakeCandidateState)
+        service = match_service.MatchService('ng', False, cfg)
+    server = match_service.MatchServer(('127.0.0.1', 0), match_service.make_handler(service))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+    service.close()
+
+
+def post(port, body, path='/match'):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    conn.request('POST', path, body if isinstance(body, bytes) else json.dumps(body).encode('utf-8'),
+                 {'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    status, payload = response.status, json.loads(response.read())
+    conn.close()
+    return status, payload
+
+
+def test_match_returns_top_k(server):
+    status, payload = post(server, {'texts': ['aaa', 'bbb'], 'k': 3})
+    assert status == 200
+    assert [[match['text'] for match in result] for result in payload['results']] == [
+        ['aaa', 'aab', 'abb'], ['bbb', 'abb', 'aab']]
+    status, payload = post(server, {'texts': ['ccc']})
+    assert status == 200 and len(payload['results'][0]) == 2
+
+
+@pytest.mark.parametrize('body', [
+    {'texts': ['aaa'], 'k': '3'}, {'texts': ['aaa'], 'k': -1}, {'texts': ['aaa'], 'k': 0},
+    {'texts': ['aaa'], 'k': 2.5}, {'texts': ['aaa'], 'k': True}, {'texts': ['aaa'], 'k': 5},
+    {'texts': 'aaa'}, {'texts': ['aaa', 1]}, {'texts': ['a', 'b', 'c', 'd']}, ['aaa'], 'aaa', None])
+def test_invalid_requests_are_rejected(server, body):
+    status, payload = post(server, body)
+    assert status == 400
+    assert payload['error']
+
+
+def test_malformed_json_is_rejected(server):
+    assert post(server, b'{"texts": [')[0] == 400
+
+
+def test_failures_are_answered_with_500(server):
+    status, payload = post(server, {'texts': ['boom']})
+    assert status == 500
+    assert 'encoder failed' in payload['error']
+    # the service keeps answering after a failed request
+    assert post(server, {'texts': ['aaa'], 'k': 1})[0] == 200
+
+
+def test_lexical_shortlist_is_reported_as_ignored(monkeypatch, capsys):
+    monkeypatch.setattr(match_service, 'EncoderPool', FakeEncoderPool)
+    monkeypatch.setattr(match_service, 'CandidateState', FakeCandidateState)
+    match_service.MatchService('ng', False, {'model': 'fake', 'num_matches': 2, 'service_batching': False,
+                                             'lexical_shortlist': 50}).close()
+    assert 'lexical_shortlist is ignored' in capsys.readouterr().out
+
+
+def test_concurrent_requests_are_all_counted(monkeypatch):
+    monkeypatch.setattr(match_service, 'EncoderPool', FakeEncoderPool)
+    monkeypatch.setattr(match_service, 'CandidateState', FakeCandidateState)
+    service = match_service.MatchService('ng', False, {'model': 'fake', 'num_matches': 2})
+    try:
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(lambda request: service.match(['aaa', 'bbb'], 1), range(200)))
+        assert service.num_requests == 200 and service.num_texts == 400
+    finally:
+        service.close()
@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+import orjson
+import pytest
+
+from func.match_writer import MatchWriter
+
+CANDIDATES = ['claim zero', 'claim one', 'claim two', 'claim three']
+
+
+def get_cfg(tmp_path, formats):
+    return {'output_dir': str(tmp_path), 'output_formats': formats, 'model': 'model', 'languages': ['en'],
+            'num_matches': 2}
+
+
+def write_batches(writer):
+    writer.write(['first tweet', 'second tweet'], [['vaccine'], None],
+                 [np.array([0.1, 0.2]), np.array([0.3, 0.4])], [np.array([2, 0]), np.array([2, -1])])
+    writer.write(['third tweet'], [['mask', 'virus']], [np.array([0.5, 0.6])], [np.array([3, 0])])
+
+
+def get_output(tmp_path, suffix):
+    files = [file for file in os.listdir(tmp_path) if file.endswith(suffix)]
+    assert len(files) == 1
+    return os.path.join(tmp_path, files[0])
+
+
+def test_jsonl_records(tmp_path):
+    with MatchWriter('tweets', 'ng', CANDIDATES, get_cfg(tmp_path, ['txt', 'jsonl'])) as writer:
+        write_batches(writer)
+    with open(get_output(tmp_path, '.matches.jsonl'), 'rb') as f:
+        matches = [orjson.loads(line) for line in f]
+    with open(get_output(tmp_path, '.candidates.jsonl'), 'rb') as f:
+        candidates = [orjson.loads(line) for line in f]
+    assert [match['search_id'] for match in matches] == [0, 1, 2]
+    # missing neighbours are dropped and ranks follow the index order
+    assert matches[1]['matches'] == [{'rank': 1, 'candidate_id': 2, 'distance': 0.3}]
+    assert candidates == [{'candidate_id': 2, 'text': 'claim two'}, {'candidate_id': 0, 'text': 'claim zero'},
+                          {'candidate_id': 3, 'text': 'claim three'}]
+    with open(get_output(tmp_path, '.run.json'), 'rb') as f:
+        assert orjson.loads(f.read())['num_searched'] == 3
+    with open(get_output(tmp_path, '.txt')) as f:
+        assert f.read().count('Search set item:') == 3
+
+
+def test_parquet_writes_a_row_group_per_batch(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    with MatchWriter('tweets', 'ng', CANDIDATES, get_cfg(tmp_path, ['parquet'])) as writer:
+        write_batches(writer)
+        # nothing is buffered once a batch is written
+        assert all(len(column) == 0 for table in writer.columns.values() for column in table.values())
+
+    matches_file = pq.ParquetFile(get_output(tmp_path, '.matches.parquet'))
+    assert matches_file.num_row_groups == 2
+    matches = matches_file.read().to_pydict()
+    assert matches['search_id'] == [0, 1, 2]
+    assert matches['keywords'] == [['vaccine'], [], ['mask', 'virus']]
+    assert matches['candidate_ids'] == [[2, 0], [2], [3, 0]]
+    assert matches['distances'] == [[0.1, 0.2], [0.3], [0.5, 0.6]]
+    assert matches_file.schema_arrow.metadata[b'candidate_set'] == b'ng'
+    candidates = pq.read_table(get_output(tmp_path, '.candidates.parquet')).to_pydict()
+    assert candidates == {'candidate_id': [2, 0, 3], 'text': ['claim two', 'claim zero', 'claim three']}
@@ -0,0 +1,147 @@
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+import json, threading
+
+import pytest
+from PIL import Image
+
+pytest.importorskip('pytesseract')
+from func import media_loader, tweet_loader
+
+IMAGE_SIZES = {'/wide.png': (40, 10), '/tall.png': (10, 40)}
+
+
+def make_png(size):
+    buffer = BytesIO()
+    Image.new('RGB', size, 'white').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    requests_seen = []
+
+    def do_GET(self):
+        self.requests_seen.append(self.path)
+        if self.path not in IMAGE_SIZES:
+            self.send_error(404)
+            return
+        body = make_png(IMAGE_SIZES[self.path])
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def image_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+    ImageHandler.requests_seen = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:' + str(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def stub_ocr(monkeypatch):
+    # tesseract is replaced by a caption describing the stub image's size
+    monkeypatch.setattr(media_loader, 'caption_image', lambda image: ' [%dx%d]' % image.size)
+
+
+@pytest.fixture
+def counted_pools(monkeypatch):
+    pools = []
+
+    def create_ocr_pool(cfg):
+        pools.append(ThreadPoolExecutor(max_workers=2))
+        return pools[-1]
+    monkeypatch.setattr(media_loader, 'create_ocr_pool', create_ocr_pool)
+    return pools
+
+
+def make_tweet(text, lang='en', image_url=None):
+    tweet = {'full_text': text, 'lang': lang}
+    if image_url:
+        tweet['entities'] = {'media': [{'type': 'photo', 'media_url_https': image_url}]}
+    return tweet
+
+
+def write_tweets(tmp_path, name, tweets):
+    with open(tmp_path / name, 'w') as f:
+        for tweet in tweets:
+            f.write(json.dumps(tweet) + '\n')
+
+
+def get_cfg(tmp_path, **overrides):
+    cfg = {'tweet_dir': str(tmp_path), 'tweet_files': [r'tweets_\d\.jsonl'], 'num_entries': 0,
+           'remove_text_only': False, 'ingest_workers': 1, 'media_batch_size': 2, 'media_retries': 0,
+           'media_timeout': 5, 'media_download_workers': 2, 'ocr_workers': 2, 'use_caption_cache': False}
+    cfg.update(overrides)
+    return cfg
+
+
+ENGLISH = ['The vaccine was tested on thousands of people before it was approved for use',
+           'Masks reduce the spread of the virus according to several large studies',
+           'The president said that the schools will reopen in the fall for all students',
+           'Drinking bleach does not cure the disease and doctors warn that it is very dangerous']
+SPANISH = 'La vacuna fue probada en miles de personas antes de ser aprobada para su uso'
+
+
+def test_local_tweets_keep_their_order(tmp_path, image_server, stub_ocr, counted_pools):
+    write_tweets(tmp_path, 'tweets_1.jsonl', [
+        make_tweet(ENGLISH[0], image_url=image_server + '/wide.png'),
+        make_tweet(SPANISH, lang='es', image_url=image_server + '/tall.png'),
+        make_tweet(ENGLISH[1]),
+        make_tweet(ENGLISH[2], image_url=image_server + '/missing.png')])
+    write_tweets(tmp_path, 'tweets_2.jsonl', [make_tweet(ENGLISH[3], image_url=image_server + '/tall.png')])
+
+    tweets = tweet_loader.get_local_tweet_data(True, get_cfg(tmp_path))
+    assert [tweet['full_text'] for tweet in tweets] == [
+        ENGLISH[0] + ' [40x10]', ENGLISH[1], ENGLISH[2], ENGLISH[3] + ' [10x40]']
+    # non-English tweets are dropped before their media is fetched, and every batch shares one OCR pool
+    assert sorted(ImageHandler.requests_seen) == ['/missing.png', '/tall.png', '/wide.png']
+    assert len(counted_pools) == 1
+
+
+def test_text_only_tweets_are_removed(tmp_path, image_server, stub_ocr, counted_pools):
+    write_tweets(tmp_path, 'tweets_1.jsonl', [
+        make_tweet(ENGLISH[0]),
+        make_tweet(ENGLISH[1], image_url=image_server + '/tall.png'),
+        make_tweet(SPANISH, lang='es'),
+        make_tweet(ENGLISH[2], image_url=image_server + '/wide.png')])
+
+    tweets = tweet_loader.get_local_tweet_data(True, get_cfg(tmp_path, remove_text_only=True, num_entries=2))
+    assert [tweet['full_text'] for tweet in tweets] == [ENGLISH[1] + ' [10x40]', ENGLISH[2] + ' [40x10]']
+
+
+def test_text_tweets_skip_captioning(tmp_path, counted_pools):
+    write_tweets(tmp_path, 'tweets_1.jsonl', [make_tweet(ENGLISH[0], image_url='http://127.0.0.1:9/a.png'),
+                                              make_tweet(SPANISH, lang='es')])
+    tweets = tweet_loader.get_local_tweet_data(False, get_cfg(tmp_path))
+    assert [tweet['full_text'] for tweet in tweets] == [ENGLISH[0]]
+    assert counted_pools == []
+
+
+def test_failed_captions_are_retried(tmp_path, image_server, monkeypatch):
+    cfg = get_cfg(tmp_path, ocr_workers=1, use_caption_cache=True,
+                  caption_cache_path=str(tmp_path / 'captions.sqlite'))
+    urls = [image_server + '/wide.png', image_server + '/tall.png']
+
+    def flaky_caption(image):
+        if image.size == (10, 40):
+            raise media_loader.pytesseract.TesseractError(1, 'busy')
+        return ' [%dx%d]' % image.size
+    monkeypatch.setattr(media_loader, 'caption_image', flaky_caption)
+    assert media_loader.caption_urls(urls, cfg) == {urls[0]: ' [40x10]', urls[1]: ''}
+
+    monkeypatch.setattr(media_loader, 'caption_image', lambda image: ' [%dx%d]' % image.size)
+    ImageHandler.requests_seen = []
+    assert media_loader.caption_urls(urls, cfg) == {urls[0]: ' [40x10]', urls[1]: ' [10x40]'}
+    # the caption that succeeded came from the cache, the one that failed was fetched and captioned again
+    assert ImageHandler.requests_seen == ['/tall.png']
@@ -0,0 +1,65 @@
+import json, time
+
+import numpy as np
+import pytest
+
+from func import match_claims
+from func.metrics import METRICS, Metrics
+
+DOCS = ['claim ' + str(index) for index in range(20)]
+
+
+@pytest.fixture
+def metrics(monkeypatch):
+    registry = Metrics()
+    monkeypatch.setattr(match_claims, 'METRICS', registry)
+    return registry
+
+
+def slow_encode(documents):
+    time.sleep(0.05)
+    return np.random.default_rng(len(documents)).standard_normal((len(documents), 8))
+
+
+def get_stages(registry):
+    return {(name, dict(labels)['set']): value for (name, labels), value in registry.stages.items()}
+
+
+def test_stages_record_time_and_counts(tmp_path):
+    registry = Metrics()
+    registry.configure({'metrics_log': str(tmp_path / 'metrics.jsonl')})
+    for documents in (3, 4):
+        with registry.stage('load', set='ng') as counts:
+            counts['documents'] = documents
+    registry.set('service_requests', 2)
+
+    calls, seconds = registry.stages[('load', (('set', 'ng'),))]
+    assert calls == 2 and seconds >= 0
+    text = registry.prometheus_text()
+    assert 'claim_matcher_stage_runs_total{set="ng",stage="load"} 2' in text
+    assert 'claim_matcher_documents_total{set="ng",stage="load"} 7' in text
+    assert 'claim_matcher_service_requests 2' in text
+    with open(tmp_path / 'metrics.jsonl') as f:
+        lines = [json.loads(line) for line in f]
+    assert [line['documents'] for line in lines] == [3, 4]
+
+
+def test_encoding_is_not_timed_as_indexing(tmp_path, metrics):
+    cfg = {'model': 'model', 'index_dir': str(tmp_path), 'index_type': 'exact'}
+    match_claims.index_candidate_set(DOCS, 'ng', slow_encode, cfg)
+    stages = get_stages(metrics)
+    assert stages[('encode', 'ng')][1] >= 0.05
+    assert stages[('index', 'ng')][1] < 0.05
+
+
+def test_incremental_sync_splits_encode_and_index(tmp_path, metrics):
+    cfg = {'model': 'model', 'index_dir': str(tmp_path), 'index_type': 'exact', 'incremental_index': True}
+    match_claims.index_candidate_set(DOCS[:15], 'ng', slow_encode, cfg)
+    match_claims.index_candidate_set(DOCS, 'ng', slow_encode, cfg)
+    stages = get_stages(metrics)
+    assert stages[('encode', 'ng')][0] == 2 and stages[('encode', 'ng')][1] >= 0.1
+    assert stages[('index', 'ng')][1] < 0.1
+    counters = {(name, key[0]): value for (name, key), value in metrics.counters.items()}
+    # only the candidates added by the second sync were encoded again
+    assert counters[('documents', 'encode')] == 20
+    assert counters[('documents', 'index')] == 35
@@ -0,0 +1,42 @@
+from itertools import permutations
+
+import numpy as np
+
+from func import near_duplicates
+from func.near_duplicates import collapse_near_duplicates, normalize_document
+
+UNRELATED = 'drinking hot water every hour will flush the virus out of your throat'
+CFG = {'near_duplicate_threshold': 0.6, 'minhash_permutations': 8, 'lsh_bands': 4}
+# a and b agree on 6 of 8 hashes and b and c on 5, but a and c only on 4. b and c share no LSH bucket without a, so
+# comparing documents with the first member of a bucket alone would make the clusters depend on the order
+SIGNATURES = {'a': [1, 1, 2, 2, 3, 3, 4, 4], 'b': [1, 1, 2, 2, 3, 3, 9, 9], 'c': [1, 1, 2, 2, 8, 8, 9, 7],
+              'd': [5, 5, 6, 6, 7, 7, 8, 8]}
+
+
+def get_partition(documents, labels):
+    clusters = {}
+    for document, label in zip(documents, labels):
+        clusters.setdefault(label, set()).add(document)
+    return sorted(sorted(cluster) for cluster in clusters.values())
+
+
+def test_normalize_document_strips_copy_noise():
+    assert normalize_document('RT @who: Masks WORK!! https://t.co/abc 😷') == 'masks work'
+
+
+def test_copies_collapse_to_the_first_document():
+    documents = ['Masks work https://t.co/1', UNRELATED, 'RT @cdc: masks work!', 'https://t.co/2',
+                 'https://t.co/2', 'https://t.co/3']
+    first_docs, labels = collapse_near_duplicates(documents, CFG)
+    assert first_docs == [0, 1, 3, 5]
+    assert labels.tolist() == [0, 1, 0, 2, 2, 3]
+
+
+def test_clusters_do_not_depend_on_document_order(monkeypatch):
+    monkeypatch.setattr(near_duplicates, 'get_shingles', lambda document, shingle_size: document)
+    monkeypatch.setattr(near_duplicates, 'get_minhash', lambda document, a, b: SIGNATURES[document])
+    for order in permutations(SIGNATURES):
+        first_docs, labels = collapse_near_duplicates(list(order), CFG)
+        assert get_partition(order, labels) == [['a', 'b', 'c'], ['d']]
+        # every cluster is represented by its first document
+        assert sorted(first_docs) == [int(np.argmax(labels == label)) for label in range(len(first_docs))]
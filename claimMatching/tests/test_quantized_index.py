@@ -0,0 +1,57 @@
+import os
+
+import numpy as np
+import pytest
+
+from func.ann_index import ExactIndex, get_candidate_index
+
+DOCS = ['claim ' + str(index) for index in range(200)]
+
+
+def get_cfg(tmp_path, quantization, **overrides):
+    cfg = {'model': 'model', 'index_dir': str(tmp_path), 'index_type': 'exact', 'embedding_quantization': quantization,
+           'rerank_factor': 8, 'num_matches': 5}
+    cfg.update(overrides)
+    return cfg
+
+
+@pytest.fixture
+def embeddings():
+    return np.random.default_rng(0).standard_normal((len(DOCS), 32))
+
+
+def list_vectors(tmp_path):
+    return sorted(file for file in os.listdir(tmp_path) if file.endswith('.npy'))
+
+
+@pytest.mark.parametrize('quantization', ['float16', 'int8'])
+def test_reranked_search_matches_exact_search(tmp_path, embeddings, quantization):
+    cfg = get_cfg(tmp_path, quantization)
+    queries = embeddings[:20] + 0.1 * np.random.default_rng(1).standard_normal((20, 32))
+    exact_distances, exact_indices = ExactIndex(embeddings, cfg).search(queries, 5)
+    distances, indices = get_candidate_index(DOCS, embeddings, 'ng', cfg).search(queries, 5)
+    assert np.array_equal(indices, exact_indices)
+    assert np.allclose(distances, exact_distances, atol=1e-6)
+
+
+def test_rerank_vectors_are_keyed_by_model_and_candidates(tmp_path, embeddings):
+    cfg = get_cfg(tmp_path, 'int8')
+    index = get_candidate_index(DOCS, embeddings, 'ng', cfg)
+    [vector_file] = list_vectors(tmp_path)
+    assert vector_file.startswith('ng-model-')
+    modified = os.path.getmtime(tmp_path / vector_file)
+
+    # the same model and candidates reuse the file, whatever the quantization
+    os.utime(tmp_path / vector_file, (modified - 100, modified - 100))
+    get_candidate_index(DOCS, embeddings, 'ng', get_cfg(tmp_path, 'float16'))
+    assert list_vectors(tmp_path) == [vector_file]
+    assert os.path.getmtime(tmp_path / vector_file) == modified - 100
+
+    # another model gets its own file, and changed candidates replace the model's previous file
+    get_candidate_index(DOCS, embeddings, 'ng', get_cfg(tmp_path, 'int8', quantize_model=True))
+    assert [file.startswith('ng-model-qint8-') for file in list_vectors(tmp_path)] == [False, True]
+    get_candidate_index(DOCS[:-1], embeddings[:-1], 'ng', cfg)
+    files = list_vectors(tmp_path)
+    assert len(files) == 2 and vector_file not in files
+    # an index still mapping the removed file keeps searching it
+    assert index.search(embeddings[:2], 1)[1].ravel().tolist() == [0, 1]
@@ -0,0 +1,55 @@
+import json, os
+
+import numpy as np
+import pytest
+
+from func.ann_index import ExactIndex, get_candidate_index, index_top_matches
+
+DOCS = ['claim ' + str(index) for index in range(300)]
+
+
+def get_cfg(tmp_path, num_shards, **overrides):
+    cfg = {'model': 'model', 'index_dir': str(tmp_path), 'index_type': 'exact', 'num_shards': num_shards,
+           'num_matches': 5, 'shard_connect_timeout': 60}
+    cfg.update(overrides)
+    return cfg
+
+
+@pytest.fixture(scope='module')
+def embeddings():
+    return np.random.default_rng(0).standard_normal((len(DOCS), 32)).astype(np.float32)
+
+
+@pytest.mark.parametrize('num_shards', [2, 3])
+def test_sharded_search_matches_unsharded_search(tmp_path, embeddings, num_shards):
+    cfg = get_cfg(tmp_path, num_shards)
+    queries = embeddings[:40] + 0.5 * np.random.default_rng(1).standard_normal((40, 32))
+    expected = ExactIndex(embeddings, cfg)
+    index = get_candidate_index(DOCS, embeddings, 'ng', cfg)
+    try:
+        assert index.index_type == 'exact-sharded' and len(index) == len(DOCS)
+        # the workers load their shards from the saved embeddings rather than being sent them
+        assert [file for file in os.listdir(tmp_path) if file.endswith('.npy')] != []
+        for k in (1, 5, 20):
+            distances, indices = index.search(queries, k)
+            expected_distances, expected_indices = expected.search(queries, k)
+            np.testing.assert_array_equal(indices, expected_indices)
+            np.testing.assert_allclose(distances, expected_distances, atol=1e-6)
+
+        distances, indices = index_top_matches(index, embeddings, 'ng', 'ng', cfg)
+        expected_distances, expected_indices = index_top_matches(expected, embeddings, 'ng', 'ng', cfg)
+        np.testing.assert_array_equal(indices, expected_indices)
+        np.testing.assert_allclose(distances, expected_distances, atol=1e-6)
+        assert not (indices == np.arange(len(DOCS)).reshape(-1, 1)).any()
+    finally:
+        index.close()
+
+
+def test_missing_workers_time_out(tmp_path, embeddings):
+    secret_loc = tmp_path / 'secret.json'
+    with open(secret_loc, 'w') as f:
+        json.dump({'shard_authkey': 'key'}, f)
+    cfg = get_cfg(tmp_path, 2, shard_local_workers=False, shard_address='127.0.0.1:0', secret_loc=str(secret_loc),
+                  shard_connect_timeout=0.5)
+    with pytest.raises(SystemExit):
+        get_candidate_index(DOCS, embeddings, 'ng', cfg)
@@ -0,0 +1,59 @@
+import numpy as np
+
+from func.similarity import batched_top_matches, exclude_ids, get_block_size, normalize_embeddings, top_k_rows, \
+    top_matches
+
+
+def brute_force(search, candidates, k):
+    search = search / np.linalg.norm(search, axis=1, keepdims=True)
+    candidates = candidates / np.linalg.norm(candidates, axis=1, keepdims=True)
+    distances = 1.0 - search @ candidates.T
+    indices = np.argsort(distances, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(distances, indices, axis=1), indices
+
+
+def test_top_matches_matches_brute_force():
+    rng = np.random.default_rng(0)
+    search, candidates = rng.standard_normal((40, 8)), rng.standard_normal((300, 8))
+    distances, indices = top_matches(search, candidates, 5, {})
+    expected_distances, expected_indices = brute_force(search, candidates, 5)
+    assert np.array_equal(indices, expected_indices)
+    assert np.allclose(distances, expected_distances)
+
+
+def test_top_matches_is_independent_of_block_size():
+    rng = np.random.default_rng(1)
+    search, candidates = rng.standard_normal((50, 4)), rng.standard_normal((1000, 4))
+    # a budget this small gives one search row per block
+    assert get_block_size(len(candidates), {'match_memory_mb': 0.001}) == 1
+    blocked = top_matches(search, candidates, 3, {'match_memory_mb': 0.001})
+    whole = top_matches(search, candidates, 3, {})
+    assert np.array_equal(blocked[1], whole[1])
+
+
+def test_top_k_rows_breaks_ties_by_index():
+    distances = np.array([[0.5, 0.1, 0.5, 0.5, 0.1]])
+    assert top_k_rows(distances, 3).tolist() == [[1, 4, 0]]
+    assert top_k_rows(distances, 10).tolist() == [[1, 4, 0, 2, 3]]
+    assert top_k_rows(distances, 0).shape == (1, 0)
+
+
+def test_normalize_embeddings_keeps_zero_vectors():
+    normalized = normalize_embeddings([[3.0, 4.0], [0.0, 0.0]])
+    assert np.allclose(normalized, [[0.6, 0.8], [0.0, 0.0]])
+
+
+def test_exclude_ids_drops_own_candidate_anywhere_in_row():
+    distances = np.array([[0.1, 0.2, 0.3], [0.1, 0.2, 0.3]])
+    indices = np.array([[7, 3, 5], [4, 8, 9]])
+    kept_distances, kept_indices = exclude_ids(distances, indices, np.array([3, 0]), 2)
+    assert kept_indices.tolist() == [[7, 5], [4, 8]]
+    assert kept_distances.tolist() == [[0.1, 0.3], [0.1, 0.2]]
+
+
+def test_batched_top_matches_skips_self_match():
+    rng = np.random.default_rng(2)
+    embeddings = rng.standard_normal((20, 6))
+    distances, indices = batched_top_matches(embeddings, embeddings, 'ng', 'ng', {'num_matches': 3})
+    assert indices.shape == (20, 3)
+    assert not np.any(indices == np.arange(20).reshape(-1, 1))
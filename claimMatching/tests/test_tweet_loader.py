@@ -0,0 +1,38 @@
+import json
+
+from func import tweet_loader
+
+ENGLISH = ['The vaccine was tested on thousands of people before it was approved for use',
+           'Masks reduce the spread of the virus according to several large studies',
+           'The president said that the schools will reopen in the fall for all students']
+SPANISH = 'La vacuna fue probada en miles de personas antes de ser aprobada para su uso'
+
+
+def write_tweets(tmp_path, name, tweets):
+    with open(tmp_path / name, 'w') as f:
+        for text, lang in tweets:
+            f.write(json.dumps({'full_text': text, 'lang': lang}) + '\n')
+
+
+def get_cfg(tmp_path, **overrides):
+    cfg = {'tweet_dir': str(tmp_path), 'tweet_files': [r'tweets_\d\.jsonl'], 'num_entries': 0,
+           'remove_text_only': False, 'ingest_workers': 1}
+    cfg.update(overrides)
+    return cfg
+
+
+def test_only_english_tweets_are_kept(tmp_path):
+    write_tweets(tmp_path, 'tweets_1.jsonl', [(ENGLISH[0], 'en'), (SPANISH, 'es'), (ENGLISH[1], 'und')])
+    # a tweet tagged English whose text is not is dropped by the language detector
+    write_tweets(tmp_path, 'tweets_2.jsonl', [(SPANISH, 'en'), (ENGLISH[2], 'en')])
+    write_tweets(tmp_path, 'other.jsonl', [(ENGLISH[1], 'en')])
+    for workers in (1, 2):
+        tweets = tweet_loader.get_local_tweet_data(False, get_cfg(tmp_path, ingest_workers=workers))
+        assert [tweet['full_text'] for tweet in tweets] == [ENGLISH[0], ENGLISH[2]]
+
+
+def test_entry_limit_counts_kept_tweets(tmp_path):
+    write_tweets(tmp_path, 'tweets_1.jsonl', [(SPANISH, 'es'), (ENGLISH[0], 'en'), (SPANISH, 'es'), (ENGLISH[1], 'en')])
+    write_tweets(tmp_path, 'tweets_2.jsonl', [(ENGLISH[2], 'en')])
+    tweets = tweet_loader.get_local_tweet_data(False, get_cfg(tmp_path, num_entries=2, ingest_workers=2))
+    assert [tweet['full_text'] for tweet in tweets] == [ENGLISH[0], ENGLISH[1]]
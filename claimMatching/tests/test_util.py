@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from func.util import LRUSet, build_word_count_matrix, build_word_encoder_decoder, do_tf_idf, get_filtering_words, \
+    get_unique_words, make_list_unique, tokenize
+
+CLAIMS = ['Masks cause hypoxia in children', 'Vaccines alter your DNA', 'The vaccine contains a microchip',
+          'Masks do not work against the virus', '5G towers spread the virus', 'Garlic cures the virus',
+          'Drinking bleach cures COVID', 'The virus was made in a lab', 'Vaccines cause infertility in women',
+          'Hand sanitizer causes cancer', 'Children cannot catch the virus', 'The vaccine changes your DNA']
+STOPWORDS = ['the', 'in', 'a', 'do', 'not', 'your', 'was']
+
+
+class FakeStopwords:
+    @staticmethod
+    def words(language):
+        return list(STOPWORDS)
+
+
+def dense_tf_idf(documents):
+    """
+    The dense TF-IDF the sparse one replaced.
+    """
+    unique_words = list(dict.fromkeys(word.lower() for document in documents for word in document.split(' ')))
+    word_encoder, word_decoder = build_word_encoder_decoder(unique_words)
+    word_counts = np.zeros((len(documents), len(unique_words)), dtype=np.int32)
+    for index, document in enumerate(documents):
+        for word in document.split(' '):
+            word_counts[index, word_encoder[word.lower()]] += 1
+    tf_matrix = word_counts / np.sum(word_counts, axis=1).reshape(-1, 1)
+    idf_matrix = np.log(len(documents) / np.sum(word_counts > 0, axis=0))
+    return tf_matrix * idf_matrix, word_encoder, word_decoder
+
+
+def dense_filtering_words(documents, cfg):
+    tf_idf_matrix, word_encoder, word_decoder = dense_tf_idf(documents)
+    tf_idf_averages = np.sum(tf_idf_matrix, axis=0)
+    for word in STOPWORDS + cfg['stopwords']:
+        if word in word_decoder:
+            tf_idf_averages[word_encoder[word]] = 0
+    return [word_decoder[term] for term in np.argsort(tf_idf_averages)[-cfg['num_filters']:]]
+
+
+def test_lru_set_forgets_least_recently_seen():
+    seen = LRUSet(2)
+    assert seen.add('a') and seen.add('b')
+    # seeing a again makes b the least recently seen
+    assert not seen.add('a')
+    assert seen.add('c')
+    assert 'b' not in seen and 'a' in seen and len(seen) == 2
+    assert seen.add('b')
+
+
+def test_make_list_unique_keeps_first_occurrences_in_order():
+    assert make_list_unique(['b', 'a', 'b', 'c', 'a']) == ['b', 'a', 'c']
+
+
+def test_word_count_matrix():
+    documents = ['Masks work', 'masks do not work work']
+    unique_words = get_unique_words(documents)
+    encoder, decoder = build_word_encoder_decoder(unique_words)
+    counts = build_word_count_matrix(documents, unique_words, encoder).toarray()
+    assert tokenize('Masks work') == ['masks', 'work']
+    assert counts[0, encoder['masks']] == 1 and counts[1, encoder['work']] == 2
+    assert counts.sum() == 7
+    assert all(decoder[encoder[word]] == word for word in unique_words)
+
+
+def test_tf_idf_weighs_rarer_words_higher():
+    tf_idf, encoder, _ = do_tf_idf(['covid vaccine', 'covid masks', 'covid cure'])
+    scores = tf_idf.toarray()
+    # a word in every document has an idf of 0
+    assert np.allclose(scores[:, encoder['covid']], 0)
+    assert np.isclose(scores[0, encoder['vaccine']], 0.5 * np.log(3))
+
+
+@pytest.mark.parametrize('num_filters', [1, 5, 20])
+def test_sparse_filtering_words_match_the_dense_ones(monkeypatch, num_filters):
+    pytest.importorskip('nltk')
+    pytest.importorskip('scipy')
+    monkeypatch.setattr('nltk.corpus.stopwords', FakeStopwords)
+    cfg = {'stopwords': ['virus'], 'num_filters': num_filters}
+    expected = dense_filtering_words(CLAIMS, cfg)
+    assert get_filtering_words(CLAIMS, cfg) == expected
+    assert 'virus' not in expected[-5:] and 'the' not in expected[-5:]
+
+    tf_idf, encoder, decoder = do_tf_idf(CLAIMS)
+    dense, dense_encoder, dense_decoder = dense_tf_idf(CLAIMS)
+    assert decoder == dense_decoder and encoder == dense_encoder
+    np.testing.assert_allclose(tf_idf.toarray(), dense, atol=1e-12)